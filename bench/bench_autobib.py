@@ -0,0 +1,103 @@
+"""
+Benchmark Autobib.create_bibliography: one pandoc run per citekey versus
+batched pandoc runs.
+
+Generates a bib file and a note citing some of its entries, renders the
+bibliography both ways, checks that the results are the same and prints
+the timings.
+
+    python bench/bench_autobib.py [--pandoc PATH] [--entries N] [--cited N]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sublime_zk   # noqa: E402
+
+LAST_NAMES = ['Smith', 'Doe', 'Miller', 'Meyer', 'Nguyen', 'Kim', 'Lee',
+              'Garcia', 'Rossi', 'Novak', 'Berg', 'Holm', 'Sato', 'Khan']
+
+
+def write_bibfile(filn, n_entries, rnd):
+    with open(filn, mode='w', encoding='utf-8') as f:
+        for i in range(n_entries):
+            authors = ' and '.join(
+                '{}{}, {}.'.format(rnd.choice(LAST_NAMES), rnd.randrange(50),
+                                   chr(ord('A') + rnd.randrange(26)))
+                for _ in range(rnd.randint(1, 3)))
+            f.write('@article{{key{i},\n'
+                    '  author = {{{authors}}},\n'
+                    '  title = {{On the {i}th \\emph{{thing}}}},\n'
+                    '  journal = {{Journal of Things}},\n'
+                    '  volume = {{{volume}}},\n'
+                    '  pages = {{1--20}},\n'
+                    '  year = {{{year}}},\n'
+                    '}}\n\n'.format(i=i, authors=authors,
+                                    volume=rnd.randrange(1, 40),
+                                    year=rnd.randrange(1950, 2020)))
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pandoc', default='pandoc')
+    parser.add_argument('--entries', type=int, default=2000)
+    parser.add_argument('--cited', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not shutil.which(args.pandoc):
+        print('pandoc not found:', args.pandoc)
+        return 1
+
+    rnd = random.Random(args.seed)
+    tmpdir = tempfile.mkdtemp(prefix='zk_bench_autobib_')
+    try:
+        bibfile = os.path.join(tmpdir, 'bench.bib')
+        write_bibfile(bibfile, args.entries, rnd)
+        cited = rnd.sample(range(args.entries), min(args.cited, args.entries))
+        text = '\n\n'.join('Some text [@key{}, p. 3].'.format(i)
+                           for i in cited)
+        # parse the bib file once, so both runs measure pandoc only
+        sublime_zk.Autobib.extract_all_citekeys(bibfile)
+
+        single, t_single = timed(sublime_zk.Autobib.create_bibliography,
+                                 text, bibfile, pandoc=args.pandoc,
+                                 batched=False)
+        batched, t_batched = timed(sublime_zk.Autobib.create_bibliography,
+                                   text, bibfile, pandoc=args.pandoc)
+        n_batches = len(sublime_zk.Autobib.batches_of(
+            sorted(batched), sublime_zk.Autobib.extract_all_entries(bibfile)))
+
+        print('citekeys:          {}'.format(len(single)))
+        print('per citekey:       {:.2f} s'.format(t_single))
+        print('batched:           {:.2f} s  ({} batches)'.format(
+            t_batched, n_batches))
+        print('speedup:           {:.1f}x'.format(t_single / t_batched))
+        if single != batched:
+            for citekey in sorted(set(single) | set(batched)):
+                if single.get(citekey) != batched.get(citekey):
+                    print('MISMATCH', citekey)
+                    print('  per citekey:', single.get(citekey))
+                    print('  batched:    ', batched.get(citekey))
+            return 1
+        print('results:           identical')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
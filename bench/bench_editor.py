@@ -0,0 +1,240 @@
+"""
+Benchmark the editor paths of sublime_zk on a large buffer, headlessly.
+
+Builds a buffer out of the notes of a synthetic archive (see corpus.py),
+opens it in a simulated View (see sublime.py) and measures link and tag
+highlighting (the first pass and per keystroke), the toc and heading
+commands, showing and hiding images and select_link_in. For each, prints
+the time spent in the plugin, without the time spent in the simulated
+View API, and the number of API calls. Exits with 1 if links and tags
+inserted away from the cursor during a highlighting pass stay unhighlighted.
+
+    python bench/bench_editor.py [--notes N] [--keystrokes N]
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import random
+import shutil
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sublime        # noqa: E402
+import corpus as corpus_generator     # noqa: E402
+import sublime_zk     # noqa: E402
+
+
+def write_png(filn, width, height):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(b'\x00' + b'\x80' * width * 3 for _ in range(height))
+    with open(filn, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2,
+                                           0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def build_text(corpus, n_images, rnd):
+    """
+    Return the text of all notes of corpus, with code blocks and image
+    links in between.
+    """
+    index = sublime_zk.NoteIndex.for_folder(corpus.folder, corpus.extension)
+    parts = []
+    for i, note_id in enumerate(corpus.ids):
+        with open(index.path_for(note_id), encoding='utf-8') as f:
+            parts.append(f.read())
+        if i % 50 == 25:
+            parts.append('```\n# code, not a heading [[{}]] #code\n```'
+                         .format(rnd.choice(corpus.ids)))
+        if i % max(1, len(corpus.ids) // max(1, n_images)) == 0:
+            parts.append('![figure {}](images/img{}.png)'.format(
+                i, i % 10))
+    return '\n\n'.join(parts) + '\n'
+
+
+class Measurement:
+    """
+    Time spent in the plugin and API calls made, for a number of runs.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.timings = []
+        self.calls = Counter()
+
+    def run(self, func, *args):
+        view = self.view
+        api_time = view.api_time
+        calls = Counter(view.api_calls)
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        self.timings.append((elapsed - (view.api_time - api_time)) * 1000)
+        self.calls.update(view.api_calls - calls)
+        return result
+
+    def report(self, name):
+        timings = sorted(self.timings)
+        n = len(timings)
+        calls = sum(self.calls.values()) / n
+        top = ', '.join('{} {:.1f}'.format(call, count / n) for call, count
+                        in self.calls.most_common(3))
+        print('{:<24} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>8.1f}  {}'.format(
+            name, n, timings[n // 2], timings[min(n - 1, int(n * 0.95))],
+            timings[-1], calls, top))
+
+
+def highlight_all(highlighter, view):
+    highlighter.update_note_link_highlights(view)
+    while highlighter.fill_in_highlights(view):
+        pass
+
+
+def highlighted(view, text):
+    """
+    Whether text is highlighted somewhere in view.
+    """
+    return any(view.substr(region) == text
+               for key in list(view.regions) if key.startswith(('clickable',
+                                                                 'tag'))
+               for region in view.get_regions(key))
+
+
+def check_remote_edits(highlighter, view, corpus, rnd, n):
+    """
+    Have a command insert a link and a tag away from the cursor, while a
+    highlighting pass runs. Returns how many of the n edits were not
+    highlighted after the next passes.
+    """
+    find_highlights = highlighter.find_highlights
+    missed = 0
+    for i in range(n):
+        note_id = rnd.choice(corpus.ids)
+        tag = '#remote{}'.format(i)
+        pos = view.line(rnd.randrange(view.size())).b
+        view.sel().clear()
+        view.sel().add(sublime.Region(pos))
+        highlighter.on_selection_modified(view)
+        view.edit(sublime.Region(pos), ' #local{}'.format(i))
+        highlighter.on_modified(view)
+        target = view.line(rnd.randrange(view.size())).b
+        edits = []
+
+        def racing_find(*args):
+            if not edits:
+                edits.append(target)
+                view.insert(sublime.Edit(), target,
+                            ' [[{}]] {}'.format(note_id, tag))
+                highlighter.on_modified(view)
+            return find_highlights(*args)
+        highlighter.find_highlights = racing_find
+        try:
+            highlight_all(highlighter, view)
+        finally:
+            highlighter.find_highlights = find_highlights
+        highlight_all(highlighter, view)
+        if not (highlighted(view, tag) and highlighted(view, note_id)):
+            missed += 1
+    return missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--notes', type=int, default=1000,
+                        help='notes in the buffer')
+    parser.add_argument('--keystrokes', type=int, default=200)
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    corpus = corpus_generator.cached(args.notes, args.seed)
+    folder = tempfile.mkdtemp(prefix='zk_bench_editor_')
+    try:
+        os.mkdir(os.path.join(folder, 'images'))
+        for i in range(10):
+            write_png(os.path.join(folder, 'images', 'img{}.png'.format(i)),
+                      400 + i * 10, 300)
+        text = build_text(corpus, args.images, rnd)
+        window = sublime.Window(folders=[folder])
+        view = sublime.View(text, os.path.join(folder, 'buffer.md'), window)
+        window.window_views.append(view)
+        window.active = view
+        print('buffer: {} lines, {} characters'.format(
+            text.count('\n'), len(text)))
+        print('{:<24} {:>6} {:>9} {:>9} {:>9} {:>8}  {}'.format(
+            'operation', 'runs', 'median ms', 'p95 ms', 'max ms',
+            'calls', 'most called'))
+
+        highlighter = sublime_zk.NoteLinkHighlighter()
+        first = Measurement(view)
+        first.run(highlighter.update_note_link_highlights, view)
+        first.report('highlight visible')
+        rest = Measurement(view)
+        while rest.run(highlighter.fill_in_highlights, view):
+            pass
+        rest.report('highlight rest (chunk)')
+
+        # type a link and a tag in a few places, one character at a time
+        typing = Measurement(view)
+        snippet = ' see [[{}]] #typed'
+        while len(typing.timings) < args.keystrokes:
+            pos = view.line(rnd.randrange(view.size())).b
+            view.show_at_center(pos)
+            view.sel().clear()
+            view.sel().add(sublime.Region(pos))
+            highlighter.on_selection_modified(view)
+            for char in snippet.format(rnd.choice(corpus.ids)):
+                view.edit(sublime.Region(pos), char)
+                pos += 1
+                highlighter.on_modified(view)
+                highlighter.on_selection_modified(view)
+                typing.run(highlight_all, highlighter, view)
+        typing.report('highlight per keystroke')
+        missed = check_remote_edits(highlighter, view, corpus, rnd, 10)
+        if missed:
+            print('remote edits not highlighted: {} of 10'.format(missed))
+            return 1
+
+        # numbering and denumbering in turns, so each run has work to do
+        view.sel().clear()
+        view.sel().add(sublime.Region(0))
+        commands = ('zk_toc', 'zk_renumber_headings', 'zk_denumber_headings')
+        measurements = dict((command, Measurement(view))
+                            for command in commands)
+        for i in range(3):
+            for command in commands:
+                measurements[command].run(view.run_command, command)
+        for command in commands:
+            measurements[command].report(command)
+
+        edit = sublime.Edit()
+        show = Measurement(view)
+        hide = Measurement(view)
+        for i in range(3):
+            show.run(sublime_zk.ImageHandler.show_images, view, edit, 320)
+            hide.run(sublime_zk.ImageHandler.hide_images, view, edit)
+        show.report('show_images')
+        hide.report('hide_images')
+
+        select = Measurement(view)
+        for i in range(1000):
+            view.sel().clear()
+            view.sel().add(sublime.Region(rnd.randrange(view.size())))
+            select.run(sublime_zk.select_link_in, view)
+        select.report('select_link_in')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+Generate synthetic note archives for benchmarks.
+
+The archives are deterministic: the same number of notes and seed always
+give the same files. Notes are named like real ones, `<ID> <title>.md`,
+with IDs a few minutes apart. They carry tags drawn from a Zipf-like
+distribution, links to earlier notes with a long-tailed number of links per
+note, citations of the entries of a matching .bib file, sub-headings and
+some text.
+
+    python bench/corpus.py FOLDER [--notes N] [--seed S]
+"""
+import os
+import re
+import sys
+import math
+import string
+import random
+import bisect
+import argparse
+import datetime
+import tempfile
+from collections import namedtuple, Counter
+
+Corpus = namedtuple('Corpus', ['folder', 'extension', 'bibfile', 'ids',
+                               'tags', 'citekeys'])
+
+WORDS = '''
+    archive argument author book card citation claim concept context data
+    definition draft evidence example field idea index insight knowledge link
+    literature memory method model network note object outline paper pattern
+    point problem process question reading reference research result review
+    science source structure summary system text theory thought topic work
+    writing abstract basic central clear common complex critical deep early
+    general hidden important key local main major minor modern natural new
+    old open personal primary simple social special strong useful visible
+    analyse build collect compare connect create develop discuss explain find
+    follow form group keep learn make organise read remember see show sort
+    study take test think use write about across after against along among
+    around because before between during into through under with without
+'''.split()
+
+TAG_WORDS = '''
+    zettelkasten method writing reading research productivity psychology
+    philosophy history science physics biology economics politics design
+    software python markdown learning memory creativity statistics math
+    language literature art music education health todo idea project draft
+    question quote person book paper concept theory example summary review
+'''.split()
+
+LAST_NAMES = ['Smith', 'Doe', 'Miller', 'Meyer', 'Nguyen', 'Kim', 'Lee',
+              'Garcia', 'Rossi', 'Novak', 'Berg', 'Holm', 'Sato', 'Khan',
+              'Luhmann', 'Ahrens', 'Weber', 'Schmidt', 'Dubois', 'Silva']
+
+First_Id = datetime.datetime(2012, 1, 1, 8, 0)
+Span_Minutes = 10 * 365 * 24 * 60     # IDs spread over about ten years
+
+
+class WeightedChoice:
+    """
+    Pick from items with Zipf-like weights 1 / rank^exponent.
+    """
+    def __init__(self, items, exponent=1.1):
+        self.items = items
+        self.cum_weights = []
+        total = 0
+        for rank in range(1, len(items) + 1):
+            total += 1 / rank ** exponent
+            self.cum_weights.append(total)
+        self.total = total
+
+    def pick(self, rnd):
+        i = bisect.bisect(self.cum_weights, rnd.random() * self.total)
+        return self.items[min(i, len(self.items) - 1)]
+
+
+def make_ids(n_notes, rnd):
+    """
+    Return n_notes increasing 12 digit note IDs, a few minutes apart.
+    """
+    mean_gap = max(1.0, Span_Minutes / max(n_notes, 1))
+    ids = []
+    minutes = 0
+    for i in range(n_notes):
+        if mean_gap > 1:
+            minutes += 1 + int(rnd.expovariate(1 / (mean_gap - 1)))
+        else:
+            minutes += 1
+        t = First_Id + datetime.timedelta(minutes=minutes)
+        ids.append(t.strftime('%Y%m%d%H%M'))
+    return ids
+
+
+def make_tags(n_notes, rnd):
+    """
+    Return the tag vocabulary, most popular first. It grows with the square
+    root of the number of notes.
+    """
+    n_tags = max(len(TAG_WORDS), int(4 * math.sqrt(n_notes)))
+    tags = ['#' + word for word in TAG_WORDS]
+    rnd.shuffle(tags)
+    i = 0
+    while len(tags) < n_tags:
+        word = TAG_WORDS[i % len(TAG_WORDS)]
+        if i % 3 == 0:
+            tags.append('#{}/{}'.format(word, rnd.choice(WORDS)))
+        else:
+            tags.append('#{}-{}'.format(word, i))
+        i += 1
+    return sorted(set(tags), key=tags.index)
+
+
+def make_citekeys(n_entries, rnd):
+    """
+    Return n_entries citekeys like `miller1987b`.
+    """
+    citekeys = []
+    counts = Counter()
+    for i in range(n_entries):
+        citekey = '{}{}'.format(rnd.choice(LAST_NAMES).lower(),
+                                rnd.randrange(1950, 2020))
+        n = counts[citekey]
+        counts[citekey] += 1
+        citekeys.append(citekey + string.ascii_lowercase[n % 26] +
+                        (str(n // 26) if n >= 26 else ''))
+    return citekeys
+
+
+def write_bibfile(filn, citekeys, rnd):
+    with open(filn, mode='w', encoding='utf-8') as f:
+        for citekey in citekeys:
+            year = re.search(r'\d{4}', citekey).group()
+            authors = ' and '.join(
+                '{}, {}.'.format(rnd.choice(LAST_NAMES),
+                                 chr(ord('A') + rnd.randrange(26)))
+                for _ in range(rnd.randint(1, 3)))
+            f.write('@article{{{key},\n'
+                    '  author = {{{authors}}},\n'
+                    '  title = {{On {word} and {other}}},\n'
+                    '  journal = {{Journal of {field}}},\n'
+                    '  volume = {{{volume}}},\n'
+                    '  pages = {{1--20}},\n'
+                    '  year = {{{year}}},\n'
+                    '}}\n\n'.format(key=citekey, authors=authors,
+                                    word=rnd.choice(WORDS),
+                                    other=rnd.choice(WORDS),
+                                    field=rnd.choice(TAG_WORDS).title(),
+                                    volume=rnd.randrange(1, 40),
+                                    year=year))
+
+
+def sentence(rnd, n_words):
+    words = [rnd.choice(WORDS) for _ in range(n_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def link_count(rnd):
+    """
+    Long-tailed number of links of a note: most have a few, some many.
+    """
+    return min(int(rnd.paretovariate(1.3)) - 1 + rnd.randint(0, 2), 60)
+
+
+def note_text(i, ids, title, tag_choice, citekeys, rnd, words):
+    lines = ['# ' + title]
+    n_tags = min(int(rnd.expovariate(0.6)), 8)
+    tags = []
+    for _ in range(n_tags):
+        tag = tag_choice.pick(rnd)
+        if tag not in tags:
+            tags.append(tag)
+    lines.append('tags = ' + ' '.join(tags))
+    lines.append('')
+
+    links = []
+    if i:
+        for _ in range(link_count(rnd)):
+            if rnd.random() < 0.5:
+                # recent notes are linked more often than old ones
+                target = max(0, i - 1 - int(rnd.expovariate(0.05)))
+            else:
+                target = rnd.randrange(i)
+            links.append(ids[target])
+    cites = []
+    if citekeys and rnd.random() < 0.2:
+        cites = rnd.sample(citekeys, min(len(citekeys), rnd.randint(1, 3)))
+
+    n_paragraphs = max(1, words // 40)
+    for p in range(n_paragraphs):
+        if p and rnd.random() < 0.3:
+            lines.append('## ' + sentence(rnd, rnd.randint(1, 4))[:-1])
+            lines.append('')
+        paragraph = [sentence(rnd, rnd.randint(5, 15)) for _ in range(3)]
+        if links:
+            for link in links[p::n_paragraphs]:
+                style = rnd.random()
+                if style < 0.8:
+                    link = '[[{}]]'.format(link)
+                elif style < 0.9:
+                    link = '[{}]'.format(link)
+                else:
+                    link = '§' + link
+                paragraph.insert(rnd.randrange(len(paragraph) + 1),
+                                 'See ' + link + '.')
+        if cites and p == 0:
+            paragraph.append('As shown in [{}].'.format('; '.join(
+                '@{}, p. {}'.format(c, rnd.randint(1, 300)) for c in cites)))
+        lines.append(' '.join(paragraph))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def generate(folder, n_notes, seed=1, extension='.md', words=120):
+    """
+    Write an archive of n_notes notes and a bib file into folder.
+    Return its Corpus.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    ids = make_ids(n_notes, rnd)
+    tags = make_tags(n_notes, rnd)
+    citekeys = make_citekeys(max(50, n_notes // 20), rnd)
+    bibfile = os.path.join(folder, 'corpus.bib')
+    write_bibfile(bibfile, citekeys, rnd)
+    tag_choice = WeightedChoice(tags)
+    for i, note_id in enumerate(ids):
+        title = sentence(rnd, rnd.randint(2, 6))[:-1]
+        text = note_text(i, ids, title, tag_choice, citekeys, rnd, words)
+        filn = os.path.join(folder, '{} {}{}'.format(note_id, title,
+                                                     extension))
+        with open(filn, mode='w', encoding='utf-8') as f:
+            f.write(text)
+    return Corpus(folder, extension, bibfile, ids, tags, citekeys)
+
+
+def cached(n_notes, seed=1, extension='.md', words=120, root=None):
+    """
+    Return the Corpus of n_notes for seed, generated only once into a
+    folder below root (the temp dir by default).
+    """
+    root = root or os.path.join(tempfile.gettempdir(), 'sublime_zk_corpus')
+    folder = os.path.join(root, '{}-{}-{}'.format(n_notes, seed, words))
+    marker = os.path.join(folder, '.complete')
+    if not os.path.exists(marker):
+        corpus = generate(folder, n_notes, seed, extension, words)
+        with open(marker, mode='w') as f:
+            f.write('\n')
+        return corpus
+    # the IDs etc. come out of the same random sequence again
+    rnd = random.Random(seed)
+    ids = make_ids(n_notes, rnd)
+    tags = make_tags(n_notes, rnd)
+    citekeys = make_citekeys(max(50, n_notes // 20), rnd)
+    return Corpus(folder, extension, os.path.join(folder, 'corpus.bib'), ids,
+                  tags, citekeys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('folder')
+    parser.add_argument('--notes', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--words', type=int, default=120,
+                        help='about this many words per note')
+    args = parser.parse_args()
+    corpus = generate(args.folder, args.notes, args.seed, words=args.words)
+    print('{} notes, {} tags, {} bib entries in {}'.format(
+        len(corpus.ids), len(corpus.tags), len(corpus.citekeys),
+        corpus.folder))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""
+Benchmark the hot paths of sublime_zk on synthetic archives.
+
+Generates (or reuses) archives of the given sizes with corpus.py, runs each
+operation a few times against the plugin, with the `sublime` stub of this
+folder, and prints the latency per call and the peak memory allocated while
+it runs. Save the results with --save and compare later runs against them
+with --baseline, so regressions show up as numbers.
+
+    python bench/run_bench.py [--notes 1000,10000] [--only OP,...]
+                              [--repeat N] [--save FILE] [--baseline FILE]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sublime        # noqa: E402
+import corpus as corpus_generator     # noqa: E402
+import sublime_zk     # noqa: E402
+
+# Sublime runs async callbacks on its own thread, after the command that
+# queued them. Do the same between measurements, so background scans don't
+# add to the latency of the operation that triggered them.
+async_callbacks = []
+
+
+def set_timeout_async(callback, delay=0):
+    async_callbacks.append(callback)
+
+
+def run_async_callbacks():
+    while async_callbacks:
+        async_callbacks.pop(0)()
+
+
+sublime.set_timeout_async = set_timeout_async
+
+
+def reset_plugin(corpus):
+    """
+    Forget all indexes and caches, in memory and on disk.
+    """
+    run_async_callbacks()
+    for cls in (sublime_zk.NoteIndex, sublime_zk.TagIndex,
+                sublime_zk.LinkIndex, sublime_zk.CompletionIndex,
+                sublime_zk.FullTextIndex, sublime_zk.BibIndex):
+        cls.indexes.clear()
+    sublime_zk.NoteCache.entries.clear()
+    sublime_zk.NoteCache.size = 0
+    index_file = sublime_zk.NoteIndex.index_file(corpus.folder)
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    note_index = sublime_zk.NoteIndex(corpus.folder, corpus.extension)
+    full_text_file = sublime_zk.FullTextIndex(note_index).cache_file()
+    if os.path.exists(full_text_file):
+        os.remove(full_text_file)
+
+
+def warm_up(corpus):
+    """
+    Build the note index and its derived indexes.
+    """
+    sublime_zk.TagIndex.for_folder(corpus.folder, corpus.extension)
+    run_async_callbacks()
+
+
+# Each operation takes the corpus and a random generator and returns
+# (setup, run, calls): setup() runs before each measured run(), which does
+# `calls` calls of the operation.
+
+def op_index_build(corpus, rnd):
+    def setup():
+        reset_plugin(corpus)
+
+    def run():
+        index = sublime_zk.NoteIndex.for_folder(corpus.folder,
+                                                corpus.extension)
+        index.parse_pending()
+    return setup, run, 1
+
+
+def op_index_load(corpus, rnd):
+    def setup():
+        warm_up(corpus)
+        sublime_zk.NoteIndex.indexes.clear()
+
+    def run():
+        sublime_zk.NoteIndex.for_folder(corpus.folder, corpus.extension)
+    return setup, run, 1
+
+
+def op_note_file_by_id(corpus, rnd):
+    ids = [rnd.choice(corpus.ids) for _ in range(1000)]
+
+    def setup():
+        warm_up(corpus)
+
+    def run():
+        for note_id in ids:
+            sublime_zk.note_file_by_id(note_id, corpus.folder,
+                                       corpus.extension)
+    return setup, run, len(ids)
+
+
+def op_extract_tags(corpus, rnd):
+    index = sublime_zk.NoteIndex.for_folder(corpus.folder, corpus.extension)
+    paths = [index.path_for(rnd.choice(corpus.ids)) for _ in range(200)]
+
+    def setup():
+        warm_up(corpus)
+
+    def run():
+        for path in paths:
+            sublime_zk.extract_tags(path)
+    return setup, run, len(paths)
+
+
+def op_advanced_tag_search(corpus, rnd):
+    tags = corpus.tags
+    specs = [
+        tags[0],
+        '{} {}'.format(tags[1], tags[len(tags) // 2]),
+        '{}, !{}'.format(tags[0], tags[2]),
+        '{}*'.format(tags[3][:4]),
+    ]
+
+    def setup():
+        warm_up(corpus)
+
+    def run():
+        for spec in specs:
+            sublime_zk.TagSearch.advanced_tag_search(spec, corpus.folder,
+                                                     corpus.extension)
+    return setup, run, len(specs)
+
+
+def op_notes_and_tags_in(corpus, rnd):
+    def setup():
+        run_async_callbacks()
+
+    def run():
+        sublime_zk.ExternalSearch.notes_and_tags_in(corpus.folder,
+                                                    corpus.extension)
+    return setup, run, 1
+
+
+def op_expand_links(corpus, rnd):
+    text = '\n'.join('* [[{}]]'.format(rnd.choice(corpus.ids))
+                     for _ in range(100))
+
+    def setup():
+        warm_up(corpus)
+
+    def run():
+        sublime_zk.TextProduction.expand_links(text, corpus.folder,
+                                               corpus.extension,
+                                               replace_lines=True)
+    return setup, run, 1
+
+
+def op_full_text_search(corpus, rnd):
+    queries = [
+        'note',
+        'memory theory',
+        'research method writing',
+        '"build collect"',
+        rnd.choice(corpus.tags)[1:],
+    ]
+
+    def setup():
+        sublime_zk.FullTextIndex.for_folder(corpus.folder, corpus.extension)
+        run_async_callbacks()
+
+    def run():
+        index = sublime_zk.FullTextIndex.for_folder(corpus.folder,
+                                                    corpus.extension)
+        for query in queries:
+            index.search(query, 200)
+    return setup, run, len(queries)
+
+
+def op_create_bibliography(corpus, rnd):
+    if not shutil.which('pandoc'):
+        return None
+    citekeys = rnd.sample(corpus.citekeys, min(30, len(corpus.citekeys)))
+    text = '\n\n'.join('Some text [@{}, p. 3].'.format(citekey)
+                       for citekey in citekeys)
+
+    def setup():
+        # parse the bib file up front, this measures pandoc
+        sublime_zk.Autobib.extract_all_citekeys(corpus.bibfile)
+
+    def run():
+        sublime_zk.Autobib.create_bibliography(text, corpus.bibfile)
+    return setup, run, 1
+
+
+OPERATIONS = OrderedDict([
+    ('index_build', op_index_build),
+    ('index_load', op_index_load),
+    ('note_file_by_id', op_note_file_by_id),
+    ('extract_tags', op_extract_tags),
+    ('advanced_tag_search', op_advanced_tag_search),
+    ('notes_and_tags_in', op_notes_and_tags_in),
+    ('expand_links', op_expand_links),
+    ('full_text_search', op_full_text_search),
+    ('create_bibliography', op_create_bibliography),
+])
+
+
+def measure(setup, run, calls, repeat):
+    """
+    Return (median ms per call, min ms per call, peak MiB). Memory is
+    traced in an extra run, so tracing doesn't slow down the timed ones.
+    """
+    timings = []
+    for i in range(repeat):
+        setup()
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000 / calls)
+    setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    return timings[len(timings) // 2], timings[0], peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--notes', default='1000,10000',
+                        help='comma separated archive sizes')
+    parser.add_argument('--only', default='',
+                        help='comma separated operations, out of: ' +
+                        ', '.join(OPERATIONS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--corpus-dir', default=None,
+                        help='where to keep the generated archives')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE (json)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with the results saved in FILE')
+    args = parser.parse_args()
+
+    names = [name for name in args.only.split(',') if name] or \
+        list(OPERATIONS)
+    for name in names:
+        if name not in OPERATIONS:
+            parser.error('unknown operation: ' + name)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = OrderedDict()
+    print('{:<22} {:>8} {:>6} {:>10} {:>10} {:>9} {:>8}'.format(
+        'operation', 'notes', 'calls', 'median ms', 'min ms', 'peak MiB',
+        'vs base'))
+    for n_notes in [int(n) for n in args.notes.split(',')]:
+        start = time.perf_counter()
+        corpus = corpus_generator.cached(n_notes, args.seed,
+                                         root=args.corpus_dir)
+        generated = time.perf_counter() - start
+        if generated > 1:
+            print('(archive of {} notes ready after {:.1f} s)'.format(
+                n_notes, generated))
+        reset_plugin(corpus)
+        for name in names:
+            rnd = random.Random(args.seed)
+            operation = OPERATIONS[name](corpus, rnd)
+            if operation is None:
+                print('{:<22} {:>8} skipped'.format(name, n_notes))
+                continue
+            setup, run, calls = operation
+            median, best, peak = measure(setup, run, calls, args.repeat)
+            key = '{}/{}'.format(name, n_notes)
+            results[key] = {'median_ms': median, 'min_ms': best,
+                            'peak_mib': peak}
+            versus = ''
+            if key in baseline and baseline[key]['median_ms']:
+                versus = '{:.2f}x'.format(median /
+                                          baseline[key]['median_ms'])
+            print('{:<22} {:>8} {:>6} {:>10.3f} {:>10.3f} {:>9.2f} {:>8}'
+                  .format(name, n_notes, calls, median, best, peak, versus))
+        reset_plugin(corpus)
+
+    if args.save:
+        with open(args.save, mode='w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,934 @@
+"""
+Minimal stand-in for Sublime Text's `sublime` module, so sublime_zk can be
+imported and benchmarked outside of Sublime.
+
+Settings are the package defaults from sublime_zk.sublime-settings.
+Timeouts without a delay run their callbacks right away, others on a timer
+thread.
+
+View and Window simulate editor buffers in memory, with the scopes of a
+minimal markdown syntax (see MarkdownScopes), so text commands and event
+listeners can run headlessly. Views count their API calls.
+"""
+import os
+import re
+import json
+import time
+import bisect
+import tempfile
+import threading
+from collections import Counter
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LITERAL = 1
+IGNORECASE = 2
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SOLID_UNDERLINE = 512
+HIDDEN = 128
+LAYOUT_INLINE = 0
+LAYOUT_BELOW = 1
+LAYOUT_BLOCK = 2
+
+
+class Settings:
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def has(self, key):
+        return key in self.values
+
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+def read_settings_file(filn):
+    """
+    Parse a .sublime-settings file: JSON with comments and trailing commas.
+    """
+    with open(filn, encoding='utf-8') as f:
+        lines = [line for line in f
+                 if not line.strip().startswith('//')]
+    text = re.sub(r',(\s*[}\]])', r'\1', ''.join(lines))
+    return json.loads(text)
+
+
+settings = {}   # name -> Settings
+
+
+def load_settings(name):
+    if name not in settings:
+        filn = os.path.join(PACKAGE_DIR, name)
+        values = read_settings_file(filn) if os.path.exists(filn) else {}
+        settings[name] = Settings(values)
+    return settings[name]
+
+
+def save_settings(name):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    if delay:
+        timer = threading.Timer(delay / 1000, callback)
+        timer.daemon = True
+        timer.start()
+    else:
+        callback()
+
+
+def set_timeout_async(callback, delay=0):
+    set_timeout(callback, delay)
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    print('error:', msg)
+
+
+all_windows = []   # simulated windows, the active one last
+
+
+def windows():
+    return list(all_windows)
+
+
+def active_window():
+    return all_windows[-1] if all_windows else None
+
+
+def cache_path():
+    return os.path.join(tempfile.gettempdir(), 'sublime_zk_bench_cache')
+
+
+def packages_path():
+    return os.path.dirname(PACKAGE_DIR)
+
+
+class Region:
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def intersects(self, other):
+        return (self.begin() < other.end() and other.begin() < self.end()) \
+            or self == other
+
+    def cover(self, other):
+        return Region(min(self.begin(), other.begin()),
+                      max(self.end(), other.end()))
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and \
+            (self.a, self.b) == (other.a, other.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __repr__(self):
+        return 'Region({}, {})'.format(self.a, self.b)
+
+
+class Edit:
+    """
+    The token of a text command's edit.
+    """
+
+
+class Selection:
+    def __init__(self, regions=None):
+        self.regions = list(regions or [Region(0)])
+
+    def __getitem__(self, i):
+        return self.regions[i]
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __iter__(self):
+        return iter(list(self.regions))
+
+    def clear(self):
+        self.regions = []
+
+    def add(self, region):
+        if not isinstance(region, Region):
+            region = Region(region)
+        self.regions.append(region)
+        self.regions.sort(key=lambda r: (r.begin(), r.end()))
+
+    def add_all(self, regions):
+        for region in regions:
+            self.add(region)
+
+
+class Phantom:
+    def __init__(self, region, content, layout, on_navigate=None):
+        self.region = region
+        self.content = content
+        self.layout = layout
+        self.on_navigate = on_navigate
+        self.id = None
+
+
+class PhantomSet:
+    def __init__(self, view, key=''):
+        self.view = view
+        self.key = key
+        self.phantoms = []
+
+    def update(self, new_phantoms):
+        for phantom in self.phantoms:
+            self.view.erase_phantom_by_id(phantom.id)
+        for phantom in new_phantoms:
+            phantom.id = self.view.add_phantom(self.key, phantom.region,
+                                               phantom.content,
+                                               phantom.layout,
+                                               phantom.on_navigate)
+        self.phantoms = list(new_phantoms)
+
+
+def selector_matches(selector, scope):
+    """
+    Return True if scope matches selector: any of its comma separated
+    alternatives, whose space separated parts must each be a prefix of one
+    of the names in scope.
+    """
+    names = scope.split()
+    for alternative in selector.split(','):
+        parts = alternative.split()
+        if parts and all(any(name == part or name.startswith(part + '.')
+                             for name in names) for part in parts):
+            return True
+    return False
+
+
+class MarkdownScopes:
+    """
+    Scopes of markdown text, like the sublime_zk syntax assigns them, for
+    what the plugin looks at: fenced code, ATX headings, inline code,
+    images, note links and tags.
+
+    Scopes are kept as sorted, non-overlapping spans. After an edit, the
+    text is re-tagged from the start of the edited block on, the next time
+    a scope behind it is asked for: up to the first line behind the edit
+    that is outside of code blocks before and after it, if there was just
+    one edit, else to the end.
+    """
+    Base = 'text.html.markdown '
+    Fenced = 'markup.raw.block.markdown markup.raw.block.fenced.markdown '
+    Fence_Matcher = re.compile(r'^[ \t]*(`{3,}|~{3,})', re.M)
+    Heading_Matcher = re.compile(r'^(#{1,6})(?!#)[ \t]*(?=\S).*\n?', re.M)
+    Inline_Matcher = re.compile(
+        r'(?P<code>`[^`\n]+`)'
+        r'|(?P<image>!\[[^\[\]\n]*\]\(<?(?P<url>[^\s)>]+)>?'
+        r'(?:[ \t]+(?:"[^"\n]*"|\([^)\n]*\)))?[ \t]*\))'
+        r'|(?P<link>\[?\[(?P<link_id>[0-9.]{12,18})(?P<title>[^\]\n]*)\]\]?)'
+        r'|(?P<plink>§(?P<plink_id>[0-9]{12,14}))'
+        r'|(?<=[ \t])(?P<tag>#+(?:[^#\W]|[-§]|:[a-zA-Z0-9])+)')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.names = []
+        self.valid_until = 0    # spans before this are up to date, None: all
+        self.edit = None        # (begin, old end, new end) of a single edit
+
+    def edited(self, begin, end, new_end):
+        if self.valid_until is None:
+            self.valid_until = begin
+            self.edit = (begin, end, new_end)
+        else:
+            self.valid_until = min(self.valid_until, begin)
+            self.edit = None
+
+    def update(self, text, pos=None):
+        """
+        Re-tag text as far as needed to know the scopes at pos (all of it if
+        pos is None).
+        """
+        if self.valid_until is None or \
+                (pos is not None and pos < self.valid_until):
+            return
+        # restart at the beginning of the line, or of the code block, the
+        # first invalid position is in
+        restart = text.rfind('\n', 0, self.valid_until) + 1
+        i = bisect.bisect_right(self.starts, restart) - 1
+        if i >= 0 and self.ends[i] > restart and \
+                self.names[i] == MarkdownScopes.Fenced:
+            restart = self.starts[i]
+        i = bisect.bisect_left(self.starts, restart)
+        old_starts, old_ends, old_names = \
+            self.starts[i:], self.ends[i:], self.names[i:]
+        del self.starts[i:], self.ends[i:], self.names[i:]
+        self.valid_until = None
+        if self.edit is None:
+            self.tag(text, restart, len(text))
+            return
+        begin, end, new_end = self.edit
+        delta = new_end - end
+        limit = text.find('\n', new_end)
+        stop = self.tag(text, restart,
+                        len(text) if limit < 0 else limit + 1)
+        if stop >= len(text):
+            return
+        old_stop = stop - delta
+        j = bisect.bisect_right(old_starts, old_stop) - 1
+        if j >= 0 and old_ends[j] > old_stop:
+            # was in a code block before the edit
+            self.tag(text, stop, len(text))
+            return
+        j = bisect.bisect_left(old_starts, old_stop)
+        self.starts.extend(start + delta for start in old_starts[j:])
+        self.ends.extend(end + delta for end in old_ends[j:])
+        self.names.extend(old_names[j:])
+
+    def add(self, start, end, name):
+        if start < end:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.names.append(name)
+
+    def tag(self, text, pos, limit):
+        """
+        Tag text from pos, a line start outside of code blocks, on up to the
+        first line start at or behind limit outside of code blocks. Return
+        that line start.
+        """
+        while True:
+            fence = MarkdownScopes.Fence_Matcher.search(text, pos)
+            end = fence.start() if fence else len(text)
+            if end >= limit:
+                self.tag_text(text, pos, limit)
+                return limit
+            self.tag_text(text, pos, end)
+            closing = re.compile(r'^[ \t]*' + fence.group(1)[0] + '{' +
+                                 str(len(fence.group(1))) + r',}[ \t]*$',
+                                 re.M)
+            close = closing.search(text, fence.end())
+            if close is None:
+                # open till the end, including the end of the view
+                self.add(fence.start(), len(text) + 1, MarkdownScopes.Fenced)
+                return len(text)
+            pos = text.find('\n', close.end())
+            pos = len(text) if pos < 0 else pos + 1
+            self.add(fence.start(), pos, MarkdownScopes.Fenced)
+            if pos >= limit:
+                return pos
+
+    def tag_text(self, text, pos, end):
+        """
+        Tag the text between pos and end, outside of code blocks.
+        """
+        headings = MarkdownScopes.Heading_Matcher
+        while pos < end:
+            heading = headings.search(text, pos, end)
+            stop = heading.start() if heading else end
+            self.tag_inline(text, pos, stop, '')
+            if not heading:
+                return
+            name = 'markup.heading.markdown markup.heading.{}.markdown ' \
+                .format(len(heading.group(1)))
+            self.tag_inline(text, heading.start(), heading.end(), name)
+            pos = heading.end()
+
+    def tag_inline(self, text, pos, end, outer):
+        start = pos
+        for match in MarkdownScopes.Inline_Matcher.finditer(text, pos, end):
+            kind = match.lastgroup
+            if kind == 'url':
+                kind = 'image'
+            if outer:
+                self.add(start, match.start(), outer)
+            if kind == 'code':
+                self.add(match.start(), match.end(),
+                         outer + 'markup.raw.inline.markdown ')
+            elif kind == 'image':
+                image = outer + 'meta.image.inline.markdown '
+                self.add(match.start(), match.start('url'), image)
+                self.add(match.start('url'), match.end('url'),
+                         image + 'markup.underline.link.image.markdown ')
+                self.add(match.end('url'), match.end(), image)
+            elif kind == 'link':
+                self.add(match.start(), match.start('link_id'), outer)
+                self.add(match.start('link_id'), match.end('link_id'),
+                         outer + 'markup.zettel.link ')
+                self.add(match.end('link_id'), match.end('title'),
+                         outer + 'markup.zettel.linktitle ')
+                self.add(match.end('title'), match.end(), outer)
+            elif kind == 'plink':
+                self.add(match.start(), match.start('plink_id'), outer)
+                self.add(match.start('plink_id'), match.end(),
+                         outer + 'markup.zettel.link ')
+            else:
+                self.add(match.start(), match.end(),
+                         outer + 'markup.zettel.tag markup.italic ')
+            start = match.end()
+        if outer:
+            self.add(start, end, outer)
+
+    def scope_at(self, text, pos):
+        self.update(text, pos)
+        i = bisect.bisect_right(self.starts, pos) - 1
+        if i >= 0 and pos < self.ends[i]:
+            return MarkdownScopes.Base + self.names[i]
+        return MarkdownScopes.Base
+
+    def spans(self, text):
+        """
+        Return [(start, end, scope name)] of all of text.
+        """
+        self.update(text)
+        return [(start, end, MarkdownScopes.Base + name) for start, end, name
+                in zip(self.starts, self.ends, self.names)]
+
+
+def counted(cls):
+    """
+    Make the public methods of cls count their calls and the time spent in
+    them, in self.api_calls and self.api_time. Calls made by the methods
+    themselves are not counted, nor is run_command(), which runs plugin
+    code.
+    """
+    def wrap(name, method):
+        def api_method(self, *args, **kwargs):
+            if self.api_depth:
+                return method(self, *args, **kwargs)
+            self.api_depth += 1
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.api_time += time.perf_counter() - start
+                self.api_calls[name] += 1
+                self.api_depth -= 1
+        api_method.__name__ = name
+        api_method.__doc__ = method.__doc__
+        return api_method
+
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith('_') and \
+                name not in ('reset_counts', 'type', 'edit', 'run_command'):
+            setattr(cls, name, wrap(name, method))
+    return cls
+
+
+@counted
+class View:
+    """
+    A buffer in memory with the parts of the View API the plugin uses.
+
+    Edits move the regions, phantoms and selections behind them like in
+    Sublime. visible_region() is `viewport_lines` lines from
+    `viewport_top` on. type() and edit() simulate the user: they change the
+    text and send on_modified to the event listeners of sublime_plugin.
+    """
+    next_id = 1
+    viewport_lines = 60
+
+    def __init__(self, text='', file_name=None, window=None):
+        self.view_id = View.next_id
+        View.next_id += 1
+        self.text = text
+        self.path = file_name
+        self.parent = window
+        self.view_name = ''
+        self.scratch = False
+        self.valid = True
+        self.count = 0
+        self.selection = Selection()
+        self.scopes = MarkdownScopes()
+        self.regions = {}       # key -> [Region]
+        self.pending_edits = []     # (begin, end, length), see _replace()
+        self.phantoms = {}      # phantom id -> (key, region, Phantom args)
+        self.next_phantom_id = 1
+        self.view_settings = Settings({
+            'syntax': 'Packages/sublime_zk/sublime_zk.sublime-syntax'})
+        self.viewport_top = 0
+        self.commands = []      # commands run that are not TextCommands
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.api_calls = Counter()
+        self.api_time = 0
+        self.api_depth = 0
+
+    # the simulated user
+
+    def edit(self, region, text):
+        """
+        Replace region by text, as the user would, and notify the event
+        listeners.
+        """
+        import sublime_plugin
+        self.selection = Selection([Region(region.begin())])
+        self._replace(region, text)
+        self.selection = Selection([Region(region.begin() + len(text))])
+        sublime_plugin.emit('on_modified', self)
+
+    def type(self, text, pos=None):
+        """
+        Type text at pos, or at the cursor, one character at a time.
+        """
+        if pos is None:
+            pos = self.selection[0].b
+        for i, char in enumerate(text):
+            self.edit(Region(pos + i), char)
+
+    def _replace(self, region, text):
+        begin, end = region.begin(), region.end()
+        self.text = self.text[:begin] + text + self.text[end:]
+        self.count += 1
+        self.scopes.edited(begin, end, begin + len(text))
+        delta = len(text) - (end - begin)
+
+        def move(x):
+            if x < begin:
+                return x
+            if x >= end:
+                return x + delta
+            return begin + len(text)
+
+        self.selection = Selection([Region(move(r.a), move(r.b))
+                                    for r in self.selection.regions])
+        # regions and phantoms are moved when they are asked for, all edits
+        # made back to front since at once
+        if self.pending_edits:
+            last_begin = self.pending_edits[-1][0]
+            if end > last_begin or begin == last_begin:
+                self._move_regions()
+        self.pending_edits.append((begin, end, len(text)))
+
+    def _move_regions(self):
+        """
+        Move the regions and phantoms behind the edits made since the last
+        call. These were made back to front, so their positions are those
+        before any of them.
+        """
+        if not self.pending_edits:
+            return
+        edits = sorted(self.pending_edits)
+        self.pending_edits = []
+        begins = [begin for begin, end, length in edits]
+        shifts = []     # shift behind the edits before each edit
+        shift = 0
+        for begin, end, length in edits:
+            shifts.append(shift)
+            shift += length - (end - begin)
+
+        def move(x):
+            i = bisect.bisect_right(begins, x) - 1
+            if i < 0:
+                return x
+            begin, end, length = edits[i]
+            if x == begin:
+                return x + shifts[i]
+            if x >= end:
+                return x + shifts[i] + length - (end - begin)
+            return begin + shifts[i]
+
+        first = begins[0]
+        for key, regions in self.regions.items():
+            self.regions[key] = [
+                r if r.a < first and r.b < first else
+                Region(move(r.a), move(r.b)) for r in regions]
+        for phantom_id, (key, r, args) in list(self.phantoms.items()):
+            self.phantoms[phantom_id] = (key, Region(move(r.a), move(r.b)),
+                                         args)
+
+    # View API
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.view_id
+
+    def is_valid(self):
+        return self.valid
+
+    def is_loading(self):
+        return False
+
+    def is_dirty(self):
+        return self.count > 0
+
+    def is_read_only(self):
+        return False
+
+    def is_scratch(self):
+        return self.scratch
+
+    def set_scratch(self, scratch):
+        self.scratch = scratch
+
+    def file_name(self):
+        return self.path
+
+    def name(self):
+        return self.view_name
+
+    def set_name(self, name):
+        self.view_name = name
+
+    def window(self):
+        return self.parent
+
+    def settings(self):
+        return self.view_settings
+
+    def set_syntax_file(self, syntax_file):
+        self.view_settings.set('syntax', syntax_file)
+
+    def encoding(self):
+        return 'UTF-8'
+
+    def line_endings(self):
+        return 'Unix'
+
+    def size(self):
+        return len(self.text)
+
+    def change_count(self):
+        return self.count
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self.text[x.begin():x.end()]
+        return self.text[x:x + 1]
+
+    def sel(self):
+        return self.selection
+
+    def line(self, x):
+        if not isinstance(x, Region):
+            x = Region(x)
+        begin = self.text.rfind('\n', 0, x.begin()) + 1
+        end = self.text.find('\n', x.end())
+        return Region(begin, len(self.text) if end < 0 else end)
+
+    def full_line(self, x):
+        region = self.line(x)
+        return Region(region.a, min(region.b + 1, len(self.text)))
+
+    def lines(self, region):
+        result = []
+        pos = self.line(region.begin()).begin()
+        while True:
+            line = self.line(pos)
+            result.append(line)
+            if line.b >= region.end() or line.b >= len(self.text):
+                return result
+            pos = line.b + 1
+
+    def split_by_newlines(self, region):
+        return [Region(max(r.a, region.begin()), min(r.b, region.end()))
+                for r in self.lines(region)]
+
+    def word(self, x):
+        pos = x.begin() if isinstance(x, Region) else x
+        begin = end = pos
+        while begin > 0 and re.match(r'\w', self.text[begin - 1]):
+            begin -= 1
+        while end < len(self.text) and re.match(r'\w', self.text[end]):
+            end += 1
+        return Region(begin, end)
+
+    def rowcol(self, point):
+        row = self.text.count('\n', 0, point)
+        return row, point - (self.text.rfind('\n', 0, point) + 1)
+
+    def text_point(self, row, col):
+        pos = 0
+        for i in range(row):
+            pos = self.text.find('\n', pos)
+            if pos < 0:
+                return len(self.text)
+            pos += 1
+        return min(pos + col, len(self.text))
+
+    def _pattern(self, pattern, flags):
+        if flags & LITERAL:
+            pattern = re.escape(pattern)
+        return re.compile(pattern, re.M | (re.I if flags & IGNORECASE else 0))
+
+    def find(self, pattern, start_point, flags=0):
+        match = self._pattern(pattern, flags).search(self.text, start_point)
+        if match:
+            return Region(match.start(), match.end())
+        return Region(-1, -1)
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        regions = []
+        for match in self._pattern(pattern, flags).finditer(self.text):
+            regions.append(Region(match.start(), match.end()))
+            if extractions is not None:
+                extractions.append(match.expand(fmt))
+        return regions
+
+    def scope_name(self, point):
+        return self.scopes.scope_at(self.text, point)
+
+    def match_selector(self, point, selector):
+        return selector_matches(selector,
+                                self.scopes.scope_at(self.text, point))
+
+    def score_selector(self, point, selector):
+        return 1 if self.match_selector(point, selector) else 0
+
+    def find_by_selector(self, selector):
+        regions = []
+        for start, end, name in self.scopes.spans(self.text):
+            end = min(end, len(self.text))
+            if not selector_matches(selector, name):
+                continue
+            if regions and regions[-1].b == start:
+                regions[-1] = Region(regions[-1].a, end)
+            else:
+                regions.append(Region(start, end))
+        return regions
+
+    def insert(self, edit, point, text):
+        self._replace(Region(point), text)
+        return len(text)
+
+    def erase(self, edit, region):
+        self._replace(region, '')
+
+    def replace(self, edit, region, text):
+        self._replace(region, text)
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self._move_regions()
+        self.regions[key] = [Region(r.a, r.b) for r in regions]
+
+    def get_regions(self, key):
+        self._move_regions()
+        return [Region(r.a, r.b) for r in self.regions.get(key, ())]
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def add_phantom(self, key, region, content, layout, on_navigate=None):
+        self._move_regions()
+        phantom_id = self.next_phantom_id
+        self.next_phantom_id += 1
+        self.phantoms[phantom_id] = (key, Region(region.a, region.b),
+                                     (content, layout, on_navigate))
+        return phantom_id
+
+    def erase_phantoms(self, key):
+        for phantom_id, (k, region, args) in list(self.phantoms.items()):
+            if k == key:
+                del self.phantoms[phantom_id]
+
+    def erase_phantom_by_id(self, phantom_id):
+        self.phantoms.pop(phantom_id, None)
+
+    def query_phantoms(self, phantom_ids):
+        self._move_regions()
+        return [self.phantoms[i][1] if i in self.phantoms else Region(-1)
+                for i in phantom_ids]
+
+    def visible_region(self):
+        begin = self.text_point(self.viewport_top, 0)
+        end = self.text_point(self.viewport_top + View.viewport_lines, 0)
+        return Region(begin, end)
+
+    def show(self, x, show_surroundings=True):
+        pos = x.begin() if isinstance(x, Region) else x
+        row = self.rowcol(pos)[0]
+        if not self.viewport_top <= row < self.viewport_top + \
+                View.viewport_lines:
+            self.viewport_top = max(0, row - View.viewport_lines // 2)
+
+    def show_at_center(self, x):
+        pos = x.begin() if isinstance(x, Region) else x
+        self.viewport_top = max(0, self.rowcol(pos)[0] -
+                                View.viewport_lines // 2)
+
+    def window_to_text(self, vector):
+        """
+        Characters are 10 px wide, lines 20 px high.
+        """
+        x, y = vector
+        row = self.viewport_top + int(y // 20)
+        line = self.line(self.text_point(row, 0))
+        return min(line.a + int(x // 10), line.b)
+
+    def set_status(self, key, value):
+        pass
+
+    def erase_status(self, key):
+        pass
+
+    def run_command(self, cmd, args=None):
+        import sublime_plugin
+        command = sublime_plugin.find_command(sublime_plugin.TextCommand, cmd)
+        if command is not None:
+            command(self).run(Edit(), **(args or {}))
+        elif cmd == 'insert':
+            for region in reversed(list(self.selection)):
+                self._replace(region, args['characters'])
+        else:
+            self.commands.append((cmd, args))
+
+
+class Window:
+    """
+    A window with the views of a note archive. Creating one makes it the
+    active window.
+    """
+    next_id = 1
+
+    def __init__(self, folders=(), project_file_name=None):
+        self.window_id = Window.next_id
+        Window.next_id += 1
+        self.window_folders = list(folders)
+        self.project = project_file_name
+        self.window_views = []
+        self.active = None
+        self.groups = 1
+        self.group = 0
+        self.commands = []      # commands run that are not WindowCommands
+        self.panels = []        # (kind, items or caption) shown
+        all_windows.append(self)
+
+    def id(self):
+        return self.window_id
+
+    def folders(self):
+        return list(self.window_folders)
+
+    def project_file_name(self):
+        return self.project
+
+    def project_data(self):
+        return {'folders': [{'path': f} for f in self.window_folders]}
+
+    def views(self):
+        return list(self.window_views)
+
+    def active_view(self):
+        return self.active
+
+    def active_view_in_group(self, group):
+        return self.active
+
+    def active_group(self):
+        return self.group
+
+    def focus_group(self, group):
+        self.group = group
+
+    def focus_view(self, view):
+        self.active = view
+
+    def num_groups(self):
+        return self.groups
+
+    def get_layout(self):
+        return {'cols': [0.0, 1.0], 'rows': [0.0, 1.0],
+                'cells': [[0, 0, 1, 1]]}
+
+    def set_view_index(self, view, group, index):
+        pass
+
+    def get_view_index(self, view):
+        return 0, self.window_views.index(view)
+
+    def new_file(self):
+        view = View(window=self)
+        self.window_views.append(view)
+        self.active = view
+        return view
+
+    def open_file(self, file_name, flags=0, group=-1):
+        import sublime_plugin
+        for view in self.window_views:
+            if view.file_name() == file_name:
+                self.active = view
+                return view
+        text = ''
+        if os.path.exists(file_name):
+            with open(file_name, encoding='utf-8') as f:
+                text = f.read()
+        view = View(text, file_name, self)
+        self.window_views.append(view)
+        self.active = view
+        sublime_plugin.emit('on_load', view)
+        return view
+
+    def find_open_file(self, file_name):
+        for view in self.window_views:
+            if view.file_name() == file_name:
+                return view
+
+    def status_message(self, msg):
+        pass
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1,
+                         on_highlight=None):
+        self.panels.append(('quick_panel', items))
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change,
+                         on_cancel):
+        self.panels.append(('input_panel', caption))
+
+    def set_sidebar_visible(self, flag):
+        pass
+
+    def extract_variables(self):
+        return {'folder': self.window_folders[0] if self.window_folders
+                else ''}
+
+    def run_command(self, cmd, args=None):
+        import sublime_plugin
+        command = sublime_plugin.find_command(sublime_plugin.WindowCommand,
+                                              cmd)
+        if command is not None:
+            command(self).run(**(args or {}))
+        else:
+            self.commands.append((cmd, args))
+
+    def close(self):
+        for view in self.window_views:
+            view.valid = False
+        if self in all_windows:
+            all_windows.remove(self)
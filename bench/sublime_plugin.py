@@ -0,0 +1,71 @@
+"""
+Minimal stand-in for Sublime Text's `sublime_plugin` module.
+
+Commands are looked up by name among the subclasses of TextCommand and
+WindowCommand, like Sublime does: ZkTocCommand is `zk_toc`. Events are sent
+to the listeners in event_listeners with emit().
+"""
+import re
+
+import sublime
+
+
+class TextCommand:
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand:
+    pass
+
+
+class EventListener:
+    pass
+
+
+class ViewEventListener:
+    def __init__(self, view):
+        self.view = view
+
+
+event_listeners = []    # EventListener instances events are sent to
+
+
+def command_name(cls):
+    name = cls.__name__
+    if name.endswith('Command'):
+        name = name[:-len('Command')]
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+
+def find_command(base, name):
+    """
+    Return the subclass of base for the command name, or None.
+    """
+    classes = list(base.__subclasses__())
+    while classes:
+        cls = classes.pop()
+        if command_name(cls) == name:
+            return cls
+        classes.extend(cls.__subclasses__())
+
+
+def emit(event, view, *args):
+    """
+    Send event to all listeners, then its _async variant by way of
+    sublime.set_timeout_async.
+    """
+    for listener in list(event_listeners):
+        handler = getattr(listener, event, None)
+        if handler is not None:
+            handler(view, *args)
+    for listener in list(event_listeners):
+        handler = getattr(listener, event + '_async', None)
+        if handler is not None:
+            sublime.set_timeout_async(
+                lambda handler=handler: handler(view, *args), 0)
@@ -13,8 +13,9 @@ import os
 import re
 import subprocess
 import glob
+import shutil
 import datetime
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict, namedtuple
 import threading
 import io
 from subprocess import Popen, PIPE
@@ -25,6 +26,23 @@ from collections import Counter
 from operator import itemgetter
 import base64
 import urllib.request
+import urllib.error
+import json
+import bisect
+import time
+import stat
+import concurrent.futures
+import pickle
+import hashlib
+import difflib
+import functools
+import array
+import math
+import heapq
+import itertools
+import operator
+import logging
+import sys
 
 
 class ZkConstants:
@@ -46,12 +64,14 @@ class ZkConstants:
     def RE_TAGS():
         prefix = re.escape(ZkConstants.TAG_PREFIX)
         return r"(?<=\s|^)(?<!`)(" + prefix + r"+([^" + prefix + r"\s.,\/!$%\^&\*;{}\[\]'\"=`~()<>”\\]|:[a-zA-Z0-9])+)"
-    # Same RE just for ST python's re module
-    # un-require line-start, sublimetext python's RE doesn't like it
 
-    def RE_TAGS_PY():
-        prefix = re.escape(ZkConstants.TAG_PREFIX)
-        return r"(?<=\s)(?<!`)(" + prefix + r"+([^" + prefix + r"\s.,\/!$%\^&\*;{}\[\]'\"=`~()<>”\\]|:[a-zA-Z0-9])+)"
+    # Same RE for python's re module, but matching tags at line-start, too,
+    # just like RE_TAGS does for ag.
+    # The prefix comes first and the look-behinds after it, so re can skip
+    # ahead to the next prefix quickly.
+    def RE_TAGS_PY_LINE(tag_prefix=None):
+        prefix = re.escape(tag_prefix or ZkConstants.TAG_PREFIX)
+        return r"(" + prefix + r"(?<![^\s]" + prefix + r")(?<!`" + prefix + r")" + prefix + r"*([^" + prefix + r"\s.,\/!$%\^&\*;{}\[\]'\"=`~()<>”\\]|:[a-zA-Z0-9])+)"
 
     # match note links in text
     Link_Matcher = re.compile('(\[+|§)([0-9.]{12,18})(\]+|.?)')
@@ -67,6 +87,112 @@ class ZkConstants:
     TOC_END = '<!-- (end of auto-toc) -->'
 
 
+Token = namedtuple('Token', ['kind', 'start', 'end', 'value'])
+
+
+class Tokenizer:
+    """
+    Splits note text into typed tokens in one linear pass of a single compiled
+    pattern:
+
+    * tag:          #tag                value: the tag
+    * link:         [[201711122259]]    value: the note id
+    * citekey:      @citekey            value: the citekey without `@`
+    * mmd_citekey:  [#citekey]          value: the citekey without `[#` `]`
+
+    Tags are matched like RE_TAGS does for ag, so all search paths find the
+    same tags. Works on view text and on raw file contents (bytes).
+    """
+    Kinds = ('tag', 'link', 'citekey', 'mmd_citekey')
+    matchers = {}   # (tag prefix, kinds) -> compiled pattern
+
+    @staticmethod
+    def pattern(tag_prefix, kinds=Kinds):
+        branches = {
+            'tag': ZkConstants.RE_TAGS_PY_LINE(tag_prefix),
+            'link': r"(?:\[+|§)(?P<link_id>[0-9.]{12,18})",
+            # pandoc: internal punctuation is allowed inside of citekeys
+            'citekey': r"@(?<![^\s\[;(-]@)@*"
+                       r"(?P<citekey_value>\w(?:\w|[:.#$%&\-+?<>~/](?=\w))*)",
+            'mmd_citekey': r"\[#(?P<mmd_citekey_value>\w[^\]\s]*)\]",
+        }
+        first_chars = {
+            'tag': tag_prefix[0], 'link': '[§', 'citekey': '@',
+            'mmd_citekey': '[',
+        }
+        # let re skip quickly to characters a token can start with
+        starts = re.escape(''.join(sorted(set(
+            ''.join(first_chars[kind] for kind in kinds)))))
+        return '(?=[' + starts + '])(?:' + '|'.join(
+            '(?P<{}>{})'.format(kind, branches[kind]) for kind in kinds) + ')'
+
+    @staticmethod
+    def matcher(tag_prefix=None, kinds=Kinds):
+        if tag_prefix is None:
+            tag_prefix = ZkConstants.TAG_PREFIX
+        matcher = Tokenizer.matchers.get((tag_prefix, kinds))
+        if matcher is None:
+            matcher = re.compile(Tokenizer.pattern(tag_prefix, kinds))
+            Tokenizer.matchers[(tag_prefix, kinds)] = matcher
+        return matcher
+
+    @staticmethod
+    def decode(data):
+        """
+        Decode raw (utf-8) file contents, with universal newlines as when
+        reading in text mode.
+        """
+        text = data.decode('utf-8')
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    @staticmethod
+    def tokenize(text, tag_prefix=None):
+        """
+        Return the list of Tokens in text (str or bytes).
+        """
+        if isinstance(text, bytes):
+            text = Tokenizer.decode(text)
+        tokens = []
+        append = tokens.append
+        for match in Tokenizer.matcher(tag_prefix).finditer(text):
+            kind = match.lastgroup
+            start, end = match.span()
+            if kind == 'tag':
+                value = match.group('tag')
+            elif kind == 'link':
+                value = match.group('link_id')
+            else:
+                value = match.group(kind + '_value')
+            append(Token(kind, start, end, value))
+        return tokens
+
+    @staticmethod
+    def values(text, tag_prefix=None):
+        """
+        Return {kind: set of token values} of text (str or bytes), without
+        offsets. Same scan as tokenize() but cheaper when only the values
+        are needed, e.g. for indexing whole archives. Citekeys include the
+        mmd ones.
+        """
+        if isinstance(text, bytes):
+            text = Tokenizer.decode(text)
+        matcher = Tokenizer.matcher(tag_prefix)
+        rows = matcher.findall(text)
+        result = {'tag': set(), 'link': set(), 'citekey': set()}
+        if not rows:
+            return result
+        # transpose the match tuples into one column per group
+        columns = list(zip(*rows))
+        for kind, groups in (('tag', ['tag']), ('link', ['link_id']),
+                             ('citekey', ['citekey_value',
+                                          'mmd_citekey_value'])):
+            found = result[kind]
+            for group in groups:
+                found.update(columns[matcher.groupindex[group] - 1])
+            found.discard('')
+        return result
+
+
 class ZKMode:
     ZKM_Results_Syntax_File = 'Packages/sublime_zk/zk-mode/sublime_zk_results.sublime-syntax'
     ZKM_SavedSearches_Syntax_File = 'Packages/sublime_zk/zk-mode/sublime_zk_search.sublime-syntax'
@@ -188,483 +314,2939 @@ def settings_changed():
     value = settings.get("tag_prefix", None)
     if value is not None:
         ZkConstants.TAG_PREFIX = value
+    Log.set_level(settings.get('log_level', 'warning'))
+    if settings.get('search_backend', 'auto') != ExternalSearch.backend_choice:
+        ExternalSearch.select_backend()
 
 
 def plugin_loaded():
-    global F_EXT_SEARCH
-    F_EXT_SEARCH = os.system(ExternalSearch.SEARCH_COMMAND + ' --help') == 0
-
-    if F_EXT_SEARCH:
-        print('Sublime_ZK: Using ag!')
-    else:
-        settings = get_settings()
-        ag = settings.get('path_to_ag', '/usr/local/bin/ag')
-        if ag:
-            if os.system(ag + ' --help') == 0:
-                ExternalSearch.SEARCH_COMMAND = ag
-                F_EXT_SEARCH = True
-                print('Sublime_ZK: Using ', ag)
-            else:
-                print('Sublime_ZK: Not using ag!')
-        else:
-            print('Sublime_ZK: Not using ag!')
     settings = get_settings()
+    Log.set_level(settings.get('log_level', 'warning'))
+    ExternalSearch.select_backend()
     settings.clear_on_change("sublime_zk_notify")
     settings.add_on_change("sublime_zk_notify", settings_changed)
     settings_changed()
+    sublime.set_timeout_async(NoteIndex.load_all, 0)
 
 
-class TagSearch:
+class Log:
     """
-    Advanced tag search.
+    Diagnostics for the console, shown from the level of the log_level
+    setting up: debug, info, warning or error.
 
-    Grammar:
-    ```
-        search-spec: search-term [, search-term]*
-        search-term: tag-spec [ tag-spec]*
-        tag-spec: [!]#tag-name[*]
-        tag-name: {any valid tag string}
-    ```
+    Messages are str.format() templates with their arguments, formatted only
+    when they are shown. Disabled debug output costs one level check.
     """
+    logger = logging.getLogger('sublime_zk')
+    Levels = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warning': logging.WARNING,
+        'error': logging.ERROR,
+    }
+
+    class Message:
+        def __init__(self, template, args):
+            self.template = template
+            self.args = args
+
+        def __str__(self):
+            return self.template.format(*self.args)
 
     @staticmethod
-    def advanced_tag_search(search_spec, folder, extension):
-        """
-        Return ids of all notes matching the search_spec.
-        """
-        if search_spec.startswith('[!'):
-            sublime.active_window().run_command('zk_show_all_notes')
-            return
-        elif search_spec.startswith('#!'):
-            sublime.active_window().run_command('zk_show_all_tags')
-            return
-        note_tag_map = find_all_notes_all_tags_in(folder, extension)
-        print('Note Tag Map for ', folder, extension)
-        for k, v in note_tag_map.items():
-            print('{} : {}'.format(k, v))
-        for sterm in [s.strip() for s in search_spec.split(',')]:
-            # iterate through all notes and apply the search-term
-            sterm_results = {}
-            for note_id, tags in note_tag_map.items():
-                if not note_id:
-                    continue
-                # apply each tag-spec match to all tags
-                for tspec in sterm.split():
-                    if tspec[0] == '!':
-                        if tspec[-1] == '*':
-                            match = TagSearch.match_not_startswith(tspec, tags)
-                        else:
-                            match = TagSearch.match_not(tspec, tags)
-                    else:
-                        if tspec[-1] == '*':
-                            match = TagSearch.match_startswith(tspec, tags)
-                        else:
-                            match = TagSearch.match_tag(tspec, tags)
-                    if match:
-                        sterm_results[note_id] = tags   # remember this note
-            # use the results for the next search-term
-            note_tag_map = sterm_results
-        result = list(sterm_results.keys())
-        result.sort()
-        return result
+    def set_level(name):
+        level = Log.Levels.get(str(name).lower(), logging.WARNING)
+        Log.logger.setLevel(level)
+        # the logger outlives reloads of the plugin: add the handler once
+        if not Log.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter(
+                '%(name)s %(levelname)s: %(message)s'))
+            Log.logger.addHandler(handler)
+            Log.logger.propagate = False
 
     @staticmethod
-    def match_not(tspec, tags):
-        return tspec[1:] not in tags
+    def debug(template, *args):
+        if Log.logger.isEnabledFor(logging.DEBUG):
+            Log.logger.debug(Log.Message(template, args))
 
     @staticmethod
-    def match_tag(tspec, tags):
-        return tspec in tags
+    def info(template, *args):
+        if Log.logger.isEnabledFor(logging.INFO):
+            Log.logger.info(Log.Message(template, args))
 
     @staticmethod
-    def match_not_startswith(tspec, tags):
-        tspec = tspec[1:-1]
-        return len([t for t in tags if t.startswith(tspec)]) == 0
+    def warning(template, *args):
+        if Log.logger.isEnabledFor(logging.WARNING):
+            Log.logger.warning(Log.Message(template, args))
 
     @staticmethod
-    def match_startswith(tspec, tags):
-        tspec = tspec[:-1]
-        return [t for t in tags if t.startswith(tspec)]
+    def error(template, *args):
+        if Log.logger.isEnabledFor(logging.ERROR):
+            Log.logger.error(Log.Message(template, args))
 
 
-class ImageHandler:
+class Stats:
     """
-    Static class to bundle image handling.
+    Timings and counters of what the plugin spends its time on: commands,
+    searches, index walks, pandoc runs, highlighting passes.
+
+    Timings go into a ring buffer of the last Capacity samples, so memory
+    stays bounded however long a session runs. See
+    ZkShowPerformanceStatsCommand for the report.
     """
+    Capacity = 5000
 
-    Phantoms = defaultdict(set)
+    samples = deque(maxlen=Capacity)    # (operation, duration in s)
+    counters = Counter()
+    lock = threading.Lock()
 
     @staticmethod
-    def show_images(view, edit, max_width=1024):
+    def record(operation, duration):
+        with Stats.lock:
+            Stats.samples.append((operation, duration))
+
+    @staticmethod
+    def count(counter, n=1):
+        with Stats.lock:
+            Stats.counters[counter] += n
+
+    @staticmethod
+    def timed(operation):
         """
-        markup.underline.link.image.markdown
+        Decorator recording the duration of each call as operation.
         """
-        global DISTRACTION_FREE_MODE_ACTIVE
-        global VIEWS_WITH_IMAGES
-        folder = get_path_for(view)
-        if not folder:
-            return
-        skip = 0
+        def decorate(func):
+            @functools.wraps(func)
+            def timed_func(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    Stats.record(operation, time.perf_counter() - start)
+            return timed_func
+        return decorate
 
-        while True:
-            img_regs = view.find_by_selector(
-                'markup.underline.link.image.markdown')[skip:]
-            skip += 1
-            if not img_regs:
-                break
-            region = img_regs[0]
-            rel_p = view.substr(region)
+    @staticmethod
+    def instrument_commands(namespace):
+        """
+        Time run() and the on_done*() callbacks of all commands in
+        namespace.
+        """
+        for cls in list(namespace.values()):
+            if not isinstance(cls, type) or not issubclass(
+                    cls, (sublime_plugin.TextCommand,
+                          sublime_plugin.WindowCommand)):
+                continue
+            name = re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1',
+                          cls.__name__[:-len('Command')]).lower()
+            for attr, func in list(vars(cls).items()):
+                if attr == 'run':
+                    operation = 'command ' + name
+                elif attr.startswith('on_done'):
+                    operation = 'command {}.{}'.format(name, attr)
+                else:
+                    continue
+                setattr(cls, attr, Stats.timed(operation)(func))
 
-            if rel_p.startswith('http'):
+    @staticmethod
+    def report():
+        """
+        Return {operation: {calls, p50, p95, max, total}} with durations
+        in ms, slowest total first, and the counters.
+        """
+        with Stats.lock:
+            samples = list(Stats.samples)
+            counters = dict(Stats.counters)
+        durations = defaultdict(list)
+        for operation, duration in samples:
+            durations[operation].append(duration * 1000)
+        operations = OrderedDict()
+        for operation, values in sorted(durations.items(),
+                                        key=lambda item: -sum(item[1])):
+            values.sort()
+            n = len(values)
+            operations[operation] = OrderedDict([
+                ('calls', n),
+                ('p50', values[n // 2]),
+                ('p95', values[min(n - 1, int(n * 0.95))]),
+                ('max', values[-1]),
+                ('total', sum(values)),
+            ])
+        return operations, OrderedDict(sorted(counters.items()))
 
-                img = rel_p
-                local_filename, headers = urllib.request.urlretrieve(rel_p)
-                size = ImageHandler.get_image_size(local_filename)
-                if size:
-                    w, h, ttype = size
+    @staticmethod
+    def report_text():
+        operations, counters = Stats.report()
+        lines = ['# Performance Stats', '',
+                 'Last {} timings, in ms:'.format(
+                     sum(o['calls'] for o in operations.values())), '',
+                 '{:<48} {:>6} {:>9} {:>9} {:>9} {:>10}'.format(
+                     'operation', 'calls', 'p50', 'p95', 'max', 'total')]
+        for operation, o in operations.items():
+            lines.append('{:<48} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f}'
+                         .format(operation, o['calls'], o['p50'], o['p95'],
+                                 o['max'], o['total']))
+        lines.extend(['', 'Counters:', ''])
+        for counter, n in counters.items():
+            lines.append('{:<48} {:>6}'.format(counter, n))
+        lines.extend(['', 'Highlighting scheduler:', ''])
+        for key, value in NoteLinkHighlighter.scheduler.report().items():
+            lines.append('{:<48} {:>6}'.format(
+                key, round(value, 1) if isinstance(value, float) else value))
+        return '\n'.join(lines) + '\n'
 
-                    FMT = u'''
-                        <img src="data:image/{}" class="centerImage" {}>
-                    '''
-                img = ttype + ";base64," + get_as_base64(img)
-            else:
-                FMT = '''
-                    <img src="file://{}" class="centerImage" {}>
-                '''
-                img = os.path.join(folder, rel_p)
-                size = ImageHandler.get_image_size(img)
-            if not size:
-                continue
-            w, h, t = size
-            line_region = view.line(region)
-            imgattr = ImageHandler.check_imgattr(view, line_region, region)
-            if not imgattr:
-                if w > max_width:
-                    m = max_width / w
-                    h *= m
-                    w = max_width
-                imgattr = 'width="{}" height="{}"'.format(w, h)
+    @staticmethod
+    def save_json(filn):
+        operations, counters = Stats.report()
+        with open(filn, mode='w', encoding='utf-8') as f:
+            json.dump(OrderedDict([
+                ('operations', operations),
+                ('counters', counters),
+                ('highlighting', NoteLinkHighlighter.scheduler.report()),
+            ]), f, indent=2)
 
-            settings = sublime.load_settings(
-                'Distraction Free.sublime-settings')
-            spaces = settings.get('wrap_width', 80)
-            centered = settings.get('draw_centered', True)
-            view.erase_phantoms(str(region))
-            html_img = FMT.format(img, imgattr)
-            if centered and DISTRACTION_FREE_MODE_ACTIVE[view.window().id()]:
-                line_str = view.substr(line_region)
-                line_len = len(line_str)
-                spaces -= line_len + 1
-                view.insert(edit, region.b, ' ' * spaces)
-                view.add_phantom(
-                    str(region),
-                    sublime.Region(line_region.b + spaces,
-                                   line_region.b + spaces),
-                    html_img,
-                    sublime.LAYOUT_BELOW)
+
+class ScanDelta:
+    """
+    Notes added, changed, renamed and removed by a scan of the archive.
+
+    Deltas of successive scans can be merged; a note that was added and then
+    removed again simply disappears from the merged delta. Notes whose meta
+    has been parsed since are 'parsed'; only consumers of meta care.
+    """
+
+    def __init__(self):
+        # path -> 'added'|'changed'|'parsed'|'removed'
+        self.state = OrderedDict()
+        self.renames = OrderedDict()    # new path -> old path
+
+    @property
+    def added(self):
+        return [p for p, s in self.state.items() if s == 'added']
+
+    @property
+    def changed(self):
+        return [p for p, s in self.state.items() if s == 'changed']
+
+    @property
+    def parsed(self):
+        return [p for p, s in self.state.items() if s == 'parsed']
+
+    @property
+    def removed(self):
+        return [p for p, s in self.state.items() if s == 'removed']
+
+    @property
+    def renamed(self):
+        """ List of (old_path, new_path) tuples. """
+        return [(old, new) for new, old in self.renames.items()]
+
+    def __len__(self):
+        return len(self.state) + len(self.renames)
+
+    def __repr__(self):
+        return 'ScanDelta(added={}, changed={}, removed={}, renamed={})'.format(
+            len(self.added), len(self.changed), len(self.removed),
+            len(self.renames))
+
+    def add(self, path):
+        if self.state.get(path) == 'removed':
+            self.state[path] = 'changed'   # replaced by a new file
+        elif path not in self.state:
+            self.state[path] = 'added'
+
+    def change(self, path):
+        if self.state.get(path) != 'added':
+            self.state[path] = 'changed'
+
+    def parse(self, path):
+        if path not in self.state:
+            self.state[path] = 'parsed'
+
+    def remove(self, path):
+        old_path = self.renames.pop(path, None)
+        if old_path is not None:
+            # renamed before: it's the original file that is gone now
+            self.state.pop(path, None)
+            if self.state.get(old_path) == 'added':
+                self.state[old_path] = 'changed'
             else:
-                view.add_phantom(str(region), region,
-                                 html_img,
-                                 sublime.LAYOUT_BLOCK)
-            ImageHandler.Phantoms[view.id()].add(str(region))
-        VIEWS_WITH_IMAGES.add(view.id())
+                self.state[old_path] = 'removed'
+        elif self.state.get(path) == 'added':
+            del self.state[path]
+        else:
+            self.state[path] = 'removed'
 
-    @staticmethod
-    def check_imgattr(view, line_region, link_region=None):
-        # find attrs for this link
-        full_line = view.substr(line_region)
-        link_till_eol = full_line[link_region.a - line_region.a:]
-        # find attr if present
-        m = re.match(r'.*\)\{(.*)\}', link_till_eol)
-        if m:
-            return m.groups()[0]
+    def rename(self, old_path, new_path):
+        if self.state.get(new_path) == 'removed':
+            self.remove(old_path)
+            self.state[new_path] = 'changed'
+            return
+        old_state = self.state.pop(old_path, None)
+        if old_state == 'added':
+            self.state[new_path] = 'added'
+            return
+        if old_state == 'changed':
+            self.state[new_path] = 'changed'
+        self.renames[new_path] = self.renames.pop(old_path, old_path)
 
-    @staticmethod
-    def hide_images(view, edit):
-        """
-        Hide all imgs; use buffered identifiers
-        """
-        print("here")
-        for rel_p in ImageHandler.Phantoms[view.id()]:
-            print(rel_p)
-            view.erase_phantoms(rel_p)
-        del ImageHandler.Phantoms[view.id()]
-        skip = 0
-        while True:
-            img_regs = view.find_by_selector(
-                'markup.underline.link.image.markdown')[skip:]
-            skip += 1
-            if not img_regs:
-                break
-            region = img_regs[0]
-            rel_p = view.substr(region)
-            line_region = view.line(region)
-            line_str = view.substr(line_region)
-            view.replace(edit, line_region, line_str.strip())
-        VIEWS_WITH_IMAGES.discard(view.id())
+    def forget(self, path):
+        self.state.pop(path, None)
 
-    @staticmethod
-    def get_image_size(img):
+    def merge(self, other):
         """
-        Determine the image type of img and return its size.
+        Apply the later delta other on top of this one.
         """
-        with open(img, 'rb') as f:
-            head = f.read(24)
-            ttype = None
-
-            # print('head:\n', repr(head))
-            if len(head) != 24:
-                return
-            if imghdr.what(img) == 'png':
-                ttype = "png"
-                check = struct.unpack('>i', head[4:8])[0]
-                if check != 0x0d0a1a0a:
-                    return
-                width, height = struct.unpack('>ii', head[16:24])
-            elif imghdr.what(img) == 'gif':
-                ttype = "gif"
-                width, height = struct.unpack('<HH', head[6:10])
-            elif imghdr.what(img) == 'jpeg':
-                ttype = "jpeg"
-                try:
-                    f.seek(0)  # Read 0xff next
-                    size = 2
-                    ftype = 0
-                    while not 0xc0 <= ftype <= 0xcf:
-                        f.seek(size, 1)
-                        byte = f.read(1)
-                        while ord(byte) == 0xff:
-                            byte = f.read(1)
-                        ftype = ord(byte)
-                        size = struct.unpack('>H', f.read(2))[0] - 2
-                    # SOFn block
-                    f.seek(1, 1)  # skip precision byte.
-                    height, width = struct.unpack('>HH', f.read(4))
-                except Exception:
-                    return
+        for new_path, old_path in other.renames.items():
+            self.rename(old_path, new_path)
+        for path, state in other.state.items():
+            if state == 'added':
+                self.add(path)
+            elif state == 'changed':
+                self.change(path)
+            elif state == 'parsed':
+                self.parse(path)
             else:
-                return
-            return width, height, ttype
+                self.remove(path)
+        return self
 
 
-class Autobib:
+class NoteIndex:
     """
-    Static class to group all auto-bibliography functions.
+    In-memory index of all notes of an archive folder.
+
+    Maps note_id -> path and path -> [note_id, title, mtime, size, inode, meta],
+    so that links can be followed and notes can be listed without walking the
+    whole archive. meta holds what has been parsed from the note's contents
+    (e.g. its tags) and is None until the note has been parsed.
+
+    Two kinds of rescans keep the index up to date:
+    * refresh(): only re-lists directories whose mtime has changed. Cheap,
+      used for lookups by ID.
+    * scan(): lists all directories and compares each file's (inode, mtime,
+      size) fingerprint. Used for everything that depends on note contents.
+      Only files that were added or changed get re-parsed; renamed files keep
+      their parsed meta.
+
+    Every rescan reports a ScanDelta. Consumers that keep derived data can
+    catch up with changes_since(generation).
+
+    The index is persisted next to the saved searches file and loaded at
+    plugin_loaded.
     """
-    citekey_matcher = re.compile('^@.*{([^,]*)[,]?')
-    author_matcher = re.compile(r'^\s*author\s*=\s*(.*)', re.IGNORECASE)
-    title_matcher = re.compile(r'^\s*title\s*=\s*(.*)', re.IGNORECASE)
-    year_matcher = re.compile(r'^\s*year\s*=\s*(.*)', re.IGNORECASE)
+    Index_File = '.note_index.zki'
+    Version = 6
+
+    # don't check the directories more often than that (seconds).
+    # lookups that miss force a refresh anyway.
+    Refresh_Interval = 2.0
+
+    # number of deltas to remember for consumers catching up
+    History_Length = 64
+
+    note_id_matcher = re.compile('[0-9.]{12,18}')
+
+    indexes = {}    # (folder, extension) -> NoteIndex
+    lock = threading.RLock()
+
+    def __init__(self, folder, extension):
+        self.folder = folder
+        self.extension = extension
+        self.notes = {}         # path -> [note_id, title, mtime, size, inode, meta]
+        self.by_id = {}         # note_id -> path
+        self.duplicate_ids = set()
+        self.dirs = {}          # dir -> [mtime, subdirs, note files]
+        self.sorted_ids = None
+        self.sorted_paths = None
+        self.last_refresh = 0
+        self.dirty = False
+        self.save_pending = False
+        self.scan_pending = False
+        self.generation = 0
+        self.history = deque(maxlen=NoteIndex.History_Length)
+        self.pending = ScanDelta()
+        self.removed_entries = {}
+        self.parse_lock = threading.Lock()
+        self.walk_lock = threading.Lock()
 
     @staticmethod
-    def look_for_bibfile(view, settings):
+    def index_file(folder):
+        """ Return the name of the persisted note index file. """
+        return os.path.join(folder, NoteIndex.Index_File)
+
+    @staticmethod
+    def for_folder(folder, extension, refresh=True):
         """
-        Look for a bib file in the view's folder.
-        If no bib file there, then query the setting.
+        Return the (refreshed) index of folder, loading it from disk or
+        creating it on first use.
         """
-        folder = get_path_for(view)
-        if folder:
-            pattern = os.path.join(folder, '*.bib')
-            bibs = glob.glob(pattern)
-            if bibs:
-                print('Using local', bibs[0])
-                return bibs[0]
-        # try the setting
-        bibfile = settings.get('bibfile', None)
-        if bibfile:
-            if os.path.exists(bibfile):
-                print('Using global', bibfile)
-                return bibfile
-            else:
-                print('bibfile not found:', bibfile)
-                return None
+        key = (os.path.abspath(folder), extension)
+        with NoteIndex.lock:
+            index = NoteIndex.indexes.get(key)
+            if index is None:
+                index = NoteIndex(key[0], extension)
+                index.load()
+                NoteIndex.indexes[key] = index
+        if refresh:
+            index.refresh()
+        return index
 
     @staticmethod
-    def extract_all_citekeys(bibfile):
+    def load_all():
         """
-        Parse the bibfile and return all citekeys.
+        Load the indexes of the archives of all open windows and bring them up
+        to date in the background.
         """
-        citekeys = set()
-        if not os.path.exists(bibfile):
-            print('bibfile not found:', bibfile)
-            return []
-        with open(bibfile, mode='r', encoding='utf-8') as f:
-            for line in f:
-                match = Autobib.citekey_matcher.findall(line)
-                if not match:
-                    continue
-                citekeys.add(match[0])
-        return citekeys
+        extension = get_settings().get('wiki_extension')
+        for window in sublime.windows():
+            folder = get_path_for_window(window)
+            if folder:
+                NoteIndex.for_folder(folder, extension,
+                                     refresh=False).scan_async()
+                CompletionIndex.build_async(folder, extension)
 
     @staticmethod
-    def extract_all_entries(bibfile):
+    def notify_saved(filn):
         """
-        Return dict: {citekey: {title, authors, year}}
+        A note has been written: update all indexes it belongs to.
         """
-        entries = defaultdict(lambda: defaultdict(str))
-        if not os.path.exists(bibfile):
-            print('bibfile not found:', bibfile)
-            return {}
-        current_citekey = None
-        with open(bibfile, mode='r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line.endswith(','):
-                    line = line[:-1]
-                match = Autobib.citekey_matcher.findall(line)
-                if match:
-                    current_citekey = match[0]
-                    continue
-                match = Autobib.author_matcher.findall(line)
-                if match:
-                    authors = match[0]
-                    authors = Autobib.parse_authors(authors)
-                    entries[current_citekey]['authors'] = authors
-                    continue
-                match = Autobib.title_matcher.findall(line)
-                if match:
-                    title = match[0]
-                    title = Autobib.remove_latex_commands(title)
-                    entries[current_citekey]['title'] = title
-                    continue
-                match = Autobib.year_matcher.findall(line)
-                if match:
-                    year = match[0]
-                    year = Autobib.remove_latex_commands(year)
-                    entries[current_citekey]['year'] = year
-                    continue
-        return entries
+        if not filn:
+            return
+        filn = os.path.abspath(filn)
+        with NoteIndex.lock:
+            indexes = list(NoteIndex.indexes.values())
+        for index in indexes:
+            if not filn.endswith(index.extension):
+                continue
+            if not filn.startswith(os.path.join(index.folder, '')):
+                continue
+            with NoteIndex.lock:
+                dir_info = index.dirs.get(os.path.dirname(filn))
+                if dir_info is not None and filn not in dir_info[2]:
+                    dir_info[2].append(filn)
+                index.update_note(filn)
+                index.commit()
+            if index.dirty:
+                index.schedule_save()
+
+    def path_for(self, note_id):
+        """
+        Return the file of note_id. Missing or stale entries force a refresh.
+        """
+        path = self.lookup_path(note_id)
+        if path is None or not os.path.exists(path):
+            self.refresh(force=True)
+            path = self.lookup_path(note_id)
+        return path
 
-    @staticmethod
-    def parse_authors(line):
-        line = Autobib.remove_latex_commands(line)
-        authors = line.split(' and')
-        author_tuples = []
-        for author in authors:
-            first = ''
-            last = author.strip()
-            if ',' in author:
-                last, first = [x.strip() for x in author.split(',')][:2]
-            author_tuples.append((last, first))
-        if len(author_tuples) > 2:
-            authors = '{} et al.'.format(author_tuples[0][0])  # last et al
-        else:
-            authors = ' & '.join(x[0] for x in author_tuples)
-        return authors
+    def title_for(self, note_id):
+        """
+        Return the title of note_id or None if the note is unknown.
+        """
+        path = self.lookup_path(note_id)
+        if path is not None:
+            return self.notes[path][1]
 
-    @staticmethod
-    def remove_latex_commands(s):
+    def lookup_path(self, note_id):
         """
-        Simple function to remove any LaTeX commands or brackets from the string,
-        replacing it with its contents.
+        Exact ID match first, then the first ID starting with note_id, just
+        like the file name prefix match of the old directory walk.
         """
-        chars = []
-        FOUND_SLASH = False
+        path = self.by_id.get(note_id)
+        if path is not None:
+            return path
+        ids = self.get_sorted_ids()
+        i = bisect.bisect_left(ids, note_id)
+        if i < len(ids) and ids[i].startswith(note_id):
+            return self.by_id[ids[i]]
+
+    def get_sorted_ids(self):
+        ids = self.sorted_ids
+        if ids is None:
+            ids = self.sorted_ids = sorted(self.by_id)
+        return ids
+
+    def paths(self):
+        """
+        Return all note files, sorted.
+        """
+        paths = self.sorted_paths
+        if paths is None:
+            paths = self.sorted_paths = sorted(self.notes)
+        return paths
 
-        for c in s:
-            if c == '{':
-                # i.e., we are entering the contents of the command
-                if FOUND_SLASH:
-                    FOUND_SLASH = False
-            elif c == '}':
-                pass
-            elif c == '\\':
-                FOUND_SLASH = True
-            elif not FOUND_SLASH:
-                chars.append(c)
-            elif c.isspace():
-                FOUND_SLASH = False
+    def notes_and_tags(self):
+        """
+        Return a dict {path: (note_id, tags)} of all parsed notes with tags.
+        note_id is None for notes without an ID, like overview notes.
+        """
+        ret = {}
+        with NoteIndex.lock:
+            for path, entry in self.notes.items():
+                meta = entry[5]
+                if meta and meta['tags']:
+                    ret[path] = (entry[0], list(meta['tags']))
+        return ret
+
+    def refresh(self, force=False):
+        """
+        Re-list all directories whose mtime has changed since the last
+        refresh. Return the ScanDelta.
+        """
+        now = time.time()
+        if not force and now - self.last_refresh < NoteIndex.Refresh_Interval:
+            return ScanDelta()
+        # a walk that is running brings the index up to date anyway
+        return self.walk(full=False, wait=force) or ScanDelta()
 
-        return ''.join(chars)
+    def scan(self, parse=True):
+        """
+        Re-list all directories and compare all files' fingerprints. Notes
+        that were added or changed are parsed if parse is True.
+        Return the ScanDelta.
+        """
+        delta = self.walk(full=True)
+        if parse:
+            self.parse_pending()
+        return delta
 
-    @staticmethod
-    def find_citations(text, citekeys):
+    def scan_async(self):
         """
-        Find all mentioned citekeys in text
+        Run a scan in the background unless one is already pending.
         """
-        citekey_stops = r"[@',\#}{~%\[\]\s]"
-        citekeys_re = [re.escape('@' + citekey) for citekey in citekeys]
-        citekeys_re.extend([re.escape('[#' + citekey) for citekey in citekeys])
-        citekeys_re = [ckre + citekey_stops for ckre in citekeys_re]
-        # print('\n'.join(citekeys_re))
-        finder = re.compile('|'.join(citekeys_re))
-        founds_raw = finder.findall(text)
-        founds = []
-        for citekey in founds_raw:
-            if citekey.startswith('[#'):
-                citekey = citekey[1:]
-            founds.append(citekey[:-1])   # don't add stop char
-        founds = set(founds)
-        return founds
+        if self.scan_pending:
+            return
+        self.scan_pending = True
 
-    @staticmethod
-    def create_bibliography(text, bibfile, pandoc='pandoc'):
+        def do_scan():
+            try:
+                self.scan()
+            finally:
+                self.scan_pending = False
+        sublime.set_timeout_async(do_scan, 0)
+
+    @Stats.timed('note index walk')
+    def walk(self, full, wait=True):
         """
-        Create a bibliography for all citations in text in form of a dictionary.
+        List the directories, all of them if full, else only those whose
+        mtime has changed, and update the index. The file system is read
+        without holding the lock. Return the ScanDelta, or None if another
+        walk is running and wait is False.
         """
-        citekeys = Autobib.extract_all_citekeys(bibfile)
-        if not citekeys:
-            return {}
-        citekeys = Autobib.find_citations(text, citekeys)
-        citekey2bib = {}
-        for citekey in citekeys:
-            pandoc_input = citekey.replace('#', '@', 1)
-            pandoc_out = Autobib.run(pandoc, bibfile, pandoc_input)
-            citation, bib = Autobib.parse_pandoc_out(pandoc_out)
-            citekey2bib[citekey] = bib
-        return citekey2bib
+        if not self.walk_lock.acquire(wait):
+            return None
+        try:
+            self.last_refresh = time.time()
+            with NoteIndex.lock:
+                old_dirs = dict(self.dirs)
+            visited = []    # [(dirpath, mtime)]
+            listings = {}   # dirpath -> [(path, stat or None)]
+            seen = set()
+            stack = [self.folder]
+            while stack:
+                dirpath = stack.pop()
+                try:
+                    st = os.stat(dirpath)
+                except OSError:
+                    continue
+                # no inode numbers on some file systems
+                key = (st.st_dev, st.st_ino) if st.st_ino \
+                    else os.path.realpath(dirpath)
+                if key in seen:
+                    continue    # symlink loop
+                seen.add(key)
+                visited.append((dirpath, st.st_mtime))
+                dir_info = old_dirs.get(dirpath)
+                if full or dir_info is None or dir_info[0] != st.st_mtime:
+                    listing = listings[dirpath] = list(
+                        NoteIndex.list_dir(dirpath, self.extension))
+                    stack.extend(path for path, st in listing if st is None)
+                else:
+                    stack.extend(dir_info[1])
+            with NoteIndex.lock:
+                dirs = {}
+                for dirpath, mtime in visited:
+                    dir_info = self.dirs.get(dirpath)
+                    if dirpath in listings:
+                        dir_info = self.update_dir(dirpath, mtime,
+                                                   listings[dirpath], dir_info)
+                    if dir_info is not None:
+                        dirs[dirpath] = dir_info
+                for dirpath in set(self.dirs) - set(dirs):
+                    for path in self.dirs[dirpath][2]:
+                        self.remove_note(path)
+                self.dirs = dirs
+                delta = self.commit()
+        finally:
+            self.walk_lock.release()
+        if self.dirty:
+            self.schedule_save()
+        return delta
+
+    def update_dir(self, dirpath, mtime, listing, dir_info):
+        """
+        Update the notes of dirpath from its listing and return its new
+        directory info.
+        """
+        subdirs = []
+        files = []
+        for path, st in listing:
+            if st is None:
+                subdirs.append(path)
+            elif self.update_note(path, st):
+                files.append(path)
+        if dir_info is not None:
+            for path in set(dir_info[2]) - set(files):
+                self.remove_note(path)
+        return [mtime, subdirs, files]
+
+    @staticmethod
+    def list_dir(dirpath, extension):
+        """
+        Yield (path, stat_result) for all note files and (path, None) for all
+        sub-directories of dirpath. Uses os.scandir if available, so that file
+        types come with the directory listing.
+        """
+        if hasattr(os, 'scandir'):
+            try:
+                entries = list(os.scandir(dirpath))
+            except OSError:
+                return
+            for entry in entries:
+                try:
+                    if entry.name.endswith(extension) and entry.is_file():
+                        yield entry.path, entry.stat()
+                    elif entry.is_dir():
+                        yield entry.path, None
+                except OSError:
+                    continue
+            return
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if name.endswith(extension):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield path, st
+                elif stat.S_ISDIR(st.st_mode):
+                    yield path, None
+            elif os.path.isdir(path):
+                yield path, None
+
+    def update_note(self, path, st=None):
+        """
+        Update the entry of a note file from its stat result. Return False if
+        it is not a note file (anymore).
+        A changed fingerprint (inode, mtime, size) invalidates parsed meta.
+        """
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.remove_note(path)
+                return False
+            if not stat.S_ISREG(st.st_mode):
+                return False
+        old_entry = self.notes.get(path)
+        if old_entry is not None:
+            if (old_entry[2], old_entry[3], old_entry[4]) == \
+                    (st.st_mtime, st.st_size, st.st_ino):
+                return True
+            old_entry[2:] = [st.st_mtime, st.st_size, st.st_ino, None]
+            self.pending.change(path)
+            self.dirty = True
+            return True
+        basename = os.path.basename(path)
+        match = NoteIndex.note_id_matcher.match(basename)
+        note_id = match.group(0) if match else None
+        title = basename[:-len(self.extension)]
+        if note_id:
+            title = title[len(note_id):]
+        self.notes[path] = [note_id, title.strip(), st.st_mtime, st.st_size,
+                            st.st_ino, None]
+        self.sorted_paths = None
+        if note_id:
+            other_path = self.by_id.setdefault(note_id, path)
+            if other_path == path:
+                self.sorted_ids = None
+            else:
+                self.duplicate_ids.add(note_id)
+        self.pending.add(path)
+        self.dirty = True
+        return True
+
+    def remove_note(self, path):
+        entry = self.notes.pop(path, None)
+        if entry is None:
+            return
+        note_id = entry[0]
+        if note_id and self.by_id.get(note_id) == path:
+            del self.by_id[note_id]
+            if note_id in self.duplicate_ids:
+                # another file with the same ID might still be around
+                self.duplicate_ids.discard(note_id)
+                for other_path, other_entry in self.notes.items():
+                    if other_entry[0] == note_id:
+                        self.by_id[note_id] = other_path
+                        break
+        self.sorted_ids = None
+        self.sorted_paths = None
+        self.removed_entries[path] = entry
+        self.pending.remove(path)
+        self.dirty = True
+
+    def commit(self):
+        """
+        Close the pending delta: detect renames (a removed and an added file
+        with the same inode, mtime and size), hand parsed meta over to the new
+        file name and append the delta to the history.
+        """
+        delta = self.pending
+        moved = {}
+        for path, entry in self.removed_entries.items():
+            if entry[4]:
+                moved[(entry[4], entry[2], entry[3])] = (path, entry)
+        if moved:
+            for path in delta.added:
+                entry = self.notes[path]
+                old = moved.pop((entry[4], entry[2], entry[3]), None)
+                if old is None:
+                    continue
+                old_path, old_entry = old
+                entry[5] = old_entry[5]
+                delta.forget(path)
+                delta.forget(old_path)
+                delta.rename(old_path, path)
+        self.pending = ScanDelta()
+        self.removed_entries = {}
+        if delta:
+            self.generation += 1
+            self.history.append((self.generation, delta))
+        return delta
+
+    def changes_since(self, generation):
+        """
+        Return (current generation, merged ScanDelta since generation).
+        The delta is None if the history doesn't reach back far enough; the
+        consumer has to rebuild from scratch then.
+        """
+        with NoteIndex.lock:
+            if generation == self.generation:
+                return generation, ScanDelta()
+            if generation > self.generation or not self.history or \
+                    self.history[0][0] > generation + 1:
+                return self.generation, None
+            merged = ScanDelta()
+            for gen, delta in self.history:
+                if gen > generation:
+                    merged.merge(delta)
+            return self.generation, merged
+
+    def parse_pending(self):
+        """
+        Parse all notes without meta. The files are read without holding the
+        lock; results for files that changed meanwhile are dropped. The
+        parsed notes are reported in a ScanDelta of their own.
+        """
+        with self.parse_lock:
+            with NoteIndex.lock:
+                pending = [(path, entry[2], entry[3])
+                           for path, entry in self.notes.items()
+                           if entry[5] is None]
+            if not pending:
+                return
+            start = time.perf_counter()
+            metas = MetaExtractor.extract_files([p[0] for p in pending])
+            Stats.record('note parsing', time.perf_counter() - start)
+            Stats.count('notes parsed', len(pending))
+            with NoteIndex.lock:
+                for path, mtime, size in pending:
+                    entry = self.notes.get(path)
+                    if entry is not None and entry[2] == mtime \
+                            and entry[3] == size:
+                        entry[5] = metas[path]
+                        self.pending.parse(path)
+                self.commit()
+            self.dirty = True
+        self.schedule_save()
+
+    def load(self):
+        """
+        Load the persisted index, if present and compatible.
+        """
+        try:
+            with open(NoteIndex.index_file(self.folder), mode='r',
+                      encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != NoteIndex.Version \
+                or data.get('extension') != self.extension:
+            return
+        to_abs = self.abs_path
+        with NoteIndex.lock:
+            for rel_path, entry in data.get('notes', {}).items():
+                path = to_abs(rel_path)
+                self.notes[path] = entry
+                if entry[0] and \
+                        self.by_id.setdefault(entry[0], path) != path:
+                    self.duplicate_ids.add(entry[0])
+            for rel_dir, (mtime, subdirs, files) in data.get('dirs', {}).items():
+                self.dirs[to_abs(rel_dir)] = [
+                    mtime, [to_abs(d) for d in subdirs],
+                    [to_abs(f) for f in files]]
+            self.sorted_ids = None
+            self.sorted_paths = None
+
+    def save(self):
+        """
+        Persist the index next to the saved searches file.
+        """
+        self.save_pending = False
+        if not get_settings().get('persist_note_index', True):
+            return
+        to_rel = self.rel_path
+        with NoteIndex.lock:
+            data = {
+                'version': NoteIndex.Version,
+                'extension': self.extension,
+                'notes': dict((to_rel(p), e) for p, e in self.notes.items()),
+                'dirs': dict((to_rel(d), [mtime, [to_rel(s) for s in subdirs],
+                                          [to_rel(f) for f in files]])
+                             for d, (mtime, subdirs, files) in self.dirs.items()),
+            }
+            data = json.dumps(data)
+            self.dirty = False
+        filn = NoteIndex.index_file(self.folder)
+        try:
+            with open(filn + '.tmp', mode='w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(filn + '.tmp', filn)
+        except OSError as e:
+            Log.error('could not save note index: {}', e)
+
+    def schedule_save(self):
+        if self.save_pending:
+            return
+        self.save_pending = True
+        sublime.set_timeout_async(self.save, 1000)
+
+    def abs_path(self, rel_path):
+        return os.path.normpath(os.path.join(self.folder, rel_path))
+
+    def rel_path(self, path):
+        return os.path.relpath(path, self.folder)
+
+
+class MetaExtractor:
+    """
+    Extracts the meta of notes -- tags, links and citekeys -- with one read
+    and one Tokenizer pass per file.
+
+    Larger numbers of files are read and parsed in batches by a pool of
+    workers. Inside of Sublime these are threads, as the plugin host can't
+    spawn worker processes; headless callers may ask for processes.
+    """
+    # below that many files, a pool isn't worth it
+    Min_Parallel = 64
+    Batch_Size = 256
+
+    @staticmethod
+    def num_workers():
+        workers = get_settings().get('index_workers', 0)
+        if not workers or workers < 0:
+            workers = os.cpu_count() if hasattr(os, 'cpu_count') else 4
+        return max(1, workers or 1)
+
+    @staticmethod
+    def extract_file(path):
+        """
+        Return the meta of a single note file.
+        """
+        return extract_meta_of_files([path], ZkConstants.TAG_PREFIX)[0][1]
+
+    @staticmethod
+    def extract_files(paths, workers=None, processes=False):
+        """
+        Return a dict {path: meta} for all paths, using a pool of workers
+        if there are enough of them.
+        """
+        tag_prefix = ZkConstants.TAG_PREFIX
+        if workers is None:
+            workers = MetaExtractor.num_workers()
+        if workers == 1 or len(paths) < MetaExtractor.Min_Parallel:
+            return dict(extract_meta_of_files(paths, tag_prefix))
+        batch_size = min(MetaExtractor.Batch_Size,
+                         max(1, len(paths) // (workers * 4)))
+        batches = [paths[i:i + batch_size]
+                   for i in range(0, len(paths), batch_size)]
+        if processes:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        metas = {}
+        with executor:
+            for results in executor.map(extract_meta_of_files, batches,
+                                        [tag_prefix] * len(batches)):
+                metas.update(results)
+        return metas
+
+
+class DerivedIndex:
+    """
+    Base class of indexes derived from the parsed meta of a NoteIndex.
+
+    Subclasses are kept up to date with the ScanDeltas of the note index by
+    sync(). They have a class attribute `indexes`, a dict
+    (folder, extension) -> index, and implement:
+
+    * reset(): clear the index
+    * add_path(): index a note file; get_meta() returns what has been parsed
+    * remove_path(): drop a note file from the index, if it's there
+
+    and may implement:
+
+    * build(): index all notes, faster than one add_path() after the other
+    * prepare(): read what add_path() needs for a list of paths, before the
+      index is locked for them
+
+    Every index has its own lock, held by readers and while it is updated;
+    slow work, like building it from scratch, is done outside of it.
+    """
+    # guards the indexes dicts
+    registry_lock = threading.RLock()
+
+    # False for indexes that only need the note files, not their meta
+    uses_meta = True
+
+    def __init__(self, note_index):
+        self.note_index = note_index
+        self.generation = -1
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def for_folder(cls, folder, extension, parse=True):
+        """
+        Return the up-to-date index of folder. See sync() for parse.
+        """
+        note_index = NoteIndex.for_folder(folder, extension, refresh=False)
+        with DerivedIndex.registry_lock:
+            key = (note_index.folder, extension)
+            index = cls.indexes.get(key)
+            if index is None:
+                index = cls.indexes[key] = cls(note_index)
+        index.sync(parse)
+        return index
+
+    def sync(self, parse=True):
+        """
+        Catch up with the note index. Notes added or removed via Sublime are
+        seen immediately; edits made outside of Sublime are picked up by a
+        background scan.
+        Notes that haven't been parsed yet are parsed first if parse is True.
+        On the UI thread, pass False unless the result is needed complete
+        right away: they're parsed in the background then and show up with
+        the next sync.
+        """
+        note_index = self.note_index
+        note_index.refresh()
+        with self.sync_lock:
+            if self.uses_meta and parse:
+                note_index.parse_pending()
+            generation, delta = note_index.changes_since(self.generation)
+            if delta is None:
+                self.rebuild()
+            else:
+                self.apply(delta)
+            self.generation = generation
+        note_index.scan_async()
+
+    def apply(self, delta):
+        """
+        Update the index with the changes of delta.
+        """
+        paths = delta.added + delta.changed
+        if self.uses_meta:
+            paths += delta.parsed
+        self.prepare(paths + [new_path for old_path, new_path
+                              in delta.renamed])
+        with self.lock:
+            for old_path, new_path in delta.renamed:
+                self.remove_path(old_path)
+                self.add_path(new_path)
+            for path in delta.removed:
+                self.remove_path(path)
+            for path in paths:
+                self.remove_path(path)
+                self.add_path(path)
+
+    def prepare(self, paths):
+        pass
+
+    def rebuild(self):
+        """
+        Build the index from scratch, on the side, and swap it in. Readers
+        keep using the old one meanwhile.
+        """
+        fresh = object.__new__(type(self))
+        fresh.note_index = self.note_index
+        fresh.reset()
+        fresh.build()
+        with self.lock:
+            vars(self).update(vars(fresh))
+
+    def build(self):
+        with NoteIndex.lock:
+            paths = list(self.note_index.notes)
+        for path in paths:
+            self.add_path(path)
+
+    def get_meta(self, path):
+        """
+        Return (note_id, meta) of a parsed note file or (None, None).
+        note_id is None for notes without an ID.
+        """
+        entry = self.note_index.notes.get(path)
+        if entry is None or not entry[5]:
+            return None, None
+        return entry[0], entry[5]
+
+
+class TagIndex(DerivedIndex):
+    """
+    Inverted index of the tags of all notes of an archive folder.
+
+    Keeps a sorted list of note files (posting list) per tag and a sorted
+    vocabulary of all tags, so tag-specs can be answered with set operations
+    and `#prefix*` wildcards with a bisect range scan of the vocabulary.
+    Notes are indexed by file, so notes without an ID keep their tags, too.
+    """
+    indexes = {}    # (folder, extension) -> TagIndex
+
+    def reset(self):
+        self.postings = {}          # tag -> sorted list of paths
+        self.vocabulary = []        # sorted list of tags
+        self.universe = set()       # paths of all notes with tags
+        self.path_tags = {}         # path -> tags
+
+    def build(self):
+        tag_paths = defaultdict(list)
+        with NoteIndex.lock:
+            for path in self.note_index.notes:
+                note_id, meta = self.get_meta(path)
+                if not meta or not meta['tags']:
+                    continue
+                self.path_tags[path] = meta['tags']
+                for tag in meta['tags']:
+                    tag_paths[tag].append(path)
+        self.postings = dict((tag, sorted(paths))
+                             for tag, paths in tag_paths.items())
+        self.vocabulary = sorted(self.postings)
+        self.universe = set(self.path_tags)
+
+    def add_path(self, path):
+        note_id, meta = self.get_meta(path)
+        if not meta or not meta['tags']:
+            return
+        self.path_tags[path] = meta['tags']
+        self.universe.add(path)
+        for tag in meta['tags']:
+            paths = self.postings.get(tag)
+            if paths is None:
+                paths = self.postings[tag] = []
+                bisect.insort(self.vocabulary, tag)
+            bisect.insort(paths, path)
+
+    def remove_path(self, path):
+        tags = self.path_tags.pop(path, ())
+        self.universe.discard(path)
+        for tag in tags:
+            paths = self.postings.get(tag)
+            if not paths:
+                continue
+            i = bisect.bisect_left(paths, path)
+            if i < len(paths) and paths[i] == path:
+                del paths[i]
+            if not paths:
+                del self.postings[tag]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, tag)]
+
+    def paths_with_tag(self, tag):
+        with self.lock:
+            return list(self.postings.get(tag, ()))
+
+    def paths_with_prefix(self, prefix):
+        """
+        Return the set of paths of all notes with a tag starting with prefix.
+        """
+        paths = set()
+        with self.lock:
+            vocabulary = self.vocabulary
+            i = bisect.bisect_left(vocabulary, prefix)
+            while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+                paths.update(self.postings[vocabulary[i]])
+                i += 1
+        return paths
+
+
+class LinkIndex(DerivedIndex):
+    """
+    Forward and reverse links between the notes of an archive folder, so
+    that notes referencing a note can be listed in O(number of links).
+    Citations are tracked the same way: citekey -> citing notes.
+    """
+    indexes = {}    # (folder, extension) -> LinkIndex
+
+    def reset(self):
+        self.forward = {}                   # path -> (note_id, ids, citekeys)
+        self.backward = defaultdict(set)    # note_id -> referencing paths
+        self.citing = defaultdict(set)      # citekey -> citing paths
+
+    def add_path(self, path):
+        note_id, meta = self.get_meta(path)
+        if not meta:
+            return
+        links = meta['links']
+        citekeys = meta.get('citekeys', ())
+        if not links and not citekeys:
+            return
+        self.forward[path] = (note_id, links, citekeys)
+        for linked_id in links:
+            self.backward[linked_id].add(path)
+        for citekey in citekeys:
+            self.citing[citekey].add(path)
+
+    def remove_path(self, path):
+        note_id, links, citekeys = self.forward.pop(path, (None, (), ()))
+        for linked_id in links:
+            LinkIndex.discard(self.backward, linked_id, path)
+        for citekey in citekeys:
+            LinkIndex.discard(self.citing, citekey, path)
+
+    @staticmethod
+    def discard(mapping, key, path):
+        paths = mapping.get(key)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del mapping[key]
+
+    def links_of(self, path):
+        """
+        Return the ids of all notes the note file links to.
+        """
+        with self.lock:
+            return self.forward.get(path, (None, (), ()))[1]
+
+    def referencing_files(self, note_id):
+        """
+        Return the sorted files of all notes linking to note_id.
+        """
+        with self.lock:
+            return sorted(self.backward.get(note_id, ()))
+
+    def citing_files(self, citekey):
+        """
+        Return the sorted files of all notes citing citekey, given as @citekey,
+        #citekey or plain citekey.
+        """
+        citekey = citekey.lstrip('@#')
+        with self.lock:
+            return sorted(self.citing.get(citekey, ()))
+
+
+class CompletionIndex(DerivedIndex):
+    """
+    Ready-made wiki-link completions for all notes of an archive folder,
+    updated as notes are added, renamed or removed.
+
+    completions() looks up the notes whose ID or a word of whose title
+    starts with the typed prefix, in a sorted list of those keys.
+    The index is built in the background, never while typing.
+    """
+    indexes = {}    # (folder, extension) -> CompletionIndex
+    uses_meta = False
+    building = set()    # (folder, extension) of indexes being built
+
+    # where Sublime can be told to ask again as the prefix gets longer,
+    # no more completions are returned at once
+    Max_Completions = 1000
+
+    word_matcher = re.compile(r'\w+')
+
+    def reset(self):
+        self.names = {}         # path -> (note_id, title, file name)
+        self.completions_of = {}   # path -> [trigger, completion]
+        self.keys = []          # sorted [(lowercase key, path)]
+        self.link_style = None
+
+    @classmethod
+    def for_typing(cls, folder, extension):
+        """
+        Return the up-to-date index of folder if it can be had without
+        building it first, else None. It's built in the background then.
+        """
+        note_index = NoteIndex.for_folder(folder, extension, refresh=False)
+        index = cls.indexes.get((note_index.folder, extension))
+        if index is not None and \
+                note_index.changes_since(index.generation)[1] is not None:
+            return cls.for_folder(folder, extension)
+        cls.build_async(folder, extension)
+        return None
+
+    @classmethod
+    def build_async(cls, folder, extension):
+        """
+        Build or update the index of folder in the background.
+        """
+        key = (folder, extension)
+        with DerivedIndex.registry_lock:
+            if key in cls.building:
+                return
+            cls.building.add(key)
+
+        def build():
+            try:
+                cls.for_folder(folder, extension)
+            finally:
+                with DerivedIndex.registry_lock:
+                    cls.building.discard(key)
+        sublime.set_timeout_async(build, 0)
+
+    def build(self):
+        """
+        Add all notes and sort their keys once.
+        """
+        with NoteIndex.lock:
+            paths = list(self.note_index.notes)
+        keys = []
+        for path in paths:
+            if self.add_name(path):
+                keys.extend((key, path) for key in self.keys_of(path))
+        keys.sort()
+        self.keys = keys
+
+    def add_path(self, path):
+        if self.add_name(path):
+            for key in self.keys_of(path):
+                bisect.insort(self.keys, (key, path))
+
+    def add_name(self, path):
+        """
+        Remember the ID and title of the note file. Return whether it is a
+        note that can be linked to.
+        """
+        filename = os.path.basename(path)
+        extension = self.note_index.extension
+        if not filename.endswith(extension) or ' ' not in filename:
+            return False
+        note_id, title = filename[:-len(extension)].split(' ', 1)
+        self.names[path] = (note_id, title, filename)
+        if self.link_style is not None:
+            self.completions_of[path] = self.completion(path)
+        return True
+
+    def remove_path(self, path):
+        if path not in self.names:
+            return
+        for key in self.keys_of(path):
+            i = bisect.bisect_left(self.keys, (key, path))
+            if i < len(self.keys) and self.keys[i] == (key, path):
+                del self.keys[i]
+        del self.names[path]
+        self.completions_of.pop(path, None)
+
+    def keys_of(self, path):
+        note_id, title, filename = self.names[path]
+        keys = set(self.word_matcher.findall(title.lower()))
+        keys.add(filename.lower())
+        return keys
+
+    def completion(self, path):
+        note_id, title, filename = self.names[path]
+        link_prefix, link_postfix, with_title = self.link_style
+        completion = link_prefix + note_id + link_postfix
+        if with_title:
+            completion += ' ' + title
+        return [filename, completion]
+
+    def set_link_style(self, link_style):
+        """
+        Format all completions for link_style: (link prefix, link postfix,
+        insert title).
+        """
+        if link_style == self.link_style:
+            return
+        self.link_style = link_style
+        self.completions_of = dict((path, self.completion(path))
+                                   for path in self.names)
+
+    def completions(self, prefix, link_style, limit=None):
+        """
+        Return the completions of the notes matching prefix, at most limit
+        of them.
+        """
+        with self.lock:
+            self.set_link_style(link_style)
+            prefix = prefix.lower()
+            keys = self.keys
+            i = bisect.bisect_left(keys, (prefix,))
+            paths = []
+            seen = set()
+            while i < len(keys) and keys[i][0].startswith(prefix):
+                path = keys[i][1]
+                if path not in seen:
+                    seen.add(path)
+                    paths.append(path)
+                    if limit and len(paths) >= limit:
+                        break
+                i += 1
+            return [self.completions_of[path] for path in sorted(paths)]
+
+
+class FullTextIndex(DerivedIndex):
+    """
+    Inverted index of the words of the titles and bodies of all notes of an
+    archive folder, for ranked full-text search.
+
+    Every note gets a document number; per word, the numbers of the notes
+    containing it, how often, and its BM25 weight without the idf (posting
+    list) are kept in compact arrays, in increasing document order. A
+    changed note is removed by marking its number dead and added again
+    under a new one; dead numbers are dropped from the posting lists once
+    there are many of them.
+
+    Results are ranked with BM25; a query only has to sum up the stored
+    weights times the idf of the words. The weights depend on the average
+    note length, they're recomputed when it has drifted by more than
+    Norm_Drift. Words of the title count Title_Boost times. Phrases are
+    looked up as their words and then checked in the text of the best
+    ranked notes.
+
+    The index is pickled into Sublime's cache folder; after a restart only
+    notes whose (mtime, size) has changed are read again.
+    """
+    Version = 1
+
+    indexes = {}    # (folder, extension) -> FullTextIndex
+    uses_meta = False
+    save_pending = False
+
+    # BM25 parameters
+    K1 = 1.2
+    B = 0.75
+    Title_Boost = 3
+
+    # recompute the weights when the average note length has changed by
+    # that much since
+    Norm_Drift = 0.1
+
+    # drop dead documents when there are more of them than live ones
+    Min_Compaction = 1000
+
+    word_matcher = re.compile(r'\w+')
+    query_matcher = re.compile(r'"([^"]*)"?|(\S+)')
+
+    def reset(self):
+        # word -> (array of docs, array of counts, array of weights)
+        self.postings = {}
+        self.docs = {}          # path -> doc
+        self.doc_paths = []     # doc -> path, None if dead
+        self.doc_lengths = array.array('I')
+        self.fingerprints = []  # doc -> (mtime, size) of the note file
+        self.dead = set()
+        self.total_length = 0
+        self.norm_length = None     # average length the weights are for
+        self.prepared = {}      # path -> text read by prepare()
+        self.unsaved = False
+
+    def rebuild(self):
+        DerivedIndex.rebuild(self)
+        if self.unsaved:
+            self.schedule_save()
+
+    def build(self):
+        """
+        Load the pickled index, if any, and bring it up to date with the
+        note index, reading only the notes that are new or have changed.
+        """
+        loaded = self.load()
+        with NoteIndex.lock:
+            current = dict((path, (entry[2], entry[3])) for path, entry
+                           in self.note_index.notes.items() if entry[0])
+        for path, doc in list(self.docs.items()):
+            if current.get(path) != self.fingerprints[doc]:
+                self.remove_path(path)
+        paths = [path for path in current if path not in self.docs]
+        for path, text in FullTextIndex.read_all(paths).items():
+            self.add_text(path, text)
+        # fresh weights are only as good as the first note's length
+        self.check_norms(drift=None if loaded else 0)
+        self.unsaved = bool(paths or self.dead or not loaded)
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path, mode='r', encoding='utf-8') as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    @staticmethod
+    def read_all(paths):
+        """
+        Return {path: text} of all paths, read in parallel.
+        """
+        if len(paths) < 2:
+            return dict((path, FullTextIndex.read(path)) for path in paths)
+        workers = min(MetaExtractor.num_workers(), len(paths))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return dict(zip(paths, executor.map(FullTextIndex.read, paths)))
+
+    def prepare(self, paths):
+        self.prepared = FullTextIndex.read_all(paths)
+
+    def add_path(self, path):
+        if path in self.prepared:
+            text = self.prepared.pop(path)
+        else:
+            text = FullTextIndex.read(path)
+        self.add_text(path, text)
+
+    def add_text(self, path, text):
+        entry = self.note_index.notes.get(path)
+        if entry is None or not entry[0] or text is None:
+            return
+        words = self.word_matcher.findall(text.lower())
+        counts = Counter(words)
+        title_words = self.word_matcher.findall(entry[1].lower())
+        for word in title_words:
+            counts[word] += FullTextIndex.Title_Boost
+        length = len(words) + FullTextIndex.Title_Boost * len(title_words)
+        doc = len(self.doc_paths)
+        self.docs[path] = doc
+        self.doc_paths.append(path)
+        self.doc_lengths.append(length)
+        self.fingerprints.append((entry[2], entry[3]))
+        self.total_length += length
+        if self.norm_length is None:
+            self.norm_length = max(1, length)
+        norm = FullTextIndex.norm(length, self.norm_length)
+        postings = self.postings
+        for word, count in counts.items():
+            posting = postings.get(word)
+            if posting is None:
+                posting = postings[word] = (array.array('I'),
+                                            array.array('H'),
+                                            array.array('f'))
+            count = min(count, 0xffff)
+            posting[0].append(doc)
+            posting[1].append(count)
+            posting[2].append(count / (count + norm))
+
+    def remove_path(self, path):
+        doc = self.docs.pop(path, None)
+        if doc is None:
+            return
+        self.doc_paths[doc] = None
+        self.dead.add(doc)
+        self.total_length -= self.doc_lengths[doc]
+
+    def compact(self):
+        """
+        Renumber the live documents and drop the dead ones from the posting
+        lists.
+        """
+        renumbered = array.array('I', [0]) * len(self.doc_paths)
+        doc_paths = []
+        doc_lengths = array.array('I')
+        fingerprints = []
+        for doc, path in enumerate(self.doc_paths):
+            if path is not None:
+                renumbered[doc] = len(doc_paths)
+                doc_paths.append(path)
+                doc_lengths.append(self.doc_lengths[doc])
+                fingerprints.append(self.fingerprints[doc])
+        dead = self.dead
+        for word, (docs, counts, weights) in list(self.postings.items()):
+            if dead.isdisjoint(docs):
+                self.postings[word] = (
+                    array.array('I', map(renumbered.__getitem__, docs)),
+                    counts, weights)
+                continue
+            kept = [i for i, doc in enumerate(docs) if doc not in dead]
+            if kept:
+                self.postings[word] = (
+                    array.array('I', (renumbered[docs[i]] for i in kept)),
+                    array.array('H', map(counts.__getitem__, kept)),
+                    array.array('f', map(weights.__getitem__, kept)))
+            else:
+                del self.postings[word]
+        self.docs = dict((path, doc) for doc, path in enumerate(doc_paths))
+        self.doc_paths = doc_paths
+        self.doc_lengths = doc_lengths
+        self.fingerprints = fingerprints
+        self.dead = set()
+
+    @staticmethod
+    def parse_query(query):
+        """
+        Return (words, phrases) of query: all words, and the lists of words
+        of "quoted phrases" and of terms like `note-taking` that are more
+        than one word.
+        """
+        words = []
+        phrases = []
+        for match in FullTextIndex.query_matcher.finditer(query):
+            term = match.group(1) if match.group(1) is not None \
+                else match.group(2)
+            term_words = FullTextIndex.word_matcher.findall(term.lower())
+            words.extend(term_words)
+            if len(term_words) > 1:
+                phrases.append(term_words)
+        return words, phrases
+
+    @staticmethod
+    def norm(length, norm_length):
+        """
+        Return the BM25 length normalization of a note of length words.
+        """
+        return FullTextIndex.K1 * (1 - FullTextIndex.B + FullTextIndex.B *
+                                   length / norm_length)
+
+    def check_norms(self, drift=None):
+        """
+        Recompute all weights if the average note length has drifted too
+        far (Norm_Drift by default) from the one they were computed for.
+        """
+        if not self.docs:
+            return
+        if drift is None:
+            drift = FullTextIndex.Norm_Drift
+        average = self.total_length / len(self.docs)
+        if abs(average - self.norm_length) <= drift * self.norm_length:
+            return
+        self.norm_length = max(1, average)
+        norms = [FullTextIndex.norm(length, self.norm_length)
+                 for length in self.doc_lengths]
+        for docs, counts, weights in self.postings.values():
+            weights[:] = array.array('f', map(
+                operator.truediv, counts, map(
+                    operator.add, counts, map(norms.__getitem__, docs))))
+
+    def rank(self, words, limit=None):
+        """
+        Return the [(score, path)] of the notes containing all words, best
+        first; only the best limit ones if limit is given.
+        """
+        scores, docs = self.scores(words)
+        if limit:
+            best = heapq.nlargest(limit, zip(scores, docs))
+        else:
+            best = sorted(zip(scores, docs), reverse=True)
+        doc_paths = self.doc_paths
+        return [(score, doc_paths[doc]) for score, doc in best]
+
+    def scores(self, words):
+        """
+        Return ([score], [doc]) of the notes containing all words.
+        """
+        if len(self.dead) > max(FullTextIndex.Min_Compaction, len(self.docs)):
+            self.compact()
+        self.check_norms()
+        words = set(words)
+        if not words or not all(word in self.postings for word in words):
+            return [], []
+        n = len(self.docs)
+        # rarest word first, the others can only narrow it down. Scores are
+        # summed up with map() and friends, not with a Python loop per note
+        postings = sorted((self.postings[word] for word in words),
+                          key=lambda posting: len(posting[0]))
+        candidates = scores = None
+        for docs, counts, weights in postings:
+            df = len(docs)
+            if self.dead:
+                df -= len(self.dead.intersection(docs))
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * \
+                (FullTextIndex.K1 + 1)
+            if candidates is None:
+                candidates = docs
+                term_weights = weights
+                keep = None
+                if self.dead:
+                    keep = list(map(operator.not_,
+                                    map(self.dead.__contains__, docs)))
+            elif len(candidates) * 8 < len(docs):
+                # few candidates: look them up with bisect
+                positions = list(map(min, map(bisect.bisect_left,
+                                              itertools.repeat(docs),
+                                              candidates),
+                                     itertools.repeat(len(docs) - 1)))
+                keep = list(map(operator.eq, map(docs.__getitem__, positions),
+                                candidates))
+                term_weights = map(weights.__getitem__,
+                                   itertools.compress(positions, keep))
+            else:
+                doc_weights = dict(zip(docs, weights))
+                keep = list(map(doc_weights.__contains__, candidates))
+                term_weights = map(doc_weights.__getitem__,
+                                   itertools.compress(candidates, keep))
+            term_scores = map(operator.mul, term_weights,
+                              itertools.repeat(idf))
+            if scores is None:
+                scores = term_scores if keep is None else \
+                    itertools.compress(term_scores, keep)
+            else:
+                scores = map(operator.add, itertools.compress(scores, keep),
+                             term_scores)
+            if keep is not None:
+                candidates = list(itertools.compress(candidates, keep))
+            scores = list(scores)
+        return scores, list(candidates)
+
+    @Stats.timed('full-text search')
+    def search(self, query, limit=None):
+        """
+        Return [(score, path)] of the notes matching query, best first: the
+        notes containing all words of the query and all its phrases.
+        """
+        words, phrases = FullTextIndex.parse_query(query)
+        if not phrases:
+            with self.lock:
+                return self.rank(words, limit)
+        # without the word boundary in front, the regex engine can look
+        # for the first word as a literal
+        matchers = [re.compile(r'\W+'.join(re.escape(word) for word in phrase)
+                               + r'(?!\w)') for phrase in phrases]
+        with self.lock:
+            scores, docs = self.scores(words)
+            doc_paths = list(map(self.doc_paths.__getitem__, docs))
+        results = []
+        for score, path in sorted(zip(scores, doc_paths), reverse=True):
+            if self.has_phrases(path, matchers):
+                results.append((score, path))
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+    def has_phrases(self, path, matchers):
+        """
+        Return whether the title or text of the note at path contain the
+        phrases of matchers.
+        """
+        text = NoteCache.read(path)
+        entry = self.note_index.notes.get(path)
+        if text is None or entry is None:
+            return False
+        text = entry[1].lower() + '\n' + text.lower()
+        for matcher in matchers:
+            for match in matcher.finditer(text):
+                start = match.start()
+                if not start or not self.word_matcher.match(text, start - 1):
+                    break
+            else:
+                return False
+        return True
+
+    def cache_file(self):
+        key = self.note_index.folder + self.note_index.extension
+        name = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(sublime.cache_path(), 'sublime_zk',
+                            name + '.fulltext')
+
+    def load(self):
+        """
+        Load the pickled index. Return success.
+        """
+        if not get_settings().get('persist_note_index', True):
+            return False
+        try:
+            with open(self.cache_file(), mode='rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # missing or unreadable: index all notes again
+            return False
+        if (data.get('version') != FullTextIndex.Version
+                or data.get('folder') != self.note_index.folder
+                or data.get('title_boost') != FullTextIndex.Title_Boost):
+            return False
+        self.postings = data['postings']
+        self.doc_paths = data['doc_paths']
+        self.doc_lengths = data['doc_lengths']
+        self.fingerprints = data['fingerprints']
+        self.norm_length = data['norm_length']
+        self.docs = dict((path, doc) for doc, path
+                         in enumerate(self.doc_paths))
+        self.total_length = sum(self.doc_lengths)
+        return True
+
+    def schedule_save(self):
+        if self.save_pending:
+            return
+        self.save_pending = True
+        sublime.set_timeout_async(self.save, 1000)
+
+    def save(self):
+        """
+        Pickle the index into the cache folder.
+        """
+        self.save_pending = False
+        if not get_settings().get('persist_note_index', True):
+            return
+        with self.lock:
+            if self.dead:
+                self.compact()
+            data = pickle.dumps({
+                'version': FullTextIndex.Version,
+                'folder': self.note_index.folder,
+                'title_boost': FullTextIndex.Title_Boost,
+                'postings': self.postings,
+                'doc_paths': self.doc_paths,
+                'doc_lengths': self.doc_lengths,
+                'fingerprints': self.fingerprints,
+                'norm_length': self.norm_length,
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+        filn = self.cache_file()
+        try:
+            os.makedirs(os.path.dirname(filn), exist_ok=True)
+            with open(filn + '.tmp', mode='wb') as f:
+                f.write(data)
+            os.replace(filn + '.tmp', filn)
+        except OSError as e:
+            Log.error('could not save full-text index: {}', e)
+
+
+class TagSearch:
+    """
+    Advanced tag search.
+
+    Grammar:
+    ```
+        search-spec: search-term [, search-term]*
+        search-term: tag-spec [ tag-spec]*
+        tag-spec: [!]#tag-name[*]
+        tag-name: {any valid tag string}
+    ```
+    """
+
+    @staticmethod
+    def advanced_tag_search(search_spec, folder, extension):
+        """
+        Return the sorted files of all notes matching the search_spec.
+
+        The tag-specs of a search-term are or-ed, search-terms are and-ed.
+        Negations refer to all notes having any tags at all.
+        """
+        if search_spec.startswith('[!'):
+            sublime.active_window().run_command('zk_show_all_notes')
+            return
+        elif search_spec.startswith('#!'):
+            sublime.active_window().run_command('zk_show_all_tags')
+            return
+        tag_index = TagIndex.for_folder(folder, extension)
+        with tag_index.lock:
+            result = None
+            for sterm in [s.strip() for s in search_spec.split(',')]:
+                sterm_results = set()
+                for tspec in sterm.split():
+                    sterm_results |= TagSearch.match(tag_index, tspec)
+                if result is None:
+                    result = sterm_results
+                else:
+                    result &= sterm_results
+        return sorted(result)
+
+    @staticmethod
+    def show_results(window, folder, extension, search_spec, note_files):
+        """
+        Show the notes found by advanced_tag_search.
+        """
+        if note_files is None:
+            return
+        link_prefix, link_postfix = get_link_pre_postfix()
+        lines = ['# Notes matching search-spec ' + search_spec + '\n']
+        results = []
+        index = NoteIndex.for_folder(folder, extension)
+        with NoteIndex.lock:
+            entries = [index.notes.get(path) for path in note_files]
+        note_ids = set(entry[0] for entry in entries if entry)
+        for note_id in [n for n in note_ids if n]:  # Strip the None
+            title = index.title_for(note_id)
+            if title is not None:
+                results.append((note_id, title))
+        settings = get_settings()
+        sort_order = settings.get('sort_notelists_by', 'id').lower()
+        if sort_order not in ('id', 'title'):
+            sort_order = 'id'
+        column = 0
+        if sort_order == 'title':
+            column = 1
+        results.sort(key=itemgetter(column))
+        for note_id, title in results:
+            line = '* ' + link_prefix + note_id + link_postfix + ' '
+            line += title
+            lines.append(line)
+        if ExternalSearch.EXTERNALIZE:
+            with open(ExternalSearch.external_file(folder), mode='w',
+                      encoding='utf-8') as f:
+                f.write('\n'.join(lines))
+        ExternalSearch.show_search_results(window, folder, 'Tag-Search', lines,
+                                           'show_all_tags_in_new_pane')
+
+    @staticmethod
+    def match(tag_index, tspec):
+        """
+        Return the set of paths of all notes matching a single tag-spec.
+        """
+        if tspec[0] == '!':
+            if tspec[-1] == '*':
+                return TagSearch.match_not_startswith(tag_index, tspec)
+            return TagSearch.match_not(tag_index, tspec)
+        if tspec[-1] == '*':
+            return TagSearch.match_startswith(tag_index, tspec)
+        return TagSearch.match_tag(tag_index, tspec)
+
+    @staticmethod
+    def match_not(tag_index, tspec):
+        return tag_index.universe.difference(tag_index.paths_with_tag(tspec[1:]))
+
+    @staticmethod
+    def match_tag(tag_index, tspec):
+        return set(tag_index.paths_with_tag(tspec))
+
+    @staticmethod
+    def match_not_startswith(tag_index, tspec):
+        return tag_index.universe - tag_index.paths_with_prefix(tspec[1:-1])
+
+    @staticmethod
+    def match_startswith(tag_index, tspec):
+        return tag_index.paths_with_prefix(tspec[:-1])
+
+
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'type', 'data'])
+
+
+class ImageCache:
+    """
+    Probed images: their size and type and, for remote images, the base64
+    encoded payload.
+
+    Local images are keyed by path, mtime and size; remote ones by URL, so
+    they are downloaded only once. Entries are kept in memory up to
+    Memory_Limit bytes of payload; remote images also in Sublime's cache
+    folder, up to the image_cache_size setting (MB). The least recently used
+    entries are evicted first.
+
+    Remote images older than the image_cache_max_age setting (hours) are
+    checked with the server again, with the ETag and Last-Modified headers
+    of their download, and downloaded again only if they have changed.
+    """
+    Version = 2
+    Memory_Limit = 32 * 1024 * 1024
+    Entry_Overhead = 200    # bytes counted per entry on top of the payload
+    Download_Timeout = 20   # seconds
+
+    entries = OrderedDict()     # key -> ImageInfo, least recently used first
+    memory_size = 0
+    validators = {}     # url -> (time checked, ETag, Last-Modified)
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(key):
+        with ImageCache.lock:
+            info = ImageCache.entries.get(key)
+            if info is not None:
+                ImageCache.entries.move_to_end(key)
+        Stats.count('image cache hits' if info is not None
+                    else 'image cache misses')
+        return info
+
+    @staticmethod
+    def put(key, info):
+        with ImageCache.lock:
+            if key in ImageCache.entries:
+                ImageCache.memory_size -= ImageCache.size_of(
+                    ImageCache.entries.pop(key))
+            ImageCache.entries[key] = info
+            ImageCache.memory_size += ImageCache.size_of(info)
+            while (ImageCache.memory_size > ImageCache.Memory_Limit
+                   and len(ImageCache.entries) > 1):
+                _, evicted = ImageCache.entries.popitem(last=False)
+                ImageCache.memory_size -= ImageCache.size_of(evicted)
+
+    @staticmethod
+    def size_of(info):
+        return len(info.data or '') + ImageCache.Entry_Overhead
+
+    @staticmethod
+    def local(path):
+        """
+        Return the ImageInfo of the image file at path, or None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = ('file', path, st.st_mtime, st.st_size)
+        info = ImageCache.get(key)
+        if info is None:
+            try:
+                size = ImageHandler.get_image_size(path)
+            except OSError:
+                return None
+            if not size:
+                return None
+            info = ImageInfo(size[0], size[1], size[2], None)
+            ImageCache.put(key, info)
+        return info
+
+    @staticmethod
+    def remote(url):
+        """
+        Return the ImageInfo of the image at url, with its payload, or None.
+        """
+        key = ('url', url)
+        info = ImageCache.get(key)
+        if info is None:
+            info = ImageCache.load(url)
+        if info is None or not ImageCache.is_fresh(url):
+            info = ImageCache.download(url, info)
+        if info is not None:
+            ImageCache.put(key, info)
+        return info
+
+    @staticmethod
+    def is_fresh(url):
+        """
+        Return whether the cached image of url was checked recently enough.
+        """
+        validators = ImageCache.validators.get(url)
+        if validators is None:
+            return False
+        max_age = get_settings().get('image_cache_max_age', 24) * 3600
+        return time.time() - validators[0] < max_age
+
+    @staticmethod
+    def download(url, cached=None):
+        """
+        Download the image at url. If there is a cached ImageInfo, only
+        download it if it has changed. Return the ImageInfo or None.
+        """
+        request = urllib.request.Request(url)
+        etag = last_modified = None
+        if cached is not None and url in ImageCache.validators:
+            checked, etag, last_modified = ImageCache.validators[url]
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        try:
+            response = urllib.request.urlopen(
+                request, timeout=ImageCache.Download_Timeout)
+            content = response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                Stats.count('image cache revalidations')
+                ImageCache.save(url, cached,
+                                e.headers.get('ETag') or etag,
+                                e.headers.get('Last-Modified') or last_modified)
+                return cached
+            return ImageCache.download_failed(url, cached, e)
+        except (OSError, ValueError) as e:
+            return ImageCache.download_failed(url, cached, e)
+        size = ImageHandler.get_image_size(io.BytesIO(content))
+        if not size:
+            return None
+        info = ImageInfo(size[0], size[1], size[2],
+                         base64.b64encode(content).decode('ascii'))
+        ImageCache.save(url, info, response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+        return info
+
+    @staticmethod
+    def download_failed(url, cached, error):
+        """
+        Return the cached ImageInfo of url, if any, and don't try again
+        before image_cache_max_age.
+        """
+        Log.warning('could not download image {}: {}', url, error)
+        if cached is not None:
+            validators = ImageCache.validators.get(url, (0, None, None))
+            ImageCache.validators[url] = (time.time(),) + validators[1:]
+        return cached
+
+    @staticmethod
+    def cache_folder():
+        return os.path.join(sublime.cache_path(), 'sublime_zk', 'images')
+
+    @staticmethod
+    def cache_file(url):
+        name = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return os.path.join(ImageCache.cache_folder(), name + '.imgcache')
+
+    @staticmethod
+    def disk_limit():
+        return get_settings().get('image_cache_size', 100) * 1024 * 1024
+
+    @staticmethod
+    def load(url):
+        """
+        Return the ImageInfo of url from the cache folder, or None.
+        """
+        if ImageCache.disk_limit() <= 0:
+            return None
+        filn = ImageCache.cache_file(url)
+        try:
+            with open(filn, mode='rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # missing or unreadable: download again
+            return None
+        if data.get('version') != ImageCache.Version or data.get('url') != url:
+            return None
+        ImageCache.validators[url] = data['validators']
+        try:
+            # the file's mtime marks its last use, for evict()
+            os.utime(filn, None)
+        except OSError:
+            pass
+        return ImageInfo(*data['info'])
+
+    @staticmethod
+    def save(url, info, etag=None, last_modified=None):
+        """
+        Store the ImageInfo of url, checked just now, with the ETag and
+        Last-Modified headers of the response in the cache folder.
+        """
+        validators = (time.time(), etag, last_modified)
+        ImageCache.validators[url] = validators
+        if ImageCache.disk_limit() <= 0:
+            return
+        filn = ImageCache.cache_file(url)
+        data = {
+            'version': ImageCache.Version,
+            'url': url,
+            'info': tuple(info),
+            'validators': validators,
+        }
+        try:
+            os.makedirs(os.path.dirname(filn), exist_ok=True)
+            tmp = filn + '.tmp'
+            with open(tmp, mode='wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, filn)
+        except OSError as e:
+            Log.warning('could not cache image: {}', e)
+            return
+        ImageCache.evict()
+
+    @staticmethod
+    def evict():
+        """
+        Remove the least recently used files from the cache folder until it
+        fits into the image_cache_size setting.
+        """
+        folder = ImageCache.cache_folder()
+        files = []
+        total = 0
+        try:
+            for name in os.listdir(folder):
+                filn = os.path.join(folder, name)
+                st = os.stat(filn)
+                files.append((st.st_mtime, st.st_size, filn))
+                total += st.st_size
+        except OSError:
+            return
+        limit = ImageCache.disk_limit()
+        for mtime, size, filn in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.remove(filn)
+            except OSError:
+                continue
+            total -= size
+
+
+class ImageHandler:
+    """
+    Static class to bundle image handling.
+    """
+
+    Phantoms = {}   # view id -> sublime.PhantomSet
+
+    # images probed or downloaded at the same time
+    Workers = 16
+
+    @staticmethod
+    def show_images(view, edit, max_width=1024):
+        """
+        markup.underline.link.image.markdown
+        All images are probed, and remote ones downloaded, at the same time;
+        then their phantoms are added in one go.
+        """
+        global DISTRACTION_FREE_MODE_ACTIVE
+        global VIEWS_WITH_IMAGES
+        folder = get_path_for(view)
+        if not folder:
+            return
+        img_regs = view.find_by_selector('markup.underline.link.image.markdown')
+        sources = [view.substr(region) for region in img_regs]
+        infos = ImageHandler.probe_all(folder, sources)
+
+        settings = sublime.load_settings('Distraction Free.sublime-settings')
+        wrap_width = settings.get('wrap_width', 80)
+        centered = settings.get('draw_centered', True) \
+            and DISTRACTION_FREE_MODE_ACTIVE[view.window().id()]
+        phantoms = []
+        shift = 0   # spaces inserted before the current region
+        for region, rel_p, info in zip(img_regs, sources, infos):
+            if not info:
+                continue
+            region = sublime.Region(region.a + shift, region.b + shift)
+            if rel_p.startswith('http'):
+                FMT = u'''
+                    <img src="data:image/{}" class="centerImage" {}>
+                '''
+                img = info.type + ";base64," + info.data
+            else:
+                FMT = '''
+                    <img src="file://{}" class="centerImage" {}>
+                '''
+                img = os.path.join(folder, rel_p)
+            w, h = info.width, info.height
+            line_region = view.line(region)
+            imgattr = ImageHandler.check_imgattr(view, line_region, region)
+            if not imgattr:
+                if w > max_width:
+                    m = max_width / w
+                    h *= m
+                    w = max_width
+                imgattr = 'width="{}" height="{}"'.format(w, h)
+
+            html_img = FMT.format(img, imgattr)
+            if centered:
+                line_len = line_region.size()
+                spaces = max(0, wrap_width - line_len - 1)
+                view.insert(edit, region.b, ' ' * spaces)
+                shift += spaces
+                phantoms.append(sublime.Phantom(
+                    sublime.Region(line_region.b + spaces,
+                                   line_region.b + spaces),
+                    html_img,
+                    sublime.LAYOUT_BELOW))
+            else:
+                phantoms.append(sublime.Phantom(region, html_img,
+                                                sublime.LAYOUT_BLOCK))
+        phantom_set = ImageHandler.Phantoms.get(view.id())
+        if phantom_set is None:
+            phantom_set = sublime.PhantomSet(view, 'zk_images')
+            ImageHandler.Phantoms[view.id()] = phantom_set
+        phantom_set.update(phantoms)
+        VIEWS_WITH_IMAGES.add(view.id())
+
+    @staticmethod
+    def probe_all(folder, sources):
+        """
+        Return the ImageInfo, or None, of each image link in sources. Local
+        images are probed and remote ones downloaded on a pool of threads,
+        each of them once.
+        """
+        def probe(rel_p):
+            if rel_p.startswith('http'):
+                return ImageCache.remote(rel_p)
+            return ImageCache.local(os.path.join(folder, rel_p))
+
+        unique = list(OrderedDict.fromkeys(sources))
+        if len(unique) < 2:
+            infos = [probe(rel_p) for rel_p in unique]
+        else:
+            workers = min(ImageHandler.Workers, len(unique))
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                infos = list(executor.map(probe, unique))
+        info_of = dict(zip(unique, infos))
+        return [info_of[rel_p] for rel_p in sources]
+
+    @staticmethod
+    def check_imgattr(view, line_region, link_region=None):
+        # find attrs for this link
+        full_line = view.substr(line_region)
+        link_till_eol = full_line[link_region.a - line_region.a:]
+        # find attr if present
+        m = re.match(r'.*\)\{(.*)\}', link_till_eol)
+        if m:
+            return m.groups()[0]
+
+    @staticmethod
+    def hide_images(view, edit):
+        """
+        Hide all imgs and strip the spaces inserted to center them.
+        """
+        phantom_set = ImageHandler.Phantoms.pop(view.id(), None)
+        if phantom_set is not None:
+            phantom_set.update([])
+        img_regs = view.find_by_selector('markup.underline.link.image.markdown')
+        lines = OrderedDict()
+        for region in img_regs:
+            line_region = view.line(region)
+            lines[line_region.a] = line_region
+        # back to front, so the replacements don't move the lines still to do
+        for line_region in reversed(list(lines.values())):
+            line_str = view.substr(line_region)
+            if line_str.strip() != line_str:
+                view.replace(edit, line_region, line_str.strip())
+        VIEWS_WITH_IMAGES.discard(view.id())
+
+    @staticmethod
+    def get_image_size(img):
+        """
+        Determine the image type of img, a file name or a binary file object,
+        and return its size.
+        """
+        if isinstance(img, str):
+            with open(img, 'rb') as f:
+                return ImageHandler.get_image_size(f)
+        f = img
+        head = f.read(32)
+        ttype = None
+        what = imghdr.what(None, head)
+
+        # print('head:\n', repr(head))
+        if len(head) < 24:
+            return
+        if what == 'png':
+            ttype = "png"
+            check = struct.unpack('>i', head[4:8])[0]
+            if check != 0x0d0a1a0a:
+                return
+            width, height = struct.unpack('>ii', head[16:24])
+        elif what == 'gif':
+            ttype = "gif"
+            width, height = struct.unpack('<HH', head[6:10])
+        elif what == 'jpeg':
+            ttype = "jpeg"
+            try:
+                f.seek(0)  # Read 0xff next
+                size = 2
+                ftype = 0
+                while not 0xc0 <= ftype <= 0xcf:
+                    f.seek(size, 1)
+                    byte = f.read(1)
+                    while ord(byte) == 0xff:
+                        byte = f.read(1)
+                    ftype = ord(byte)
+                    size = struct.unpack('>H', f.read(2))[0] - 2
+                # SOFn block
+                f.seek(1, 1)  # skip precision byte.
+                height, width = struct.unpack('>HH', f.read(4))
+            except Exception:
+                return
+        else:
+            return
+        return width, height, ttype
+
+
+class Autobib:
+    """
+    Static class to group all auto-bibliography functions.
+    """
+    citekey_matcher = re.compile('^@.*{([^,]*)[,]?')
+    field_matcher = re.compile(r'^\s*(author|title|year)\s*=\s*(.*)',
+                               re.IGNORECASE)
+
+    local_bibfiles = {}     # folder -> (folder mtime, bib file or None)
+
+    # pandoc runs at the same time when creating a bibliography
+    Pandoc_Workers = 4
+    # marks the end of each entry in batched pandoc output
+    Batch_Separator = 'zkbibseparator'
+
+    @staticmethod
+    def look_for_bibfile(view, settings):
+        """
+        Look for a bib file in the view's folder.
+        If no bib file there, then query the setting.
+        """
+        folder = get_path_for(view)
+        if folder:
+            bibfile = Autobib.local_bibfile(folder)
+            if bibfile:
+                return bibfile
+        # try the setting
+        bibfile = settings.get('bibfile', None)
+        if bibfile:
+            if os.path.exists(bibfile):
+                Log.info('using global bibfile {}', bibfile)
+                return bibfile
+            else:
+                Log.warning('bibfile not found: {}', bibfile)
+                return None
+
+    @staticmethod
+    def local_bibfile(folder):
+        """
+        Return the first bib file in folder, or None. The folder is only
+        globbed again when its mtime has changed.
+        """
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return None
+        cached = Autobib.local_bibfiles.get(folder)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        bibs = glob.glob(os.path.join(folder, '*.bib'))
+        bibfile = bibs[0] if bibs else None
+        if bibfile:
+            Log.info('using local bibfile {}', bibfile)
+        Autobib.local_bibfiles[folder] = (mtime, bibfile)
+        return bibfile
+
+    @staticmethod
+    def extract_all_citekeys(bibfile):
+        """
+        Return all citekeys of the bibfile, from the BibIndex.
+        """
+        if not os.path.exists(bibfile):
+            Log.warning('bibfile not found: {}', bibfile)
+            return []
+        return BibIndex.for_file(bibfile).citekeys
+
+    @staticmethod
+    def extract_all_entries(bibfile):
+        """
+        Return dict: {citekey: {title, authors, year}}, from the BibIndex.
+        """
+        if not os.path.exists(bibfile):
+            Log.warning('bibfile not found: {}', bibfile)
+            return {}
+        return BibIndex.for_file(bibfile).entries
+
+    @staticmethod
+    def parse_bibfile(bibfile):
+        """
+        Parse the bibfile in one pass.
+        Return (citekeys, entries) with entries as
+        {citekey: {'title': ..., 'authors': ..., 'year': ...}}.
+        """
+        citekeys = set()
+        entries = {}
+        current_citekey = None
+        with open(bibfile, mode='r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.endswith(','):
+                    line = line[:-1]
+                if line.startswith('@'):
+                    match = Autobib.citekey_matcher.findall(line)
+                    if match:
+                        current_citekey = match[0]
+                        citekeys.add(current_citekey)
+                        continue
+                match = Autobib.field_matcher.match(line)
+                if not match:
+                    continue
+                field, value = match.groups()
+                field = field.lower()
+                if field == 'author':
+                    field = 'authors'
+                    value = Autobib.parse_authors(value)
+                else:
+                    value = Autobib.remove_latex_commands(value)
+                entry = entries.get(current_citekey)
+                if entry is None:
+                    entry = {'title': '', 'authors': '', 'year': ''}
+                    entries[current_citekey] = entry
+                entry[field] = value
+        return citekeys, entries
+
+    @staticmethod
+    def parse_authors(line):
+        line = Autobib.remove_latex_commands(line)
+        authors = line.split(' and')
+        author_tuples = []
+        for author in authors:
+            first = ''
+            last = author.strip()
+            if ',' in author:
+                last, first = [x.strip() for x in author.split(',')][:2]
+            author_tuples.append((last, first))
+        if len(author_tuples) > 2:
+            authors = '{} et al.'.format(author_tuples[0][0])  # last et al
+        else:
+            authors = ' & '.join(x[0] for x in author_tuples)
+        return authors
+
+    @staticmethod
+    def remove_latex_commands(s):
+        """
+        Simple function to remove any LaTeX commands or brackets from the string,
+        replacing it with its contents.
+        """
+        chars = []
+        FOUND_SLASH = False
+
+        for c in s:
+            if c == '{':
+                # i.e., we are entering the contents of the command
+                if FOUND_SLASH:
+                    FOUND_SLASH = False
+            elif c == '}':
+                pass
+            elif c == '\\':
+                FOUND_SLASH = True
+            elif not FOUND_SLASH:
+                chars.append(c)
+            elif c.isspace():
+                FOUND_SLASH = False
+
+        return ''.join(chars)
+
+    @staticmethod
+    def find_citations(text, citekeys):
+        """
+        Find all mentioned citekeys in text
+        """
+        citekeys = set(citekeys)
+        founds = set()
+        for kind, start, end, citekey in Tokenizer.tokenize(text):
+            if citekey not in citekeys:
+                continue
+            if kind == 'citekey':
+                founds.add('@' + citekey)
+            elif kind == 'mmd_citekey':
+                founds.add('#' + citekey)
+        return founds
+
+    @staticmethod
+    def create_bibliography(text, bibfile, pandoc='pandoc', batched=True):
+        """
+        Create a bibliography for all citations in text in form of a dictionary.
+        Unless batched is False, the citekeys are rendered in a few batches
+        instead of one pandoc run per citekey.
+        """
+        citekeys = Autobib.extract_all_citekeys(bibfile)
+        if not citekeys:
+            return {}
+        citekeys = sorted(Autobib.find_citations(text, citekeys))
+        if not citekeys:
+            return {}
+        if batched:
+            batches = Autobib.batches_of(citekeys,
+                                         Autobib.extract_all_entries(bibfile))
+        else:
+            batches = [[citekey] for citekey in citekeys]
+        citekey2bib = {}
+        workers = min(Autobib.Pandoc_Workers, len(batches))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for result in executor.map(
+                    lambda batch: Autobib.bibliography_of_batch(
+                        pandoc, bibfile, batch), batches):
+                citekey2bib.update(result)
+        return citekey2bib
+
+    @staticmethod
+    def batches_of(citekeys, entries):
+        """
+        Split citekeys into batches that can be rendered by one pandoc run
+        each, without changing the output per citekey: entries by the same
+        author are rendered differently when they are in one bibliography
+        (e.g. `———.` for the same author, 2000a and 2000b), so they go to
+        different batches.
+        """
+        batches = []    # [(citekeys, first authors)]
+        for citekey in citekeys:
+            entry = entries.get(citekey[1:]) or {}
+            author = re.split(r' et al\.| & ', entry.get('authors', ''))[0]
+            for batch, authors in batches:
+                if author not in authors:
+                    break
+            else:
+                batch, authors = [], set()
+                batches.append((batch, authors))
+            batch.append(citekey)
+            authors.add(author)
+        return [batch for batch, authors in batches]
+
+    @staticmethod
+    def bibliography_of(pandoc, bibfile, citekey):
+        """
+        Return the bib entry of a single `@citekey` or `#citekey`.
+        """
+        pandoc_input = citekey.replace('#', '@', 1)
+        pandoc_out = Autobib.run(pandoc, bibfile, pandoc_input)
+        citation, bib = Autobib.parse_pandoc_out(pandoc_out)
+        return bib
+
+    @staticmethod
+    def bibliography_of_batch(pandoc, bibfile, citekeys):
+        """
+        Return {citekey: bib entry} for a batch of citekeys, with two pandoc
+        runs: one renders the citations into pandoc's JSON AST where each
+        entry is a `ref-<citekey>` Div; the other renders the entries,
+        separated by a marker paragraph, to plain text.
+        Citekeys whose entries can't be told apart reliably are rendered one
+        by one.
+        """
+        citekey2bib = {}
+        if len(citekeys) > 1:
+            pandoc_input = '\n\n'.join('@' + citekey[1:]
+                                       for citekey in citekeys)
+            refs = {}
+            try:
+                doc = json.loads(Autobib.run(pandoc, bibfile, pandoc_input,
+                                             fmt_to='json'))
+                Autobib.refs_in(doc['blocks'], refs)
+            except (ValueError, KeyError, TypeError):
+                doc = None
+            found = [citekey for citekey in citekeys if citekey[1:] in refs]
+            if found:
+                separator = {'t': 'Para',
+                             'c': [{'t': 'Str', 'c': Autobib.Batch_Separator}]}
+                blocks = []
+                for citekey in found:
+                    blocks.extend(refs[citekey[1:]])
+                    blocks.append(separator)
+                doc = {'pandoc-api-version': doc['pandoc-api-version'],
+                       'meta': {}, 'blocks': blocks}
+                pandoc_out = Autobib.run(pandoc, None, json.dumps(doc),
+                                         fmt_from='json')
+                chunks = re.split('^' + Autobib.Batch_Separator + '$',
+                                  pandoc_out, flags=re.MULTILINE)
+                if len(chunks) == len(found) + 1:
+                    for citekey, chunk in zip(found, chunks):
+                        paragraphs = chunk.strip('\n').split('\n\n')
+                        if not paragraphs[0]:
+                            continue
+                        # as split off the end of a single citekey's output
+                        bib = paragraphs[0]
+                        if len(paragraphs) == 1:
+                            bib += '\n'
+                        citekey2bib[citekey] = bib.replace('\n', ' ')
+        for citekey in citekeys:
+            if citekey not in citekey2bib:
+                citekey2bib[citekey] = Autobib.bibliography_of(
+                    pandoc, bibfile, citekey)
+        return citekey2bib
+
+    @staticmethod
+    def refs_in(blocks, refs):
+        """
+        Collect the blocks of all `ref-<citekey>` Divs in pandoc JSON blocks
+        into refs: {citekey: blocks}.
+        """
+        for block in blocks:
+            if not isinstance(block, dict) or block.get('t') != 'Div':
+                continue
+            (ident, classes, attributes), content = block['c']
+            if ident.startswith('ref-'):
+                refs[ident[4:]] = content
+            else:
+                Autobib.refs_in(content, refs)
+        return refs
+
+    @staticmethod
+    def parse_pandoc_out(pandoc_out):
+        """
+        Splits pandoc output into citation and bib part
+        """
+        # print('pandoc_out:', repr(pandoc_out))
+        pdsplit = pandoc_out.split('\n\n')
+        citation = '(no citation generated)'
+        bib = '(no bib generated)'
+        if len(pdsplit) >= 1:
+            citation = pdsplit[0]
+        if len(pdsplit) >= 2:
+            bib = pdsplit[1]
+        citation = citation.replace('\n', ' ')
+        bib = bib.replace('\n', ' ')
+        return citation, bib
+
+    @staticmethod
+    @Stats.timed('pandoc run')
+    def run(pandoc_bin, bibfile, stdin, fmt_from=None, fmt_to='plain'):
+        args = [pandoc_bin, '-t', fmt_to]
+        if fmt_from:
+            args.extend(['-f', fmt_from])
+        if bibfile:
+            args.extend(['--bibliography', bibfile])
+        # using universal_newlines here gets us into decoding troubles as the
+        # encoding then is guessed and can be ascii which can't deal with
+        # unicode characters. hence, we handle \r ourselves
+        p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate(bytes(stdin, 'utf-8'))
+        # make me windows-safe
+        stdout = stdout.decode('utf-8', errors='ignore').replace('\r', '')
+        stderr = stderr.decode('utf-8', errors='ignore').replace('\r', '')
+        # print('pandoc says:', stderr)
+        return stdout
+
+
+class BibIndex:
+    """
+    Cache of the parsed citekeys and entries of a bib file, shared by the
+    completions, the citation picker and the auto-bibliography.
+
+    The cache is validated with the bib file's (mtime, size). When the bib
+    file has changed, the old data is served while the file is parsed again
+    in the background. Parsed bib files are pickled into Sublime's cache
+    folder, so big bib files aren't parsed again after a restart.
+    """
+    Version = 1
+
+    indexes = {}    # bib file -> BibIndex
+    lock = threading.Lock()
+
+    def __init__(self, bibfile):
+        self.bibfile = bibfile
+        self.fingerprint = None     # (mtime, size) of the parsed bib file
+        self.citekeys = set()
+        self.entries = {}
+        self.sorted_citekeys = None     # sorted [(lowercase key, key)]
+        self.rebuild_pending = False
+
+    @staticmethod
+    def for_file(bibfile):
+        """
+        Return the index of bibfile, parsing it or loading it from the cache
+        on first use.
+        """
+        bibfile = os.path.abspath(bibfile)
+        with BibIndex.lock:
+            index = BibIndex.indexes.get(bibfile)
+            if index is None:
+                index = BibIndex(bibfile)
+                BibIndex.indexes[bibfile] = index
+        index.validate()
+        return index
+
+    @staticmethod
+    def fingerprint_of(bibfile):
+        try:
+            st = os.stat(bibfile)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def validate(self):
+        fingerprint = BibIndex.fingerprint_of(self.bibfile)
+        if fingerprint == self.fingerprint:
+            return
+        if self.fingerprint is None:
+            # nothing to serve yet
+            if not self.load(fingerprint):
+                self.rebuild()
+        else:
+            self.rebuild_async()
+
+    def citekeys_with_prefix(self, prefix, limit=None):
+        """
+        Return the citekeys starting with prefix, ignoring case.
+        """
+        with BibIndex.lock:
+            if self.sorted_citekeys is None:
+                self.sorted_citekeys = sorted((citekey.lower(), citekey)
+                                              for citekey in self.citekeys)
+            keys = self.sorted_citekeys
+        prefix = prefix.lower()
+        i = bisect.bisect_left(keys, (prefix,))
+        result = []
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            result.append(keys[i][1])
+            if limit and len(result) >= limit:
+                break
+            i += 1
+        return result
+
+    def rebuild(self):
+        """
+        Parse the bib file and update the cache.
+        """
+        # take the fingerprint first: changes while parsing cause another run
+        fingerprint = BibIndex.fingerprint_of(self.bibfile)
+        try:
+            citekeys, entries = Autobib.parse_bibfile(self.bibfile)
+        except (OSError, UnicodeDecodeError) as e:
+            Log.error('could not parse bibfile: {}', e)
+            citekeys, entries = set(), {}
+        with BibIndex.lock:
+            self.citekeys = citekeys
+            self.entries = entries
+            self.sorted_citekeys = None
+            self.fingerprint = fingerprint
+        self.save()
+
+    def rebuild_async(self):
+        """
+        Parse the bib file in the background unless that's already pending.
+        """
+        if self.rebuild_pending:
+            return
+        self.rebuild_pending = True
+
+        def do_rebuild():
+            try:
+                self.rebuild()
+            finally:
+                self.rebuild_pending = False
+        sublime.set_timeout_async(do_rebuild, 0)
+
+    def cache_file(self):
+        name = hashlib.md5(self.bibfile.encode('utf-8')).hexdigest()
+        return os.path.join(sublime.cache_path(), 'sublime_zk',
+                            name + '.bibcache')
+
+    def load(self, fingerprint):
+        """
+        Load the pickled copy if it matches fingerprint. Return success.
+        """
+        if not get_settings().get('cache_bibfile', True):
+            return False
+        if fingerprint is None:
+            return False
+        try:
+            with open(self.cache_file(), mode='rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # missing or unreadable: parse again
+            return False
+        if (data.get('version') != BibIndex.Version
+                or data.get('bibfile') != self.bibfile
+                or data.get('fingerprint') != fingerprint):
+            return False
+        with BibIndex.lock:
+            self.citekeys = data['citekeys']
+            self.entries = data['entries']
+            self.sorted_citekeys = None
+            self.fingerprint = fingerprint
+        return True
+
+    def save(self):
+        """
+        Pickle the parsed bib file into the cache folder.
+        """
+        if not get_settings().get('cache_bibfile', True):
+            return
+        if self.fingerprint is None:
+            return
+        with BibIndex.lock:
+            data = {
+                'version': BibIndex.Version,
+                'bibfile': self.bibfile,
+                'fingerprint': self.fingerprint,
+                'citekeys': self.citekeys,
+                'entries': self.entries,
+            }
+        filn = self.cache_file()
+        try:
+            os.makedirs(os.path.dirname(filn), exist_ok=True)
+            with open(filn + '.tmp', mode='wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(filn + '.tmp', filn)
+        except OSError as e:
+            Log.error('could not save bibfile cache: {}', e)
+
+
+class SearchJob:
+    """
+    A search running on a worker thread.
+
+    Only one search runs at a time: starting a new one cancels the one
+    before and kills its external search process. The result is handed to
+    on_done on the UI thread, unless the search was cancelled. While the
+    search runs, its progress is shown in the status bar.
+    """
+    current = None
+    lock = threading.Lock()
+    local = threading.local()   # .job: the job of a worker thread
+
+    Progress_Interval = 100     # ms
+    Progress_Width = 8
+
+    def __init__(self, title, search, on_done):
+        self.title = title
+        self.search = search
+        self.on_done = on_done
+        self.cancelled = False
+        self.finished = False
+        self.processes = []
+        self.started = time.time()
+
+    @staticmethod
+    def start(title, search, on_done):
+        """
+        Run search() on a worker thread and call on_done(result) on the UI
+        thread when it's done. Cancels the search that's still running.
+        """
+        job = SearchJob(title, search, on_done)
+        with SearchJob.lock:
+            previous = SearchJob.current
+            SearchJob.current = job
+        if previous is not None:
+            previous.cancel()
+        threading.Thread(target=job.run, daemon=True).start()
+        job.show_progress(0)
+        return job
+
+    @staticmethod
+    def current_job():
+        """
+        Return the job the calling worker thread runs, if any.
+        """
+        return getattr(SearchJob.local, 'job', None)
+
+    def run(self):
+        SearchJob.local.job = self
+        try:
+            result = self.search()
+        except Exception as e:
+            Log.error('search failed: {}: {}', self.title, e)
+            self.cancelled = True
+        finally:
+            self.finished = True
+            SearchJob.local.job = None
+            with SearchJob.lock:
+                if SearchJob.current is self:
+                    SearchJob.current = None
+        if self.cancelled:
+            sublime.set_timeout(lambda: sublime.status_message(''), 0)
+            return
+        sublime.set_timeout(lambda: self.done(result), 0)
 
-    @staticmethod
-    def parse_pandoc_out(pandoc_out):
+    def done(self, result):
+        if self.cancelled:
+            return
+        sublime.status_message('')
+        self.on_done(result)
+
+    def cancel(self):
         """
-        Splits pandoc output into citation and bib part
+        Cancel the job: kill its processes and drop its result.
         """
-        # print('pandoc_out:', repr(pandoc_out))
-        pdsplit = pandoc_out.split('\n\n')
-        citation = '(no citation generated)'
-        bib = '(no bib generated)'
-        if len(pdsplit) >= 1:
-            citation = pdsplit[0]
-        if len(pdsplit) >= 2:
-            bib = pdsplit[1]
-        citation = citation.replace('\n', ' ')
-        bib = bib.replace('\n', ' ')
-        return citation, bib
-
-    @staticmethod
-    def run(pandoc_bin, bibfile, stdin):
-        args = [pandoc_bin, '-t', 'plain', '--bibliography', bibfile]
-        # using universal_newlines here gets us into decoding troubles as the
-        # encoding then is guessed and can be ascii which can't deal with
-        # unicode characters. hence, we handle \r ourselves
-        p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate(bytes(stdin, 'utf-8'))
-        # make me windows-safe
-        stdout = stdout.decode('utf-8', errors='ignore').replace('\r', '')
-        stderr = stderr.decode('utf-8', errors='ignore').replace('\r', '')
-        # print('pandoc says:', stderr)
-        return stdout
+        self.cancelled = True
+        for process in list(self.processes):
+            try:
+                process.kill()
+            except OSError:
+                pass    # already gone
+
+    def add_process(self, process):
+        self.processes.append(process)
+        if self.cancelled:
+            process.kill()
+
+    def show_progress(self, tick):
+        if self.finished or self.cancelled:
+            return
+        width = SearchJob.Progress_Width
+        pos = tick % (2 * width - 2)
+        if pos >= width:
+            pos = 2 * width - 2 - pos
+        bar = ' ' * pos + '=' + ' ' * (width - 1 - pos)
+        sublime.status_message('{} [{}] {}s'.format(
+            self.title, bar, int(time.time() - self.started)))
+        sublime.set_timeout(lambda: self.show_progress(tick + 1),
+                            SearchJob.Progress_Interval)
 
 
 class ExternalSearch:
     """
     Static class to group all external search related functions.
+
+    Searches run through a SearchBackend: ag, rg or pure Python, chosen by
+    the search_backend setting.
     """
-    SEARCH_COMMAND = 'ag'
     EXTERNALIZE = '.search_results.zkr'   # '' to skip
 
+    backend = None          # the SearchBackend searches run through
+    backend_choice = None   # the search_backend setting it was selected for
+
+    # searched for when timing the backends
+    Benchmark_Pattern = 'zk-search-backend-benchmark'
+
+    @staticmethod
+    def select_backend():
+        """
+        Select the search backend as configured by the search_backend
+        setting. With "auto", the first available of rg and ag is used
+        right away, and the faster of the two, if both are there, after a
+        quick benchmark in the background. Without either of them, the pure
+        Python backend is used.
+        """
+        global F_EXT_SEARCH
+        choice = get_settings().get('search_backend', 'auto')
+        ExternalSearch.backend_choice = choice
+        backends = [cls.find() for cls in (RgBackend, AgBackend)]
+        backends = [backend for backend in backends if backend]
+        if choice != 'auto':
+            backends = [backend for backend in backends
+                        if backend.name == choice]
+            if not backends and choice != PythonBackend.name:
+                Log.warning('search backend not found: {}', choice)
+        backend = backends[0] if backends else PythonBackend()
+        ExternalSearch.backend = backend
+        F_EXT_SEARCH = backend.is_external()
+        Log.info('using {} for searches {}', backend.name,
+                 backend.command or '')
+        if choice == 'auto' and len(backends) > 1:
+            sublime.set_timeout_async(
+                lambda: ExternalSearch.benchmark_backends(backends), 0)
+
+    @staticmethod
+    def get_backend():
+        if ExternalSearch.backend is None:
+            ExternalSearch.select_backend()
+        return ExternalSearch.backend
+
     @staticmethod
-    def search_all_tags(folder, extension):
+    def benchmark_backends(backends):
+        """
+        Time a search with each backend in the archive of the first window
+        with one, and use the fastest backend.
+        """
+        folder = None
+        for window in sublime.windows():
+            folder = get_path_for_window(window)
+            if folder:
+                break
+        if not folder:
+            return
+        extension = get_settings().get('wiki_extension')
+        timings = []
+        for backend in backends:
+            # best of two, so file system caches don't favour the second
+            best = None
+            for i in range(2):
+                start = time.time()
+                backend.search_in(folder, ExternalSearch.Benchmark_Pattern,
+                                  extension)
+                duration = time.time() - start
+                if best is None or duration < best:
+                    best = duration
+            timings.append((best, backend))
+        if ExternalSearch.backend_choice != 'auto':
+            return      # changed in the meantime
+        best, backend = min(timings, key=itemgetter(0))
+        ExternalSearch.backend = backend
+        Log.info('search backend benchmark: {} -> using {}', ', '.join(
+            '{} {:.3f}s'.format(b.name, t) for t, b in timings), backend.name)
+
+    @staticmethod
+    def search_all_tags(folder, extension, externalize=True):
         """
         Create a list of all #tags of all notes in folder.
         """
-        output = ExternalSearch.search_in(folder, ZkConstants.RE_TAGS(),
-                                          extension, tags=True)
-        tags = set()
-        for line in output.split('\n'):
-            if line:
-                tags.add(line)
-        if ExternalSearch.EXTERNALIZE:
+        tags = ExternalSearch.get_backend().all_tags(folder, extension)
+        if externalize and ExternalSearch.EXTERNALIZE:
             with open(ExternalSearch.external_file(folder), mode='w',
                       encoding='utf-8') as f:
                 f.write('# All Tags\n\n')
@@ -677,35 +3259,10 @@ class ExternalSearch:
         """
         Return a dict {note_id: tags}.
         """
-        args = [ExternalSearch.SEARCH_COMMAND, '--nocolor', '--ackmate']
-        args.extend(['--nonumbers', '-o', '--silent', '-G', '.*\\' + extension,
-                     ZkConstants.RE_TAGS(), folder])
-        ag_out = ExternalSearch.run(args, folder)
-        if not ag_out:
-            return {}
         note_tags = defaultdict(list)
-        note_id = None
-
-        lines = deque(ag_out.split('\n'))
-        lindex = 0
-        num_lines = len(lines)
-
-        while lines:
-            line = lines.popleft()
-            if not line.startswith(':'):
-                continue
-            note_id = get_note_id_of_file(line[1:])
-            line = lines.popleft()
-            while line:  # until newline
-                # parse findspec
-                positions, txt_line = line.split(':', 1)
-                for position in positions.split(','):
-                    start, width = position.split()
-                    start = int(start)
-                    width = int(width)
-                    tag = txt_line[start:start + width]
-                    note_tags[note_id].append(tag.strip())
-                line = lines.popleft()
+        for note_id, tags in ExternalSearch.get_backend().iter_notes_and_tags(
+                folder, extension):
+            note_tags[note_id].extend(tags)
         return note_tags
 
     @staticmethod
@@ -720,20 +3277,6 @@ class ExternalSearch:
                 output, folder, extension, prefix)
         return output.split('\n')
 
-    @staticmethod
-    def search_friend_notes(folder, extension, note_id):
-        """
-        Return a list of notes referencing note_id.
-        """
-        regexp = '(\[' + note_id + ')|(§' + note_id + ')'   # don't insist on ]
-        output = ExternalSearch.search_in(folder, regexp, extension)
-        link_prefix, link_postfix = get_link_pre_postfix()
-        prefix = 'Notes referencing {}{}{}:'.format(link_prefix, note_id,
-                                                    link_postfix)
-        ExternalSearch.externalize_note_links(output, folder, extension,
-                                              prefix)
-        return output.split('\n')
-
     @staticmethod
     def search_in(folder, regexp, extension, tags=False):
         """
@@ -742,38 +3285,93 @@ class ExternalSearch:
         tags == True : only matching words are returned.
         tags == False: only names of files with matches are returned.
         """
-        args = [ExternalSearch.SEARCH_COMMAND, '--nocolor']
-        if tags:
-            args.extend(['--nofilename', '--nonumbers', '--only-matching'])
-        else:
-            args.extend(['-l', '--ackmate'])
-        args.extend(['--silent', '-G', '.*\\' + extension, regexp, folder])
-        return ExternalSearch.run(args, folder)
+        return ExternalSearch.get_backend().search_in(folder, regexp,
+                                                      extension, tags)
 
     @staticmethod
+    @Stats.timed('search run')
     def run(args, folder):
         """
         Execute ag to run a search, handle errors & timeouts.
         Return output of stdout as string.
+        Run from a SearchJob, the search is killed when the job is cancelled.
         """
         output = b''
-        verbose = False
-        if verbose or True:
-            print('cmd:', ' '.join(args))
+        Log.debug('cmd: {}', args)
+        timeout = get_settings().get('search_timeout', 30) or None
+        job = SearchJob.current_job()
+        p = Popen(args, stdout=PIPE, stderr=PIPE)
+        if job:
+            job.add_process(p)
         try:
-            output = subprocess.check_output(args, shell=False, timeout=10000)
-        except subprocess.CalledProcessError as e:
-            print('sublime_zk: search unsuccessful:')
-            print(e.returncode)
-            print(e.cmd)
-            for line in e.output.decode('utf-8', errors='ignore').split('\n'):
-                print('    ', line)
+            stdout, stderr = p.communicate(timeout=timeout)
         except subprocess.TimeoutExpired:
-            print('sublime_zk: search timed out:', ' '.join(args))
-        if verbose:
-            print(output.decode('utf-8', errors='ignore'))
+            p.kill()
+            p.communicate()
+            Log.warning('search timed out: {}', args)
+            sublime.status_message('Search timed out after {}s'.format(timeout))
+        else:
+            if not p.returncode:
+                output = stdout
+            elif not ExternalSearch.no_matches(p.returncode) \
+                    and not (job and job.cancelled):
+                Log.warning('search unsuccessful, exit code {}: {}\n{}',
+                            p.returncode, args,
+                            stderr.decode('utf-8', errors='ignore'))
         return output.decode('utf-8', errors='ignore').replace('\r', '')
 
+    @staticmethod
+    def no_matches(returncode):
+        """
+        ag and rg exit with 1 if nothing was found: that's not an error.
+        """
+        return returncode == 1
+
+    @staticmethod
+    def stream(args):
+        """
+        Execute ag to run a search and yield its output line by line while
+        it's running. Errors & timeouts are handled as in run().
+        """
+        Log.debug('cmd: {}', args)
+        start = time.perf_counter()
+        timeout = get_settings().get('search_timeout', 30) or None
+        job = SearchJob.current_job()
+        p = Popen(args, stdout=PIPE)
+        if job:
+            job.add_process(p)
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            p.kill()
+        watchdog = None
+        if timeout:
+            watchdog = threading.Timer(timeout, kill)
+            watchdog.daemon = True
+            watchdog.start()
+        complete = False
+        try:
+            for line in p.stdout:
+                yield line.decode('utf-8', errors='ignore').replace(
+                    '\r', '').rstrip('\n')
+            complete = True
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if not complete:
+                p.kill()    # the caller stopped early
+            p.stdout.close()
+            p.wait()
+            Stats.record('search stream', time.perf_counter() - start)
+        if timed_out:
+            Log.warning('search timed out: {}', args)
+            sublime.status_message('Search timed out after {}s'.format(timeout))
+        elif p.returncode and not ExternalSearch.no_matches(p.returncode) \
+                and not (job and job.cancelled):
+            Log.warning('search unsuccessful, exit code {}: {}',
+                        p.returncode, args)
+
     @staticmethod
     def externalize_note_links(ag_out, folder, extension, prefix=None):
         """
@@ -847,6 +3445,414 @@ class ExternalSearch:
             window.focus_group(0)
 
 
+class SearchBackend:
+    """
+    A way to search the note archive. All searches of ExternalSearch run
+    through one of them:
+
+    * search_in(): search for a regexp; return the names of the files with
+      matches, or with tags=True the matches, one per line
+    * all_tags(): return the set of all tags
+    * iter_notes_and_tags(): yield (note_id, tags) of all notes with tags
+
+    Regexps passed to search_in() are tags or simple patterns that mean the
+    same to all backends.
+    """
+    name = None
+    path_setting = None     # setting with the fall-back path of the command
+
+    def __init__(self, command=None):
+        self.command = command
+
+    @classmethod
+    def find(cls):
+        """
+        Return the backend if its command can be found, else None.
+        """
+        command = shutil.which(cls.name)
+        if not command and cls.path_setting:
+            path = get_settings().get(cls.path_setting)
+            if path and shutil.which(path):
+                command = path
+        if command:
+            return cls(command)
+
+    def is_external(self):
+        return self.command is not None
+
+
+class AgBackend(SearchBackend):
+    """
+    The Silver Searcher. Tags are parsed from its --ackmate output.
+    """
+    name = 'ag'
+    path_setting = 'path_to_ag'
+
+    def search_in(self, folder, regexp, extension, tags=False):
+        args = [self.command, '--nocolor']
+        if tags:
+            args.extend(['--nofilename', '--nonumbers', '--only-matching'])
+        else:
+            args.extend(['-l', '--ackmate'])
+        args.extend(['--silent', '-G', '.*\\' + extension, regexp, folder])
+        return ExternalSearch.run(args, folder)
+
+    def all_tags(self, folder, extension):
+        output = self.search_in(folder, ZkConstants.RE_TAGS(), extension,
+                                tags=True)
+        return set(line for line in output.split('\n') if line)
+
+    def iter_notes_and_tags(self, folder, extension):
+        """
+        Yield (note_id, tags) for every note with tags, while ag is still
+        searching. ag's --ackmate output is parsed as it comes in:
+
+            :path/to/note
+            start width,start width:line text
+            ...
+            (empty line)
+        """
+        args = [self.command, '--nocolor', '--ackmate']
+        args.extend(['--nonumbers', '-o', '--silent', '-G', '.*\\' + extension,
+                     ZkConstants.RE_TAGS(), folder])
+        note_id = None
+        tags = []
+        for line in ExternalSearch.stream(args):
+            if line.startswith(':'):
+                note_id = get_note_id_of_file(line[1:])
+                continue
+            if not line:
+                # end of the file's findspecs
+                if tags:
+                    yield note_id, tags
+                note_id = None
+                tags = []
+                continue
+            if note_id is None:
+                continue
+            # parse findspec
+            positions, txt_line = line.split(':', 1)
+            for position in positions.split(','):
+                start, width = position.split()
+                start = int(start)
+                width = int(width)
+                tag = txt_line[start:start + width]
+                tags.append(tag.strip())
+        if tags:
+            yield note_id, tags
+
+
+class RgBackend(SearchBackend):
+    """
+    ripgrep. Tags are taken from its --json output.
+    """
+    name = 'rg'
+    path_setting = 'path_to_rg'
+
+    @staticmethod
+    def tag_pattern():
+        """
+        RE_TAGS for rg's regex engine, which has no look-behinds: the blank
+        in front of a tag is part of the match and stripped off.
+        """
+        prefix = ''.join('\\' + c if c in '\\.+*?()|[]{}^$#&-~' else c
+                         for c in ZkConstants.TAG_PREFIX)
+        return r"(?:^|\s)" + prefix + r"+(?:[^" + prefix + \
+            r"""\s.,/!$%\^\&*;{}\[\]'"=`\~()<>”\\]|:[a-zA-Z0-9])+"""
+
+    def args(self, extension):
+        return [self.command, '--color', 'never', '--no-messages',
+                '-g', '*' + extension]
+
+    def search_in(self, folder, regexp, extension, tags=False):
+        args = self.args(extension)
+        if tags:
+            args.extend(['--no-filename', '--no-line-number',
+                         '--only-matching'])
+        else:
+            args.append('--files-with-matches')
+        args.extend(['-e', regexp, folder])
+        return ExternalSearch.run(args, folder)
+
+    def all_tags(self, folder, extension):
+        output = self.search_in(folder, RgBackend.tag_pattern(), extension,
+                                tags=True)
+        return set(line.strip() for line in output.split('\n')
+                   if line.strip())
+
+    def iter_notes_and_tags(self, folder, extension):
+        """
+        Yield (note_id, tags) for every note with tags, while rg is still
+        searching.
+        """
+        args = self.args(extension)
+        args.extend(['--json', '-e', RgBackend.tag_pattern(), folder])
+        tags = []
+        for line in ExternalSearch.stream(args):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            kind = message.get('type')
+            if kind == 'match':
+                for submatch in message['data']['submatches']:
+                    tag = submatch['match'].get('text', '').strip()
+                    if tag:
+                        tags.append(tag)
+            elif kind == 'end':
+                path = message['data']['path'].get('text')
+                if tags and path:
+                    yield get_note_id_of_file(path), tags
+                tags = []
+
+
+class PythonBackend(SearchBackend):
+    """
+    Searches without external tools: files are taken from the note index,
+    tags from the meta the note index keeps for every note.
+    """
+    name = 'python'
+
+    @classmethod
+    def find(cls):
+        return cls()
+
+    @Stats.timed('search python')
+    def search_in(self, folder, regexp, extension, tags=False):
+        try:
+            matcher = re.compile(regexp)
+        except re.error as e:
+            Log.warning('invalid search pattern {}: {}', regexp, e)
+            return ''
+        job = SearchJob.current_job()
+        results = []
+        for path in NoteIndex.for_folder(folder, extension).paths():
+            if job and job.cancelled:
+                return ''
+            try:
+                with open(path, mode='r', encoding='utf-8',
+                          errors='ignore') as f:
+                    text = f.read()
+            except OSError:
+                continue
+            if tags:
+                results.extend(match.group(0)
+                               for match in matcher.finditer(text))
+            elif matcher.search(text):
+                results.append(path)
+        return '\n'.join(results)
+
+    def all_tags(self, folder, extension):
+        tags = set()
+        for note_id, note_tags in self.notes_and_tags(folder, extension):
+            tags.update(note_tags)
+        return tags
+
+    def iter_notes_and_tags(self, folder, extension):
+        return iter(self.notes_and_tags(folder, extension))
+
+    def notes_and_tags(self, folder, extension):
+        # only notes that changed since the last scan are read again
+        index = NoteIndex.for_folder(folder, extension, refresh=False)
+        index.scan()
+        return list(index.notes_and_tags().values())
+
+
+class NoteCache:
+    """
+    Contents of note files, validated by their (mtime, size), so notes that
+    are embedded over and over are read only once.
+    Holds up to Max_Size characters; the least recently used notes are
+    dropped first.
+    """
+    Max_Size = 64 * 1024 * 1024
+    Workers = 8
+
+    entries = OrderedDict()     # path -> ((mtime, size), text)
+    size = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def read(path):
+        """
+        Return the text of the note file at path, or None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = (st.st_mtime, st.st_size)
+        with NoteCache.lock:
+            entry = NoteCache.entries.get(path)
+            if entry is not None and entry[0] == fingerprint:
+                NoteCache.entries.move_to_end(path)
+                Stats.count('note cache hits')
+                return entry[1]
+        Stats.count('note cache misses')
+        try:
+            with open(path, mode='r', encoding='utf-8') as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+        with NoteCache.lock:
+            old = NoteCache.entries.pop(path, None)
+            if old is not None:
+                NoteCache.size -= len(old[1])
+            NoteCache.entries[path] = (fingerprint, text)
+            NoteCache.size += len(text)
+            while (NoteCache.size > NoteCache.Max_Size
+                   and len(NoteCache.entries) > 1):
+                _, (_, evicted) = NoteCache.entries.popitem(last=False)
+                NoteCache.size -= len(evicted)
+        return text
+
+    @staticmethod
+    def read_all(paths):
+        """
+        Return {path: text or None} for all paths, read in parallel.
+        """
+        paths = list(set(paths))
+        if len(paths) < 2:
+            return dict((path, NoteCache.read(path)) for path in paths)
+        workers = min(NoteCache.Workers, len(paths))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return dict(zip(paths, executor.map(NoteCache.read, paths)))
+
+
+class Transclusion:
+    """
+    Embeds the notes linked in a text into it, for the expansion of overview
+    notes.
+
+    Embedded notes are expanded as well, up to max_depth levels, so overviews
+    can include other overviews. A note that would end up inside of itself is
+    not embedded again. All notes of a level are read in parallel, through
+    the NoteCache.
+
+    The header of each embedded note ends with a digest of the note's
+    contents, so a refresh can tell which notes have changed since. It's
+    written as `digest=...`, which can't be taken for a tag.
+    """
+    Digest_Matcher = re.compile(r' digest=([0-9a-f]{8}) -->$')
+
+    def __init__(self, folder, extension, max_depth=None):
+        if max_depth is None:
+            max_depth = get_settings().get('overview_expansion_depth', 1)
+        self.extension = extension
+        self.max_depth = max(1, max_depth or 1)
+        self.note_index = NoteIndex.for_folder(folder, extension)
+        self.notes = {}     # note id -> (note file, content); None if missing
+
+    @staticmethod
+    def link_ids(text):
+        return set(note_id for pre, note_id, post
+                   in ZkConstants.Link_Matcher.findall(text))
+
+    @staticmethod
+    def digest(content):
+        return hashlib.md5(content.encode('utf-8')).hexdigest()[:8]
+
+    def is_current(self, header):
+        """
+        Return True if header was written for the current contents of its
+        note.
+        """
+        note_links = ZkConstants.Link_Matcher.findall(header)
+        match = Transclusion.Digest_Matcher.search(header)
+        if not note_links or not match:
+            return False
+        note_file, content = self.notes.get(note_links[0][1], (None, None))
+        return bool(content) and match.group(1) == Transclusion.digest(content)
+
+    def prefetch(self, text):
+        """
+        Read all notes reachable from the links in text within max_depth
+        levels, one level at a time.
+        """
+        frontier = Transclusion.link_ids(text)
+        for depth in range(self.max_depth):
+            new_ids = [note_id for note_id in frontier
+                       if note_id not in self.notes]
+            if not new_ids:
+                break
+            files = self.resolve(new_ids)
+            contents = NoteCache.read_all([f for f in files.values() if f])
+            frontier = set()
+            for note_id, note_file in files.items():
+                content = contents.get(note_file) if note_file else None
+                self.notes[note_id] = (note_file, content)
+                if content and depth + 1 < self.max_depth:
+                    frontier.update(Transclusion.link_ids(content))
+
+    def resolve(self, note_ids):
+        """
+        Return {note id: note file or None}, refreshing the note index at
+        most once for notes it doesn't know (yet).
+        """
+        files = dict((note_id, self.note_index.lookup_path(note_id))
+                     for note_id in note_ids)
+        missing = [note_id for note_id, note_file in files.items()
+                   if note_file is None or not os.path.exists(note_file)]
+        if missing:
+            self.note_index.refresh(force=True)
+            for note_id in missing:
+                files[note_id] = self.note_index.lookup_path(note_id)
+        return files
+
+    def expand(self, text, replace_lines=False, root_id=None):
+        """
+        Expand all note-links in text, with their lines kept or replaced by
+        the note contents. root_id is the ID of the note text comes from.
+        """
+        self.prefetch(text)
+        ancestors = (root_id,) if root_id else ()
+        return '\n'.join(self.expand_lines(text, replace_lines, 1, ancestors))
+
+    def expand_lines(self, text, replace_lines, depth, ancestors):
+        result_lines = []
+        for line in text.split('\n'):
+            link_results = ZkConstants.Link_Matcher.findall(line)
+            if link_results:
+                if not replace_lines:
+                    result_lines.append(line)
+                for pre, note_id, post in link_results:
+                    result_lines.extend(self.embed(note_id, pre, post,
+                                                   replace_lines, depth,
+                                                   ancestors))
+            else:
+                result_lines.append(line)
+        return result_lines
+
+    def embed(self, note_id, link_prefix, link_postfix, replace_lines=False,
+              depth=1, ancestors=()):
+        """
+        Put the contents of a note into a comment block, its links expanded
+        down to max_depth.
+        """
+        if note_id not in self.notes:
+            self.prefetch(link_prefix + note_id + link_postfix)
+        note_file, content = self.notes.get(note_id, (None, None))
+        if not content:
+            return ['<!-- Note not found: ' + note_id + ' -->']
+        if note_id in ancestors:
+            return ['<!-- Note includes itself: ' + note_id + ' -->']
+        result_lines = []
+        filename = os.path.basename(note_file).replace(self.extension, '')
+        filename = filename.split(' ', 1)[1]
+        header = link_prefix + note_id + link_postfix + ' ' + filename
+        header = '<!-- !    {}    digest={} -->'.format(
+            header, Transclusion.digest(content))
+        result_lines.append(header)
+        if depth < self.max_depth:
+            result_lines.extend(self.expand_lines(content, replace_lines,
+                                                  depth + 1,
+                                                  ancestors + (note_id,)))
+        else:
+            result_lines.extend(content.split('\n'))
+        result_lines.append('<!-- (End of note ' + note_id + ') -->')
+        return result_lines
+
+
 class TextProduction:
     """
     Static class grouping functions for text production from overview notes.
@@ -859,48 +3865,24 @@ class TextProduction:
         note_file = note_file_by_id(note_id, folder, extension)
         if not note_file:
             return None, None
-        with open(note_file, mode='r', encoding='utf-8') as f:
-            return note_file, f.read()
+        return note_file, NoteCache.read(note_file)
 
     @staticmethod
     def embed_note(note_id, folder, extension, link_prefix, link_postfix):
         """
         Put the contents of a note into a comment block.
         """
-        result_lines = []
-        note_file, content = TextProduction.read_full_note(note_id, folder,
-                                                           extension)
-        footer = '<!-- (End of note ' + note_id + ') -->'
-        if not content:
-            header = '<!-- Note not found: ' + note_id + ' -->'
-            result_lines.append(header)
-        else:
-            filename = os.path.basename(note_file).replace(extension, '')
-            filename = filename.split(' ', 1)[1]
-            header = link_prefix + note_id + link_postfix + ' ' + filename
-            header = '<!-- !    ' + header + '    -->'
-            result_lines.append(header)
-            result_lines.extend(content.split('\n'))
-            result_lines.append(footer)
-        return result_lines
+        return Transclusion(folder, extension).embed(note_id, link_prefix,
+                                                     link_postfix)
 
     @staticmethod
-    def expand_links(text, folder, extension, replace_lines=False):
+    def expand_links(text, folder, extension, replace_lines=False,
+                     root_id=None):
         """
         Expand all note-links in text, replacing their lines by note contents.
         """
-        result_lines = []
-        for line in text.split('\n'):
-            link_results = ZkConstants.Link_Matcher.findall(line)
-            if link_results:
-                if not replace_lines:
-                    result_lines.append(line)
-                for pre, note_id, post in link_results:
-                    result_lines.extend(TextProduction.embed_note(note_id,
-                                                                  folder, extension, pre, post))
-            else:
-                result_lines.append(line)
-        return '\n'.join(result_lines)
+        return Transclusion(folder, extension).expand(text, replace_lines,
+                                                      root_id)
 
     @staticmethod
     def refresh_result(text, folder, extension):
@@ -908,29 +3890,82 @@ class TextProduction:
         Refresh the result of expand_links with current contents of referenced
         notes.
         """
-        result_lines = []
-        state = 'default'
-        note_id = pre = post = None
+        for begin, end, new_text in reversed(TextProduction.changed_blocks(
+                text, folder, extension)):
+            text = text[:begin] + new_text + text[end:]
+        return text
 
+    @staticmethod
+    def changed_blocks(text, folder, extension):
+        """
+        Return [(begin, end, new_text)], sorted, for the lines of all embedded
+        notes in text that have changed since they were embedded, with the
+        notes embedded into them. Each block is written again the way it was
+        written: with the link lines of its embedded notes kept or replaced.
+        """
+        engine = Transclusion(folder, extension)
+        engine.prefetch('\n'.join(line for line in text.split('\n')
+                                  if line.startswith('<!-- !')))
+        changes = []
+        pos = 0
+        previous = ''
+        block = None    # [begin, note_id, pre, post, footer, current, kept]
         for line in text.split('\n'):
-            if state == 'skip_lines':
-                if not line.startswith('<!-- (End of note'):
-                    continue
-                # insert note
-                result_lines.extend(TextProduction.embed_note(note_id, folder,
-                                                              extension, pre, post))
-                state = 'default'
-                continue
-
-            if line.startswith('<!-- !'):
-                # get note id
+            line_end = pos + len(line)
+            if block is not None:
+                # embedded notes are part of our block, up to our own footer
+                if line.startswith('<!-- !'):
+                    block[5] = block[5] and engine.is_current(line)
+                    block[6] = block[6] or (
+                        not previous.startswith('<!--') and
+                        bool(ZkConstants.Link_Matcher.search(previous)))
+                elif line.startswith('<!-- Note not found:'):
+                    block[5] = False
+                elif line.startswith(block[4]):
+                    begin, note_id, pre, post, footer, current, kept = block
+                    if not current:
+                        changes.extend(TextProduction.changed_lines(
+                            text[begin:line_end], engine.embed(
+                                note_id, pre, post, replace_lines=not kept),
+                            begin))
+                    block = None
+            elif line.startswith('<!-- !'):
                 note_links = ZkConstants.Link_Matcher.findall(line)
                 if note_links:
                     pre, note_id, post = note_links[0]
-                    state = 'skip_lines'
+                    footer = '<!-- (End of note ' + note_id + ')'
+                    block = [pos, note_id, pre, post, footer,
+                             engine.is_current(line), False]
+            previous = line
+            pos = line_end + 1
+        return changes
+
+    @staticmethod
+    def changed_lines(old_text, new_lines, offset):
+        """
+        Return [(begin, end, new_text)], sorted, for the lines of old_text,
+        found at offset, that differ from new_lines.
+        """
+        old_lines = old_text.split('\n')
+        starts = [offset]
+        for line in old_lines:
+            starts.append(starts[-1] + len(line) + 1)
+        changes = []
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines,
+                                          autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            lines = '\n'.join(new_lines[j1:j2])
+            if i1 == i2:
+                # inserted lines
+                changes.append((starts[i1], starts[i1], lines + '\n'))
+            elif j1 == j2:
+                # deleted lines, with their line breaks
+                changes.append((starts[i1], starts[i2], ''))
             else:
-                result_lines.append(line)
-        return '\n'.join(result_lines)
+                changes.append((starts[i1], starts[i2] - 1, lines))
+        return changes
 
     @staticmethod
     def expand_link_in(view, edit, folder, extension):
@@ -969,9 +4004,14 @@ class TextProduction:
                                                           cursor_pos_in_line)
                     if not tag:
                         return
-            # we have a #tag so let's search for tagged notes
-            note_list = ExternalSearch.search_tagged_notes(folder, extension,
-                                                           tag, externalize=False)
+            # we have a #tag so let's search for tagged notes; notes not
+            # parsed yet are parsed now, the list is written only once
+            if link_is_citekey or tag.startswith('@'):
+                note_list = LinkIndex.for_folder(
+                    folder, extension).citing_files(tag)
+            else:
+                note_list = list(TagIndex.for_folder(
+                    folder, extension).paths_with_tag(tag))
             bullet_list = []
             results = []
             for line in sorted(note_list):
@@ -980,8 +4020,9 @@ class TextProduction:
                 if line.endswith(extension):
                     line = os.path.basename(line)
                     line = line.replace(extension, '')
-                    note_id, title = line.split(' ', 1)
-                    note_id = os.path.basename(note_id)
+                    note_id, _, title = line.partition(' ')
+                    if not NoteIndex.note_id_matcher.match(note_id):
+                        continue    # nothing to link to
                     results.append((note_id, title))
             settings = get_settings()
             sort_order = settings.get('sort_notelists_by', 'id').lower()
@@ -1066,6 +4107,7 @@ def create_note(filn, title, origin_id=None, origin_title=None, body=None):
         f.write(format_str.format(**params))
         if body is not None:
             f.write('\n' + body)
+    NoteIndex.notify_saved(filn)
 
 
 def get_path_for(view):
@@ -1081,83 +4123,84 @@ def get_path_for(view):
         folder = os.path.abspath(view.window().folders()[0])
 
     if folder is None:
-        print('sublime_zk: could not deduce your note archive folder!')
+        Log.warning('could not deduce your note archive folder!')
         view.window().status_message('Could not find the location of your note '
                                      'archive! See the README for how to create a project!')
     return folder
 
 
+def get_path_for_window(window):
+    """
+    Return the note archive path of the given window's project or open folder,
+    if any.
+    """
+    if window.project_file_name():
+        return os.path.dirname(window.project_file_name())
+    elif window.folders():
+        return os.path.abspath(window.folders()[0])
+
+
 def note_file_by_id(note_id, folder, extension):
     """
     Find the file for note_id.
     """
     if not note_id:
         return
-    candidates = []
-    for root, dirs, files in os.walk(folder):
-        candidates.extend([os.path.join(root, f)
-                           for f in files if f.startswith(note_id)])
-    if len(candidates) > 0:
-        return candidates[0]
+    return NoteIndex.for_folder(folder, extension).path_for(note_id)
 
 
 def extract_tags(file):
     """
     Extract #tags from file.
     Returns all words starting with `#`.
-    To be precise, it returns everything that matches RE_TAGS_PY.
+    To be precise, it returns all tag tokens of the Tokenizer.
     """
-    tags = set()
     with open(file, mode='r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            for tag in re.findall(ZkConstants.RE_TAGS_PY(), line):
-                tags.add(tag[0])
-    return tags
+        text = f.read()
+    return Tokenizer.values(text)['tag']
+
+
+def extract_meta_of_files(paths, tag_prefix):
+    """
+    Read the note files in paths and return a list of (path, meta) where meta
+    is {'tags': [...], 'links': [...], 'citekeys': [...]}.
+    The tag_prefix is passed in to keep this usable in worker processes.
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(path, mode='rb') as f:
+                values = Tokenizer.values(f.read(), tag_prefix)
+        except (OSError, UnicodeDecodeError):
+            values = {'tag': (), 'link': (), 'citekey': ()}
+        results.append((path, {
+            'tags': sorted(values['tag']),
+            'links': sorted(values['link']),
+            'citekeys': sorted(values['citekey']),
+        }))
+    return results
 
 
 def get_all_notes_for(folder, extension):
     """
     Return all files with extension in folder.
     """
-    candidates = []
-    for root, dirs, files in os.walk(folder):
-        candidates.extend([os.path.join(root, f)
-                           for f in files if f.endswith(extension)])
-    return candidates
+    return list(NoteIndex.for_folder(folder, extension).paths())
 
 
-def find_all_tags_in(folder, extension):
+def find_all_tags_in(folder, extension, externalize=True):
     """
-    Return a list of all #tags from all notes in folder using external search
-    if possible.
+    Return a list of all #tags from all notes in folder using the search
+    backend.
     """
-    global F_EXT_SEARCH
-    if F_EXT_SEARCH:
-        return ExternalSearch.search_all_tags(folder, extension)
-    tags = set()
-    for file in get_all_notes_for(folder, extension):
-        tags |= extract_tags(file)
-    return list(tags)
+    return ExternalSearch.search_all_tags(folder, extension, externalize)
 
 
 def find_all_notes_all_tags_in(folder, extension):
     """
-    Manual and ag implementation to get a dict mapping note_ids to tags
+    Return a dict mapping note_ids to tags, using the search backend.
     """
-    global F_EXT_SEARCH
-    if F_EXT_SEARCH:
-        return ExternalSearch.notes_and_tags_in(folder, extension)
-    # manual implementation
-    ret = {}
-    for filn in get_all_notes_for(folder, extension):
-        note_id = get_note_id_of_file(filn)
-        if not note_id:
-            continue
-        tags = list(extract_tags(filn))
-        if tags:
-            ret[note_id] = tags
-    return ret
+    return ExternalSearch.notes_and_tags_in(folder, extension)
 
 
 def tag_at(text, pos=None):
@@ -1354,7 +4397,7 @@ def post_open_note(view, pane):
         rows = layout["rows"]
         cols = layout["cols"]
 
-        print('layout before', layout)
+        Log.debug('layout before {}', layout)
         num_groups = len(layout['cells'])
         current_group = num_groups - 1  # window.active_group()
         old_cell = cells.pop(current_group)
@@ -1379,8 +4422,7 @@ def post_open_note(view, pane):
             new_cols.append(1.0)
             cols = new_cols
 
-        print('new cell', new_cell)
-        print('old cell', old_cell)
+        Log.debug('new cell {}, old cell {}', new_cell, old_cell)
 
         focused_cell = old_cell
         unfocused_cell = new_cell
@@ -1392,7 +4434,7 @@ def post_open_note(view, pane):
         window.focus_group(min(current_group, num_groups - 1))
         # ,0..make it first view
         window.set_view_index(view, num_groups - 1, 0)
-        print(window.get_layout())
+        Log.debug('layout after {}', layout)
 
 
 class ZkExpandLinkCommand(sublime_plugin.TextCommand):
@@ -1424,8 +4466,12 @@ class ZkExpandOverviewNoteCommand(sublime_plugin.TextCommand):
         extension = settings.get('wiki_extension')
 
         complete_text = self.view.substr(sublime.Region(0, self.view.size()))
+        root_id = None
+        if self.view.file_name():
+            root_id = os.path.basename(self.view.file_name()).split(' ', 1)[0]
         result_text = TextProduction.expand_links(complete_text, folder,
-                                                  extension, replace_lines=True)
+                                                  extension, replace_lines=True,
+                                                  root_id=root_id)
         new_view = self.view.window().new_file()
 
         # don't: this causes auto-indent:
@@ -1447,11 +4493,12 @@ class ZkRefreshExpandedNoteCommand(sublime_plugin.TextCommand):
 
         settings = get_settings()
         extension = settings.get('wiki_extension')
-        complete_region = sublime.Region(0, self.view.size())
-        complete_text = self.view.substr(complete_region)
-        result_text = TextProduction.refresh_result(complete_text, folder,
-                                                    extension)
-        self.view.replace(edit, complete_region, result_text)
+        complete_text = self.view.substr(sublime.Region(0, self.view.size()))
+        changes = TextProduction.changed_blocks(complete_text, folder,
+                                                extension)
+        # back to front, so the regions of the changes before stay valid
+        for begin, end, new_text in reversed(changes):
+            self.view.replace(edit, sublime.Region(begin, end), new_text)
 
 
 class ZkFollowWikiLinkCommand(sublime_plugin.TextCommand):
@@ -1472,16 +4519,28 @@ class ZkFollowWikiLinkCommand(sublime_plugin.TextCommand):
         new_view = self.view.window().open_file(the_file)
         post_open_note(new_view, PANE_FOR_OPENING_NOTES)
 
+    def show_tagged_notes(self, tagged_note_files):
+        """
+        Called with the result of the search for tagged notes.
+        """
+        global PANE_FOR_OPENING_RESULTS
+        window = self.view.window()
+        if ExternalSearch.EXTERNALIZE:
+            n = window.open_file(ExternalSearch.external_file(self.folder))
+            window.set_view_index(n, PANE_FOR_OPENING_RESULTS, 0)
+        else:
+            self.tagged_note_files = [os.path.basename(f) for f in
+                                      tagged_note_files]
+            window.show_quick_panel(self.tagged_note_files, self.on_done)
+
     def select_link(self, event=None):
         """
         Select a note-link under the cursor.
-        If it's a tag, follow it by searching for tagged notes.
-        Search:
-        * via find-in-files if ag is not found
-        * results in external search results file if enabled
+        If it's a tag, follow it by searching for tagged notes, in the
+        background, with ag, rg or without external tools. Results go:
+        * in external search results file if enabled
         * else present overlay to pick a note
         """
-        global F_EXT_SEARCH
         global PANE_FOR_OPENING_RESULTS
         linestart_till_cursor_str, link_region = select_link_in(
             self.view, event)
@@ -1513,43 +4572,16 @@ class ZkFollowWikiLinkCommand(sublime_plugin.TextCommand):
                 if not tag:
                     return
 
-            settings = get_settings()
-
-            if F_EXT_SEARCH:
-                extension = settings.get('wiki_extension')
-                folder = get_path_for(self.view)
-                if not folder:
-                    return
-                self.folder = folder
-                self.tagged_note_files = ExternalSearch.search_tagged_notes(
-                    folder, extension, tag)
-                if ExternalSearch.EXTERNALIZE:
-                    n = self.view.window().open_file(ExternalSearch.external_file(
-                        folder))
-                    self.view.window().set_view_index(n,
-                                                      PANE_FOR_OPENING_RESULTS, 0)
-
-                else:
-                    self.tagged_note_files = [os.path.basename(f) for f in
-                                              self.tagged_note_files]
-                    self.view.window().show_quick_panel(self.tagged_note_files,
-                                                        self.on_done)
-            else:
-                new_tab = settings.get('show_search_results_in_new_tab')
-
-                # hack for the find in files panel: select tag in view, copy it
-                selection = self.view.sel()
-                selection.clear()
-                line_region = sublime.Region(
-                    line_start + begin, line_start + end)
-                selection.add(line_region)
-                self.view.window().run_command("copy")
-                self.view.window().run_command("show_panel",
-                                               {"panel": "find_in_files",
-                                                "where": get_path_for(self.view),
-                                                   "use_buffer": new_tab, })
-                # now paste the tag --> it will land in the "find" field
-                self.view.window().run_command("paste")
+            extension = get_settings().get('wiki_extension')
+            folder = get_path_for(self.view)
+            if not folder:
+                return
+            self.folder = folder
+            SearchJob.start(
+                'Searching for ' + tag,
+                lambda: ExternalSearch.search_tagged_notes(
+                    folder, extension, tag),
+                self.show_tagged_notes)
         return
 
     def run(self, edit, event=None):
@@ -1569,59 +4601,29 @@ class ZkFollowWikiLinkCommand(sublime_plugin.TextCommand):
         extension = settings.get('wiki_extension')
         id_in_title = settings.get('id_in_title')
 
-        print('EVENT', event)
+        Log.debug('event {}', event)
         if event is None:
             region = self.view.sel()[0]
             cursor_pos = region.begin()
         else:
             cursor_pos = self.view.window_to_text((event['x'], event['y']))
-            print('cursor pos', cursor_pos)
+            Log.debug('cursor pos {}', cursor_pos)
         # FIRST check if it's a saved search!!!
         if self.view.match_selector(cursor_pos, 'markup.zettel.search'):
             line_region = self.view.line(cursor_pos)
             line = self.view.substr(line_region)
             search_spec = line.split(':', 1)[1].strip()
-            print('search_spec >' + search_spec + '<')
+            Log.debug('search_spec >{}<', search_spec)
             self.folder = folder
             self.extension = extension
             input_text = search_spec
             self.window = self.view.window()
-            #
-            # VERBATIM FROM ZkMultiTagSearchCommand.on_done:
-            #
-            note_ids = TagSearch.advanced_tag_search(input_text, self.folder,
-                                                     self.extension)
-            print('note_ids', note_ids)
-            if note_ids is None:
-                return
-            link_prefix, link_postfix = get_link_pre_postfix()
-            lines = ['# Notes matching search-spec ' + input_text + '\n']
-            results = []
-            for note_id in [n for n in note_ids if n]:  # Strip the None
-                filn = note_file_by_id(note_id, self.folder, self.extension)
-                if filn:
-                    title = os.path.basename(filn).split(' ', 1)[1]
-                    title = title.replace(self.extension, '')
-                    results.append((note_id, title))
-            settings = get_settings()
-            sort_order = settings.get('sort_notelists_by', 'id').lower()
-            if sort_order not in ('id', 'title'):
-                sort_order = 'id'
-            column = 0
-            if sort_order == 'title':
-                column = 1
-            results.sort(key=itemgetter(column))
-            for note_id, title in results:
-                line = '* ' + link_prefix + note_id + link_postfix + ' '
-                line += title
-                lines.append(line)
-            if ExternalSearch.EXTERNALIZE:
-                with open(ExternalSearch.external_file(self.folder), mode='w',
-                          encoding='utf-8') as f:
-                    f.write('\n'.join(lines))
-            ExternalSearch.show_search_results(self.window, self.folder,
-                                               'Tag-Search', lines, 'show_all_tags_in_new_pane')
-            # END OF VERBATIM
+            SearchJob.start(
+                'Searching for ' + input_text,
+                lambda: TagSearch.advanced_tag_search(input_text, folder,
+                                                      extension),
+                lambda note_files: TagSearch.show_results(
+                    self.window, folder, extension, input_text, note_files))
             return
 
         window = self.view.window()
@@ -1677,9 +4679,8 @@ class ZkFollowWikiLinkCommand(sublime_plugin.TextCommand):
 
 class ZkShowReferencingNotesCommand(sublime_plugin.TextCommand):
     """
-    Command searching for notes referencing the note id under the cursor.
-    * if ag is not installed, opens a find-in-files for link under cursor.
-    * if ag is installed, it will show results:
+    Command listing notes referencing the note id under the cursor, using the
+    link index. It will show results:
       * in an overlay if external search results are disabled
       * else in the external search file
     """
@@ -1698,50 +4699,47 @@ class ZkShowReferencingNotesCommand(sublime_plugin.TextCommand):
         """
         Try to select note link if present. Search for notes as described above.
         """
-        global F_EXT_SEARCH
-        global PANE_FOR_OPENING_RESULTS
         linestart_till_cursor_str, link_region = select_link_in(self.view)
         if not link_region:
             return
+        note_id = cut_after_note_id(self.view.substr(link_region))
+        if not note_id:
+            return
 
         settings = get_settings()
-        if F_EXT_SEARCH:
-            extension = settings.get('wiki_extension')
-            folder = get_path_for(self.view)
-            if not folder:
-                return
-            self.folder = folder
-            note_id = cut_after_note_id(self.view.substr(link_region))
-            self.friend_note_files = ExternalSearch.search_friend_notes(
-                folder, extension, note_id)
-            self.friend_note_files = [os.path.basename(f) for f in
-                                      self.friend_note_files]
-            if ExternalSearch.EXTERNALIZE:
-                nv = self.view.window().open_file(ExternalSearch.external_file(
-                    folder))
-                self.view.window().set_view_index(nv,
-                                                  PANE_FOR_OPENING_RESULTS, 0)
+        extension = settings.get('wiki_extension')
+        folder = get_path_for(self.view)
+        if not folder:
+            return
+        self.folder = folder
+        link_prefix, link_postfix = get_link_pre_postfix()
+        prefix = 'Notes referencing {}{}{}:'.format(link_prefix, note_id,
+                                                    link_postfix)
 
-            else:
-                self.view.window().show_quick_panel(self.friend_note_files,
-                                                    self.on_done)
+        def search():
+            friend_note_files = LinkIndex.for_folder(
+                folder, extension).referencing_files(note_id)
+            ExternalSearch.externalize_note_links(
+                '\n'.join(friend_note_files), folder, extension, prefix)
+            return friend_note_files
+        SearchJob.start('Searching notes referencing ' + note_id, search,
+                        self.show_friend_notes)
+
+    def show_friend_notes(self, friend_note_files):
+        """
+        Called with the referencing notes found.
+        """
+        global PANE_FOR_OPENING_RESULTS
+        self.friend_note_files = [os.path.basename(f) for f in
+                                  friend_note_files]
+        if ExternalSearch.EXTERNALIZE:
+            nv = self.view.window().open_file(ExternalSearch.external_file(
+                self.folder))
+            self.view.window().set_view_index(nv,
+                                              PANE_FOR_OPENING_RESULTS, 0)
         else:
-            new_tab = settings.get('show_search_results_in_new_tab')
-
-            # hack for the find in files panel: select tag in view, copy it
-            selection = self.view.sel()
-            selection.clear()
-            note_id = cut_after_note_id(self.view.substr(link_region))
-            selection.add(sublime.Region(link_region.a,
-                                         link_region.a + len(note_id)))
-            self.view.window().run_command("copy")
-            self.view.window().run_command("show_panel",
-                                           {"panel": "find_in_files",
-                                            "where": get_path_for(self.view),
-                                               "use_buffer": new_tab, })
-            # now paste the note-id --> it will land in the "find" field
-            self.view.window().run_command("paste")
-        return
+            self.view.window().show_quick_panel(self.friend_note_files,
+                                                self.on_done)
 
 
 class ZkReplaceSelectedTextCommand(sublime_plugin.TextCommand):
@@ -1926,10 +4924,13 @@ class ZkTagSelectorCommand(sublime_plugin.TextCommand):
             return
         settings = get_settings()
         extension = settings.get('wiki_extension')
-        temp = ExternalSearch.EXTERNALIZE
-        ExternalSearch.EXTERNALIZE = False
-        self.tags = find_all_tags_in(folder, extension)
-        ExternalSearch.EXTERNALIZE = temp
+        SearchJob.start(
+            'Collecting tags',
+            lambda: find_all_tags_in(folder, extension, externalize=False),
+            self.show_tags)
+
+    def show_tags(self, tags):
+        self.tags = tags
         self.view.window().show_quick_panel(self.tags, self.on_done)
 
 
@@ -1954,19 +4955,18 @@ class ZkShowAllTagsCommand(sublime_plugin.WindowCommand):
             return
         settings = get_settings()
         extension = settings.get('wiki_extension')
-        tags = find_all_tags_in(folder, extension)
+        self.folder = folder
+        SearchJob.start('Collecting tags',
+                        lambda: find_all_tags_in(folder, extension),
+                        self.show_tags)
+
+    def show_tags(self, tags):
         tags.sort()
+        Log.debug('{} tags found', len(tags))
         lines = '# All Tags\n'
-        print(lines)
         lines += '\n'.join(['* ' + tag for tag in tags])
-        print(lines)
-
-        if ExternalSearch.EXTERNALIZE and not F_EXT_SEARCH:
-            with open(ExternalSearch.external_file(folder), mode='w',
-                      encoding='utf-8') as f:
-                f.write(lines)
-        ExternalSearch.show_search_results(self.window, folder, 'Tags', lines,
-                                           'show_all_tags_in_new_pane')
+        ExternalSearch.show_search_results(self.window, self.folder, 'Tags',
+                                           lines, 'show_all_tags_in_new_pane')
 
 
 class ZkShowAllNotesCommand(sublime_plugin.WindowCommand):
@@ -2037,37 +5037,64 @@ class ZkMultiTagSearchCommand(sublime_plugin.WindowCommand):
                                      None, None)
 
     def on_done(self, input_text):
-        note_ids = TagSearch.advanced_tag_search(input_text, self.folder,
-                                                 self.extension)
-        if note_ids is None:
+        SearchJob.start(
+            'Searching for ' + input_text,
+            lambda: TagSearch.advanced_tag_search(input_text, self.folder,
+                                                  self.extension),
+            lambda note_files: TagSearch.show_results(
+                self.window, self.folder, self.extension, input_text,
+                note_files))
+
+
+class ZkFullTextSearchCommand(sublime_plugin.WindowCommand):
+    """
+    Command for the full-text search.
+    Prompts for words and "phrases", and shows the notes containing all of
+    them, best matches first.
+    """
+    Max_Results = 200
+
+    def run(self):
+        folder = get_path_for_window(self.window)
+        if not folder:
+            # don't know where to search
             return
-        link_prefix, link_postfix = get_link_pre_postfix()
-        lines = ['# Notes matching search-spec ' + input_text + '\n']
-        results = []
-        for note_id in [n for n in note_ids if n]:  # Strip the None
-            filn = note_file_by_id(note_id, self.folder, self.extension)
-            if filn:
-                title = os.path.basename(filn).split(' ', 1)[1]
-                title = title.replace(self.extension, '')
-                results.append((note_id, title))
         settings = get_settings()
-        sort_order = settings.get('sort_notelists_by', 'id').lower()
-        if sort_order not in ('id', 'title'):
-            sort_order = 'id'
-        column = 0
-        if sort_order == 'title':
-            column = 1
-        results.sort(key=itemgetter(column))
-        for note_id, title in results:
-            line = '* ' + link_prefix + note_id + link_postfix + ' '
-            line += title
-            lines.append(line)
+        self.folder = folder
+        self.extension = settings.get('wiki_extension')
+        self.window.show_input_panel('Words and "phrases":', '', self.on_done,
+                                     None, None)
+
+    def on_done(self, input_text):
+        SearchJob.start(
+            'Searching for ' + input_text,
+            lambda: FullTextIndex.for_folder(
+                self.folder, self.extension).search(
+                    input_text, ZkFullTextSearchCommand.Max_Results),
+            lambda results: self.show_results(input_text, results))
+
+    def show_results(self, query, results):
+        """
+        Show the notes found, in the order of their rank.
+        """
+        if results is None:
+            return
+        link_prefix, link_postfix = get_link_pre_postfix()
+        lines = ['# Notes matching full-text search ' + query + '\n']
+        index = NoteIndex.for_folder(self.folder, self.extension)
+        for score, path in results:
+            entry = index.notes.get(path)
+            if entry is None:
+                continue
+            lines.append('* ' + link_prefix + entry[0] + link_postfix + ' ' +
+                         entry[1])
         if ExternalSearch.EXTERNALIZE:
             with open(ExternalSearch.external_file(self.folder), mode='w',
                       encoding='utf-8') as f:
                 f.write('\n'.join(lines))
         ExternalSearch.show_search_results(self.window, self.folder,
-                                           'Tag-Search', lines, 'show_all_tags_in_new_pane')
+                                           'Full-Text Search', lines,
+                                           'show_all_tags_in_new_pane')
 
 
 class ZkAutoBibCommand(sublime_plugin.TextCommand):
@@ -2130,23 +5157,97 @@ class ZkHideImagesCommand(sublime_plugin.TextCommand):
         ImageHandler.hide_images(self.view, edit)
 
 
-class ZkTocCommand(sublime_plugin.TextCommand):
+Heading = namedtuple('Heading', ['start', 'end', 'hashes', 'numbering',
+                                 'title'])
+
+
+class Headings:
     """
-    Auto-insert or refresh a toc in(to) current view.
+    Headings of a note, from its text: parsed in one pass, for numbering,
+    denumbering and the table of contents. Works on view text and on note
+    files alike.
+
+    Edits are returned as sorted (start, end, replacement) tuples, to be
+    applied back to front with apply() or view.replace().
     """
+    # ATX heading, optionally indented and numbered: `## 1.2 Title`
+    Matcher = re.compile(
+        r'([ ]{0,3})(#{1,6})(?=[ \t]+\S)([ \t]*[0-9.]*[ \t])(.*)')
+    Fence_Matcher = re.compile(r'(`{3,}|~{3,})')
 
-    def find_toc_region(self):
+    @staticmethod
+    def parse(text):
         """
-        Find the entire toc region including start and end markers.
+        Return the Headings of text, outside of fenced code blocks.
         """
-        toc_hdr = ZkConstants.TOC_HDR.replace('(', '\(').replace(')', '\)')
-        toc_end = ZkConstants.TOC_END.replace('(', '\(').replace(')', '\)')
-        hdr_region = self.view.find(toc_hdr, 0)
-        if hdr_region and hdr_region.a > 0:
-            end_region = self.view.find(toc_end, hdr_region.b)
-            if end_region and end_region.a > hdr_region.b:
-                return sublime.Region(hdr_region.a, end_region.b)
-        return None
+        headings = []
+        fence = None
+        pos = 0
+        for line in text.split('\n'):
+            line_end = pos + len(line)
+            if fence:
+                if line.lstrip().startswith(fence):
+                    fence = None
+            elif line.lstrip(' ').startswith('#'):
+                match = Headings.Matcher.match(line)
+                if match:
+                    indent, hashes, numbering, title = match.groups()
+                    number = numbering.strip()
+                    if number.isdigit() and len(hashes) > 1:
+                        # numbered below the top level, there's a dot:
+                        # `## 10 things` starts its title with a number
+                        blanks = numbering[:numbering.index(number)]
+                        title = numbering[len(blanks):] + title
+                        numbering = blanks
+                    headings.append(Heading(pos + len(indent), line_end,
+                                            hashes, numbering, title))
+            else:
+                match = Headings.Fence_Matcher.match(line.lstrip())
+                if match:
+                    fence = match.group(1)
+            pos = line_end + 1
+        return headings
+
+    @staticmethod
+    def numberings(headings):
+        """
+        Return the numbering of each heading, as in ` 1.2 `.
+        """
+        current_level = 0
+        levels = [0] * 6
+        result = []
+        for heading in headings:
+            level = len(heading.hashes) - 1
+            if level < current_level:
+                levels[level + 1:] = [0] * (6 - level - 1)
+            levels[level] += 1
+            current_level = level
+            result.append(' ' + '.'.join([str(l)
+                                          for l in levels[:level + 1]]) + ' ')
+        return result
+
+    @staticmethod
+    def renumber_edits(text):
+        edits = []
+        headings = Headings.parse(text)
+        for heading, numbering in zip(headings,
+                                      Headings.numberings(headings)):
+            start = heading.start + len(heading.hashes)  # behind the hash
+            end = start + len(heading.numbering)
+            if heading.numbering != numbering:
+                edits.append((start, end, numbering))
+        return edits
+
+    @staticmethod
+    def denumber_edits(text):
+        edits = []
+        for heading in Headings.parse(text):
+            if heading.numbering.strip():
+                start = heading.start + len(heading.hashes)
+                # keep one blank between the hashes and the title
+                blank = '' if heading.title[:1].isspace() else ' '
+                edits.append((start, start + len(heading.numbering), blank))
+        return edits
 
     @staticmethod
     def heading2ref(heading):
@@ -2158,34 +5259,93 @@ class ZkTocCommand(sublime_plugin.TextCommand):
                                                 errors='ignore')).strip().lower()
         return re.sub('[-\s]+', '-', ref)
 
-    def run(self, edit):
-        settings = get_settings()
-        suffix_sep = settings.get('toc_suffix_separator', None)
-        if not suffix_sep:
-            suffix_sep = '_'
+    @staticmethod
+    def toc(text, suffix_sep='_'):
+        """
+        Return the table of contents of text, with its start and end markers.
+        """
         # '' for unprintable char only headings
         ref_counter = Counter({'': 1})
-        toc_region = self.find_toc_region()
-        if not toc_region:
-            toc_region = self.view.sel()[0]
         lines = [ZkConstants.TOC_HDR]
-
-        for h_region in self.view.find_by_selector('markup.heading'):
-            heading = self.view.substr(h_region)
-            ref = self.heading2ref(heading)
+        for heading in Headings.parse(text):
+            line = text[heading.start:heading.end]
+            ref = Headings.heading2ref(line)
             ref_counter[ref] += 1
             if ref_counter[ref] > 1:
                 ref = ref + '{}{}'.format(suffix_sep, ref_counter[ref] - 1)
-
-            match = re.match('\s*(#+)(.*)', heading)
-            hashes, title = match.groups()
-            title = title.strip()
-            level = len(hashes) - 1
-            line = '    ' * level + '* [{}](#{})'.format(title, ref)
-            lines.append(line)
+            title = (heading.numbering + heading.title).strip()
+            level = len(heading.hashes) - 1
+            lines.append('    ' * level + '* [{}](#{})'.format(title, ref))
         lines.append(ZkConstants.TOC_END)
-        self.view.replace(edit, toc_region, '')
-        self.view.insert(edit, toc_region.a, '\n'.join(lines))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def find_toc(text):
+        """
+        Return (start, end) of the table of contents in text, or None.
+        """
+        start = text.find(ZkConstants.TOC_HDR)
+        if start > 0:
+            end = text.find(ZkConstants.TOC_END,
+                            start + len(ZkConstants.TOC_HDR))
+            if end >= 0:
+                return start, end + len(ZkConstants.TOC_END)
+        return None
+
+    @staticmethod
+    def toc_edits(text, suffix_sep='_', region=None):
+        """
+        Return the edit replacing the table of contents of text, or, if there
+        is none yet, region (start, end) by it.
+        """
+        region = Headings.find_toc(text) or region
+        if region is None:
+            return []
+        return [(region[0], region[1], Headings.toc(text, suffix_sep))]
+
+    @staticmethod
+    def apply(text, edits):
+        """
+        Return text with edits applied.
+        """
+        parts = []
+        pos = 0
+        for start, end, replacement in edits:
+            parts.append(text[pos:start])
+            parts.append(replacement)
+            pos = end
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    @staticmethod
+    def apply_to_view(view, edit, edits):
+        """
+        Apply edits to view with a single replace of the span they cover.
+        """
+        if not edits:
+            return
+        start = edits[0][0]
+        end = edits[-1][1]
+        span = view.substr(sublime.Region(start, end))
+        view.replace(edit, sublime.Region(start, end), Headings.apply(
+            span, [(s - start, e - start, r) for s, e, r in edits]))
+
+
+class ZkTocCommand(sublime_plugin.TextCommand):
+    """
+    Auto-insert or refresh a toc in(to) current view.
+    """
+
+    def run(self, edit):
+        settings = get_settings()
+        suffix_sep = settings.get('toc_suffix_separator', None)
+        if not suffix_sep:
+            suffix_sep = '_'
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        selection = self.view.sel()[0]
+        edits = Headings.toc_edits(text, suffix_sep,
+                                   (selection.begin(), selection.end()))
+        Headings.apply_to_view(self.view, edit, edits)
 
 
 class ZkRenumberHeadingsCommand(sublime_plugin.TextCommand):
@@ -2194,34 +5354,8 @@ class ZkRenumberHeadingsCommand(sublime_plugin.TextCommand):
     """
 
     def run(self, edit):
-        current_level = 0
-        levels = [0] * 6
-        regions_to_skip = 0
-        while True:
-            h_regions = self.view.find_by_selector('markup.heading')
-            h_regions = h_regions[regions_to_skip:]
-            if not h_regions:
-                break
-            regions_to_skip += 1
-            h_region = h_regions[0]
-            heading = self.view.substr(h_region)
-            # print(heading)
-            match = re.match('(\s*)(#+)(\s*[1-9.]*\s)(.*)', heading)
-            spaces, hashes, old_numbering, title = match.groups()
-            level = len(hashes) - 1
-            if level < current_level:
-                levels[level + 1:] = [0] * (6 - level - 1)
-            levels[level] += 1
-            current_level = level
-            # print('resetting levels to', levels)
-            numbering = ' ' + '.'.join([str(l)
-                                        for l in levels[:level + 1]]) + ' '
-            h_region.a += len(spaces) + len(hashes)   # we're behind the hash
-            if old_numbering.strip():   # there is an old numbering to replace
-                h_region.b = h_region.a + len(old_numbering)
-            else:
-                h_region.b = h_region.a
-            self.view.replace(edit, h_region, numbering)
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        Headings.apply_to_view(self.view, edit, Headings.renumber_edits(text))
 
 
 class ZkDenumberHeadingsCommand(sublime_plugin.TextCommand):
@@ -2230,21 +5364,29 @@ class ZkDenumberHeadingsCommand(sublime_plugin.TextCommand):
     """
 
     def run(self, edit):
-        regions_to_skip = 0
-        while True:
-            h_regions = self.view.find_by_selector('markup.heading')
-            h_regions = h_regions[regions_to_skip:]
-            if not h_regions:
-                break
-            regions_to_skip += 1
-            h_region = h_regions[0]
-            heading = self.view.substr(h_region)
-            match = re.match('(\s*)(#+)(\s*[1-9.]*\s)(.*)', heading)
-            spaces, hashes, old_numbering, title = match.groups()
-            h_region.a += len(spaces) + len(hashes)   # we're behind the hash
-            if old_numbering.strip():   # there is an old numbering to replace
-                h_region.b = h_region.a + len(old_numbering)
-            self.view.replace(edit, h_region, '')
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        Headings.apply_to_view(self.view, edit, Headings.denumber_edits(text))
+
+
+class ZkShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    """
+    Show where the time went: timings of commands, searches, index walks,
+    pandoc runs and highlighting passes, and counters. With to_json, save
+    them to a JSON file in the cache folder and open it.
+    """
+
+    def run(self, to_json=False):
+        if to_json:
+            folder = os.path.join(sublime.cache_path(), 'sublime_zk')
+            os.makedirs(folder, exist_ok=True)
+            filn = os.path.join(folder, 'performance_stats.json')
+            Stats.save_json(filn)
+            self.window.open_file(filn)
+            return
+        view = self.window.new_file()
+        view.set_name('ZK Performance Stats')
+        view.set_scratch(True)
+        view.run_command('insert', {'characters': Stats.report_text()})
 
 
 class ZkSelectPanesCommand(sublime_plugin.WindowCommand):
@@ -2296,20 +5438,212 @@ class ZkSelectPanesCommand(sublime_plugin.WindowCommand):
             group_view.erase_phantoms('popup')
 
 
+def merge_regions(regions):
+    """
+    Return the sorted, non-overlapping cover of regions.
+    """
+    merged = []
+    for region in sorted(regions, key=lambda r: r.begin()):
+        if merged and region.begin() <= merged[-1].end():
+            merged[-1] = merged[-1].cover(region)
+        else:
+            merged.append(sublime.Region(region.begin(), region.end()))
+    return merged
+
+
+def intersect_regions(regions, region):
+    """
+    Return the parts of the sorted regions within region.
+    """
+    result = []
+    for r in regions:
+        begin = max(r.begin(), region.begin())
+        end = min(r.end(), region.end())
+        if begin < end:
+            result.append(sublime.Region(begin, end))
+    return result
+
+
+def subtract_regions(regions, others):
+    """
+    Return the parts of the merged sorted regions outside of the merged
+    sorted others.
+    """
+    result = []
+    for region in regions:
+        begin = region.begin()
+        for other in others:
+            if other.end() <= begin:
+                continue
+            if other.begin() >= region.end():
+                break
+            if other.begin() > begin:
+                result.append(sublime.Region(begin, other.begin()))
+            begin = max(begin, other.end())
+        if begin < region.end():
+            result.append(sublime.Region(begin, region.end()))
+    return result
+
+
+ViewJob = namedtuple('ViewJob', ['func', 'queued', 'due'])
+
+
+class ViewScheduler:
+    """
+    Runs work for views on worker threads.
+
+    At most one job per view is queued: submitting another one for the same
+    view replaces it, keeping its place in the queue. Jobs of different views
+    run concurrently, jobs of the same view never do. Replacing a job can
+    postpone it by up to Max_Wait seconds. A worker that has been busy for
+    Tick_Budget seconds pauses for Tick_Delay ms, so editing stays smooth.
+    Queue depth and latency, from the first request to the start of the job,
+    are kept for report().
+    """
+    Workers = 2
+    Max_Wait = 0.5
+    Tick_Budget = 0.05
+    Tick_Delay = 5
+
+    def __init__(self, name):
+        self.name = name
+        self.condition = threading.Condition()
+        self.queue = OrderedDict()  # view id -> ViewJob
+        self.running = set()        # ids of the views with a job running
+        self.workers = 0
+        self.idle = 0
+        self.submitted = 0
+        self.superseded = 0
+        self.finished = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.latencies = deque(maxlen=200)
+
+    def submit(self, view_id, func, delay=0):
+        """
+        Run func() for view_id, no sooner than in delay ms.
+        """
+        now = time.perf_counter()
+        with self.condition:
+            previous = self.queue.get(view_id)
+            queued = now
+            due = now + delay / 1000
+            if previous is not None:
+                self.superseded += 1
+                queued = previous.queued
+                due = min(due, max(previous.due,
+                                   queued + ViewScheduler.Max_Wait))
+            self.queue[view_id] = ViewJob(func, queued, due)
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            if self.idle:
+                self.condition.notify()
+            elif self.workers < ViewScheduler.Workers:
+                self.workers += 1
+                threading.Thread(target=self.work, daemon=True).start()
+
+    def cancel(self, view_id):
+        with self.condition:
+            self.queue.pop(view_id, None)
+
+    def next_job(self, now):
+        """
+        Return (view id, ViewJob) of the first due job of a view without a
+        running job, or (None, seconds to wait; None to wait for a change).
+        """
+        wait = None
+        for view_id, job in self.queue.items():
+            if view_id in self.running:
+                continue
+            if job.due <= now:
+                return view_id, job
+            if wait is None or job.due - now < wait:
+                wait = job.due - now
+        return None, wait
+
+    def work(self):
+        tick_start = time.perf_counter()
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        self.workers -= 1
+                        return
+                    now = time.perf_counter()
+                    view_id, job = self.next_job(now)
+                    if view_id is not None:
+                        break
+                    self.idle += 1
+                    self.condition.wait(job)
+                    self.idle -= 1
+                del self.queue[view_id]
+                self.running.add(view_id)
+                self.latencies.append(now - job.queued)
+            try:
+                job.func()
+            except Exception as e:
+                Log.error('{} failed: {}', self.name, e)
+                self.failed += 1
+            finally:
+                with self.condition:
+                    self.running.discard(view_id)
+                    self.finished += 1
+                    self.condition.notify()
+            if time.perf_counter() - tick_start > ViewScheduler.Tick_Budget:
+                time.sleep(ViewScheduler.Tick_Delay / 1000)
+                tick_start = time.perf_counter()
+
+    def report(self):
+        """
+        Return the scheduler's counters and latencies in ms, as a dict.
+        """
+        with self.condition:
+            latencies = sorted(self.latencies)
+            report = OrderedDict([
+                ('queued', len(self.queue)),
+                ('running', len(self.running)),
+                ('max queued', self.max_depth),
+                ('submitted', self.submitted),
+                ('superseded', self.superseded),
+                ('finished', self.finished),
+                ('failed', self.failed),
+            ])
+        if latencies:
+            report['latency median'] = latencies[len(latencies) // 2] * 1000
+            report['latency max'] = latencies[-1] * 1000
+        return report
+
+
 class NoteLinkHighlighter(sublime_plugin.EventListener):
     """
     Receives all updates to all views.
     * Highlights [[201710310102]] style links.
     * Enables word completion (ctrl + space) to insert links to notes.
     """
-    DEFAULT_MAX_LINKS = 1000
-
-    note_links_for_view = {}
+    # wait for a pause in typing before highlighting, in ms
+    Debounce_Delay = 100
+
+    # hidden regions marking the lines edited since the last pass, and the
+    # ones not scanned yet; Sublime moves them along with the text
+    Dirty_Key = 'zk_dirty_lines'
+    Pending_Key = 'zk_pending_lines'
+
+    # the parts of a view outside of the visible region are scanned in
+    # chunks of about Chunk_Size characters, for at most Chunk_Time seconds
+    # per job, with a pause of Chunk_Delay ms in between
+    Chunk_Size = 5000
+    Chunk_Time = 0.02
+    Chunk_Delay = 10
+
+    # characters before and after the selection kept to check an edit by
+    Context_Size = 32
+
+    change_counts = {}      # view id -> view.change_count() at last pass
+    snapshots = {}          # view id -> see take_snapshot()
+    end_scopes = {}         # view id -> scope name at the end of the view
     scopes_for_view = {}
-    ignored_views = []
-    highlight_semaphore = threading.Semaphore()
+    scheduler = ViewScheduler('highlighting')
 
-    tag_regions = {}
     tag_scopes = {}
 
     def on_query_context(self, view, key, operator, operand, match_all):
@@ -2336,26 +5670,35 @@ class NoteLinkHighlighter(sublime_plugin.EventListener):
 
         # we have a path and are in markdown!
         settings = get_settings()
-        prefix, postfix = get_link_pre_postfix()
+        link_prefix, link_postfix = get_link_pre_postfix()
         extension = settings.get('wiki_extension')
-        completions = []
-        aux = [os.path.basename(f)
-               for f in get_all_notes_for(folder, extension)]
-        ids_and_names = [f.split(' ', 1) for f in aux
-                         if f.endswith(extension)
-                         and ' ' in f]
         do_insert_title = settings.get('insert_links_with_titles', False)
-        for noteid, notename in ids_and_names:
-            completion_str = prefix + noteid + postfix
-            if do_insert_title:
-                completion_str += ' ' + notename.replace(extension, '')
-            completions.append([noteid + ' ' + notename, completion_str])
+
+        # Sublime Text 4 asks again for longer prefixes if told so, older
+        # versions only filter what they got and have to get everything
+        limit = None
+        flags = 0
+        if hasattr(sublime, 'DYNAMIC_COMPLETIONS'):
+            limit = CompletionIndex.Max_Completions
+        completions = []
+        index = CompletionIndex.for_typing(folder, extension)
+        if index is not None:
+            completions = index.completions(
+                prefix, (link_prefix, link_postfix, do_insert_title),
+                limit and limit + 1)
+            if limit and len(completions) > limit:
+                del completions[limit:]
+                flags = sublime.DYNAMIC_COMPLETIONS
 
         # now come the citekeys
         bibfile = Autobib.look_for_bibfile(view, settings)
-        if bibfile:
+        if bibfile and os.path.exists(bibfile):
             mmd_style = settings.get('citations-mmd-style', None)
-            citekeys = Autobib.extract_all_citekeys(bibfile)
+            citekeys = BibIndex.for_file(bibfile).citekeys_with_prefix(
+                prefix, limit and limit + 1)
+            if limit and len(citekeys) > limit:
+                del citekeys[limit:]
+                flags = sublime.DYNAMIC_COMPLETIONS
             if mmd_style:
                 fmt_key = '#{}'
                 fmt_completion = '[][{}]'
@@ -2366,95 +5709,326 @@ class NoteLinkHighlighter(sublime_plugin.EventListener):
             for citekey in citekeys:
                 citekey = fmt_key.format(citekey)
                 completions.append([citekey, fmt_completion.format(citekey)])
-        return (completions, 0)
+        return (completions, flags)
 
-    def on_activated(self, view):
-        self.update_note_link_highlights(view)
+    def on_activated_async(self, view):
+        self.schedule_highlights(view)
 
     # Async listeners for ST3
     def on_load_async(self, view):
         global AUTO_SHOW_IMAGES
-        self.update_note_link_highlights_async(view)
+        self.schedule_highlights(view)
         if AUTO_SHOW_IMAGES:
             view.run_command('zk_show_images')
 
-    def on_modified_async(self, view):
-        self.update_note_link_highlights_async(view)
+    def on_activated(self, view):
+        self.take_snapshot(view)
 
-    def on_close(self, view):
-        for map in [self.note_links_for_view, self.scopes_for_view,
-                    self.ignored_views]:
-            if view.id() in map:
-                del map[view.id()]
+    def on_selection_modified(self, view):
+        snapshot = NoteLinkHighlighter.snapshots.get(view.id())
+        if snapshot is None or snapshot[0] == view.change_count():
+            # else on_modified() still needs it
+            self.take_snapshot(view)
 
-    def update_note_link_highlights(self, view):
+    def on_modified(self, view):
         """
-        The entry point. Find all LINKs in view, store and highlight them
+        Remember the lines touched by the edit. Only an edit at the cursor,
+        checked against the snapshot of the text around it, is marked by
+        its lines; for any other edit, e.g. by a command or by undo, the
+        whole view is rescanned.
         """
-        settings = get_settings()
-        should_highlight = settings.get('highlight_note_links')
-
-        max_note_link_limit = NoteLinkHighlighter.DEFAULT_MAX_LINKS
-        if view.id() in NoteLinkHighlighter.ignored_views:
+        view_id = view.id()
+        snapshot = NoteLinkHighlighter.snapshots.get(view_id)
+        self.take_snapshot(view)
+        if view_id not in NoteLinkHighlighter.change_counts:
+            return
+        region = snapshot and self.edited_region(view, snapshot)
+        if region is None:
+            self.set_pending(view, [sublime.Region(0, view.size())])
             return
+        dirty = view.get_regions(NoteLinkHighlighter.Dirty_Key)
+        dirty.append(view.line(region))
+        view.add_regions(NoteLinkHighlighter.Dirty_Key, merge_regions(dirty),
+                         '', '', sublime.HIDDEN)
 
-        note_links = view.find_by_selector('markup.zettel.link')
-        # update the regions to ignore the brackets
-        note_links = [sublime.Region(n.a, n.b) for n in note_links]
+    def take_snapshot(self, view):
+        """
+        Remember the change count, size and selection of view, and the text
+        around the selection, to find the next edit by.
+        """
+        sel = view.sel()
+        size = view.size()
+        if len(sel) != 1:
+            snapshot = (view.change_count(), size, None, None, '', '')
+        else:
+            a, b = sel[0].begin(), sel[0].end()
+            n = NoteLinkHighlighter.Context_Size
+            snapshot = (view.change_count(), size, a, b,
+                        view.substr(sublime.Region(max(0, a - n), a)),
+                        view.substr(sublime.Region(b, min(size, b + n))))
+        NoteLinkHighlighter.snapshots[view.id()] = snapshot
+
+    def edited_region(self, view, snapshot):
+        """
+        Return the region of the text inserted at the selection of the
+        snapshot, empty for a deletion, if that explains the one edit since
+        the snapshot. Else None.
+        """
+        count, size, a, b, before, after = snapshot
+        sel = view.sel()
+        if a is None or len(sel) != 1 or view.change_count() != count + 1:
+            return None
+        cursor = sel[0]
+        grown = view.size() - size
+
+        def text(begin, end):
+            return view.substr(sublime.Region(max(0, begin), end))
+
+        # typed or pasted over the selection: the text around it stays put
+        end = b + grown
+        if a <= cursor.begin() and cursor.end() <= end \
+                and (cursor.begin(), cursor.end()) != (a, b) \
+                and text(a - len(before), a) == before \
+                and text(end, end + len(after)) == after:
+            return sublime.Region(a, end)
+        if a != b or grown >= 0:
+            return None
+        # deleted before the cursor, e.g. by backspace
+        start = a + grown
+        if cursor.empty() and cursor.begin() == start \
+                and -grown <= len(before) \
+                and text(start - len(before) - grown, start) \
+                == before[:len(before) + grown] \
+                and text(start, start + len(after)) == after:
+            return sublime.Region(start)
+        # deleted after the cursor
+        if cursor.empty() and cursor.begin() == a \
+                and -grown <= len(after) \
+                and text(a - len(before), a) == before \
+                and text(a, a + len(after) + grown) == after[-grown:]:
+            return sublime.Region(a)
+        return None
 
-        # Avoid slowdowns for views with too many links
-        n_links = len(note_links)
-        if n_links > max_note_link_limit:
-            print('NoteLinkHighlighter: ignoring view with %d links' % n_links)
-            NoteLinkHighlighter.ignored_views.append(view.id())
+    def on_modified_async(self, view):
+        self.schedule_highlights(view, NoteLinkHighlighter.Debounce_Delay)
 
-        tag_regions = view.find_all(ZkConstants.RE_TAGS_PY())
-        NoteLinkHighlighter.tag_regions[view.id()] = tag_regions
+    def on_post_save_async(self, view):
+        NoteIndex.notify_saved(view.file_name())
 
-        NoteLinkHighlighter.note_links_for_view[view.id()] = note_links
+    def on_close(self, view):
+        NoteLinkHighlighter.scheduler.cancel(view.id())
+        for map in [NoteLinkHighlighter.change_counts,
+                    NoteLinkHighlighter.snapshots,
+                    NoteLinkHighlighter.end_scopes,
+                    NoteLinkHighlighter.scopes_for_view,
+                    NoteLinkHighlighter.tag_scopes]:
+            map.pop(view.id(), None)
+
+    def schedule_highlights(self, view, delay=0):
+        """
+        Have the highlighting of view updated, replacing an update that has
+        not started yet.
+        """
+        NoteLinkHighlighter.scheduler.submit(
+            view.id(), lambda: self.highlight_view(view), delay)
 
-        if should_highlight:
-            self.highlight_note_links(view, note_links, tag_regions)
+    def highlight_view(self, view):
+        """
+        The job of the scheduler: update the highlighting of the view, then
+        scan the rest of it for a while, and come back for more if needed.
+        """
+        if not view.is_valid():
+            return
+        settings = get_settings()
+        if not settings.get('highlight_note_links'):
+            return
+        self.update_note_link_highlights(view)
+        if self.fill_in_highlights(view):
+            self.schedule_highlights(view, NoteLinkHighlighter.Chunk_Delay)
 
-    def update_note_link_highlights_async(self, view):
-        NoteLinkHighlighter.highlight_semaphore.acquire()
-        try:
-            self.update_note_link_highlights(view)
-        finally:
-            NoteLinkHighlighter.highlight_semaphore.release()
+    @Stats.timed('highlighting update')
+    def update_note_link_highlights(self, view):
+        """
+        Find the LINKs and tags in the lines edited since the last pass and
+        in the visible part of the view that was not scanned yet, and
+        highlight them. The rest of the view is scanned in the background by
+        fill_in_highlights(). Does nothing if the view has not changed since
+        the last pass. If the view is edited while this runs, the dirty and
+        pending regions are left as they are, with the edit marked by
+        on_modified(), for the next pass.
+        """
+        view_id = view.id()
+        change_count = view.change_count()
+        last_count = NoteLinkHighlighter.change_counts.get(view_id)
+        if last_count == change_count:
+            return
+        size = view.size()
+        if last_count is None:
+            # from now on, on_modified() marks the edits
+            self.set_pending(view, [sublime.Region(0, size)])
+            NoteLinkHighlighter.change_counts[view_id] = change_count
+            dirty = []
+            pending = [sublime.Region(0, size)]
+        else:
+            dirty = merge_regions(
+                view.get_regions(NoteLinkHighlighter.Dirty_Key))
+            pending = view.get_regions(NoteLinkHighlighter.Pending_Key)
+
+        # an edit can change the syntax context of everything after it,
+        # e.g. an opened code fence: check for that and rescan the rest
+        end_scope = view.scope_name(size)
+        if dirty:
+            rescan = self.first_stale_link(view, dirty)
+            if end_scope != NoteLinkHighlighter.end_scopes.get(view_id):
+                rescan = dirty[0].begin()
+            if rescan is not None:
+                start = view.line(rescan).begin()
+                pending.append(sublime.Region(start, size))
+
+        # the visible part first
+        visible = view.line(view.visible_region())
+        pending = merge_regions(pending)
+        dirty = merge_regions(dirty + intersect_regions(pending, visible))
+        pending = subtract_regions(pending, dirty)
+        if dirty and not self.rescan_regions(view, dirty, change_count) \
+                or view.change_count() != change_count:
+            # edited meanwhile: the next pass covers this one's regions and
+            # the ones of the edit
+            return
+        view.erase_regions(NoteLinkHighlighter.Dirty_Key)
+        self.set_pending(view, pending)
+        if view.change_count() != change_count:
+            # an edit just now may have lost its mark
+            self.set_pending(view, [sublime.Region(0, view.size())])
+        NoteLinkHighlighter.end_scopes[view_id] = end_scope
+        NoteLinkHighlighter.change_counts[view_id] = change_count
+
+    @Stats.timed('highlighting fill-in')
+    def fill_in_highlights(self, view):
+        """
+        Scan the pending regions of view, in chunks of whole lines, for up to
+        Chunk_Time. What is found is highlighted at the end, with one update
+        of the regions per key. Returns whether there is more to scan.
+        """
+        change_count = view.change_count()
+        pending = merge_regions(
+            view.get_regions(NoteLinkHighlighter.Pending_Key))
+        deadline = time.perf_counter() + NoteLinkHighlighter.Chunk_Time
+        scanned = []
+        link_map = {}
+        tag_regions = []
+        while pending:
+            region = pending[0]
+            end = region.begin() + NoteLinkHighlighter.Chunk_Size
+            end = min(view.line(min(end, region.end())).end(), region.end())
+            # whole lines, but no line twice: a token would be found twice
+            chunk = view.line(sublime.Region(region.begin(), end))
+            if scanned and scanned[-1].end() > chunk.begin():
+                chunk = sublime.Region(scanned[-1].end(), chunk.end())
+            self.find_highlights(view, [chunk], link_map, tag_regions)
+            scanned.append(chunk)
+            if end < region.end():
+                pending[0] = sublime.Region(end, region.end())
+            else:
+                del pending[0]
+            if time.perf_counter() > deadline:
+                break
+        if not self.highlight_regions(view, merge_regions(scanned), link_map,
+                                      tag_regions, change_count) \
+                or view.change_count() != change_count:
+            # edited meanwhile: the edit comes first
+            return True
+        self.set_pending(view, pending)
+        if view.change_count() != change_count:
+            # an edit just now may have lost its mark
+            self.set_pending(view, [sublime.Region(0, view.size())])
+            return True
+        return bool(pending)
+
+    def set_pending(self, view, pending):
+        """
+        Store the regions of view left to scan.
+        """
+        if pending:
+            view.add_regions(NoteLinkHighlighter.Pending_Key, pending,
+                             '', '', sublime.HIDDEN)
+        else:
+            view.erase_regions(NoteLinkHighlighter.Pending_Key)
 
-    def highlight_note_links(self, view, note_links, tag_regions):
+    def rescan_regions(self, view, dirty, change_count):
+        """
+        Rescan the lines of the dirty regions for links and tags and update
+        the highlighted regions there. Returns False, leaving the rest as it
+        is, if the view was edited since change_count.
+        """
+        dirty = merge_regions([view.line(region) for region in dirty])
+        link_map = {}
+        tag_regions = []
+        self.find_highlights(view, dirty, link_map, tag_regions)
+        return self.highlight_regions(view, dirty, link_map, tag_regions,
+                                      change_count)
+
+    def find_highlights(self, view, regions, link_map, tag_regions):
+        """
+        Add the links in regions to link_map, scope name -> link regions,
+        and the tags to tag_regions.
         """
-        Creates a set of regions from the intersection of note_links and scopes,
-        underlines all of them.
+        # We need separate regions for each lexical scope for ST to use a
+        # proper color for the underline
+        for region in regions:
+            offset = region.begin()
+            for token in Tokenizer.tokenize(view.substr(region)):
+                if token.kind == 'tag':
+                    tag_regions.append(sublime.Region(
+                        offset + token.start, offset + token.end))
+                elif token.kind == 'link':
+                    end = offset + token.end
+                    start = end - len(token.value)
+                    if view.match_selector(start, 'markup.zettel.link'):
+                        link_map.setdefault(view.scope_name(start), []).append(
+                            sublime.Region(start, end))
+
+    def highlight_regions(self, view, dirty, link_map, tag_regions,
+                          change_count):
+        """
+        Replace the highlighted links and tags within the dirty regions by
+        the ones found there. Returns False, leaving the rest as it is, if
+        the view was edited since change_count.
         """
         settings = get_settings()
         show_bookmarks = settings.get('show_bookmarks_in_gutter')
+        view_id = view.id()
+        scopes = set(NoteLinkHighlighter.scopes_for_view.get(view_id, ()))
+        scopes.update(link_map)
+        new_scopes = []
+        for scope_name in scopes:
+            n = self.underline_regions(view, scope_name,
+                                       link_map.get(scope_name, []), dirty,
+                                       show_bookmarks, False, change_count)
+            if n is None:
+                NoteLinkHighlighter.scopes_for_view[view_id] = list(scopes)
+                return False
+            if n:
+                new_scopes.append(scope_name)
+        NoteLinkHighlighter.scopes_for_view[view_id] = new_scopes
+
+        scope_name = 'markup.zettel.tag'
+        n = self.underline_regions(view, scope_name, tag_regions, dirty,
+                                   show_bookmarks, True, change_count)
+        if n is None:
+            return False
+        if n:
+            NoteLinkHighlighter.tag_scopes[view_id] = [scope_name]
+        else:
+            NoteLinkHighlighter.tag_scopes.pop(view_id, None)
+        return True
 
-        # We need separate regions for each lexical scope for ST to use a
-        # proper color for the underline
-        scope_map = {}
-        for note_link in note_links:
-            scope_name = view.scope_name(note_link.a)
-            scope_map.setdefault(scope_name, []).append(note_link)
-        for scope_name in scope_map:
-            self.underline_regions(view, scope_name, scope_map[scope_name],
-                                   show_bookmarks, tags=False)
-        self.update_view_scopes(view, scope_map.keys(), tags=False)
-
-        scope_map = {}
-        for tag_region in tag_regions:
-            scope_name = view.scope_name(tag_region.a)
-            scope_name = 'markup.zettel.tag'
-            scope_map.setdefault(scope_name, []).append(tag_region)
-        for scope_name in scope_map:
-            self.underline_regions(view, scope_name, scope_map[scope_name],
-                                   show_bookmarks, tags=True)
-        self.update_view_scopes(view, scope_map.keys(), tags=True)
-
-    def underline_regions(self, view, scope_name, regions, show_bookmarks, tags):
-        """
-        Apply underlining to provided regions.
+    def underline_regions(self, view, scope_name, regions, dirty,
+                          show_bookmarks, tags, change_count):
+        """
+        Replace the underlined regions of scope_name within dirty by regions.
+        Returns the number of regions underlined now, or None if the view was
+        edited since change_count.
         """
         if show_bookmarks:
             symbol = 'bookmark'
@@ -2471,29 +6045,49 @@ class NoteLinkHighlighter(sublime_plugin.EventListener):
             scope = 'markup.zettel.tag'
             symbol = ''
 
-        view.add_regions(key, regions, scope, symbol, flags)
+        # the underlined regions are sorted and don't overlap
+        old_regions = view.get_regions(key)
+        begins = [r.begin() for r in old_regions]
+        kept = []
+        start = 0
+        for region in dirty:
+            i = bisect.bisect_left(begins, region.begin(), start)
+            if i > start and old_regions[i - 1].end() >= region.begin():
+                i -= 1
+            kept.extend(old_regions[start:i])
+            start = max(start, bisect.bisect_right(begins, region.end(), i))
+        kept.extend(old_regions[start:])
+        if not regions and len(kept) == len(old_regions):
+            return len(kept)
+        regions = sorted(kept + regions, key=lambda r: r.begin())
+        # the positions are only valid for the text they were found in
+        if view.change_count() != change_count:
+            return None
+        if regions:
+            view.add_regions(key, regions, scope, symbol, flags)
+        else:
+            view.erase_regions(key)
+        return len(regions)
 
-    def update_view_scopes(self, view, new_scopes, tags):
+    def first_stale_link(self, view, dirty):
         """
-        Store new set of underlined scopes for view.
-        Erase underlining from scopes that were once used but are not anymore.
+        Return the position of the first highlighted link after a dirty region
+        that is no longer in the scope it was highlighted for, or None.
         """
-        if not tags:
-            old_scopes = NoteLinkHighlighter.scopes_for_view.get(
-                view.id(), None)
-            if old_scopes:
-                unused_scopes = set(old_scopes) - set(new_scopes)
-                for unused_scope_name in unused_scopes:
-                    view.erase_regions(
-                        u'clickable-note_links ' + unused_scope_name)
-            NoteLinkHighlighter.scopes_for_view[view.id()] = new_scopes
-        else:
-            old_scopes = NoteLinkHighlighter.tag_scopes.get(view.id(), None)
-            if old_scopes:
-                unused_scopes = set(old_scopes) - set(new_scopes)
-                for unused_scope_name in unused_scopes:
-                    view.erase_regions(u'tag ' + unused_scope_name)
-            NoteLinkHighlighter.tag_scopes[view.id()] = new_scopes
+        after = []
+        for scope_name in NoteLinkHighlighter.scopes_for_view.get(view.id(),
+                                                                  ()):
+            key = u'clickable-note_links ' + scope_name
+            after.extend((r.begin(), scope_name) for r in view.get_regions(key))
+        after.sort()
+        starts = [pos for pos, scope_name in after]
+        for region in dirty:
+            i = bisect.bisect_left(starts, region.end())
+            if i < len(after):
+                pos, scope_name = after[i]
+                if view.scope_name(pos) != scope_name:
+                    return region.end()
+        return None
 
     def on_window_command(self, window, command_name, args):
         global DISTRACTION_FREE_MODE_ACTIVE
@@ -2516,6 +6110,4 @@ class NoteLinkHighlighter(sublime_plugin.EventListener):
                     view.run_command('zk_show_images')
 
 
-def get_as_base64(url):
-    image = urllib.request.urlopen(url)
-    return base64.encodestring(image.read()).decode('ascii').replace('\n', '')
+Stats.instrument_commands(globals())